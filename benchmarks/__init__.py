@@ -0,0 +1,45 @@
+"""Micro benchmarks for the key server.
+
+Run a benchmark as a module from the repository root, e.g.
+``python -m benchmarks.bench_token_lookup``. Benchmarks build their own
+throwaway SQLite database; ``KEYSERV_CONFIG`` selects the config class the
+app is created with (``TestConfig`` by default).
+"""
+import os
+import statistics
+import tempfile
+import time
+
+from keyserv import create_app
+from keyserv.models import db
+
+
+def bench_app(database_uri: str = None):
+    """Create an app bound to a fresh database, with an app context pushed."""
+    app = create_app(os.environ.get("KEYSERV_CONFIG", "TestConfig"))
+    if database_uri is None:
+        database_uri = "sqlite:///" + os.path.join(tempfile.mkdtemp(), "bench.db")
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_uri
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    ctx = app.test_request_context()
+    ctx.push()
+    db.create_all()
+    return app
+
+
+def timed(func, repeat: int) -> dict:
+    """Call `func` `repeat` times and summarise the latencies in microseconds."""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1e6)
+    samples.sort()
+    return {"mean": statistics.mean(samples),
+            "p50": samples[len(samples) // 2],
+            "p99": samples[min(len(samples) - 1, int(len(samples) * 0.99))]}
+
+
+def report(label: str, stats: dict):
+    print(f"{label:<32} mean {stats['mean']:>10.1f}us  p50 {stats['p50']:>10.1f}us"
+          f"  p99 {stats['p99']:>10.1f}us")
@@ -0,0 +1,69 @@
+"""Activation match latency on a key with many activations.
+
+    python -m benchmarks.bench_activation_lookup [--activations 100000]
+
+`find_activation` reads only the matching rows through the
+(key_id, kunin_employee_id, hwid) index; the legacy path loads every
+activation of the key and filters them in Python.
+"""
+import argparse
+import random
+from datetime import datetime, timedelta
+
+from benchmarks import bench_app, report, timed
+from keyserv.idblocks import id_blocks
+from keyserv.keymanager import find_activation, rand_token
+from keyserv.models import Activation, Application, Key, db
+
+
+def _seed(key_id: int, count: int) -> list:
+    valid_until = datetime.utcnow() + timedelta(days=30)
+    rows, matches = [], []
+    for n in range(count):
+        match = (n % 5000, f"hw-{n:08d}")
+        matches.append(match)
+        rows.append({"key_id": key_id, "kunin_employee_id": match[0], "hwid": match[1],
+                     "activation_ts": datetime.utcnow(), "valid_until": valid_until})
+        if len(rows) == 10000:
+            db.session.execute(Activation.__table__.insert(),
+                               id_blocks.assign(db.session.connection(), Activation.__table__,
+                                                rows))
+            rows = []
+    if rows:
+        db.session.execute(Activation.__table__.insert(),
+                           id_blocks.assign(db.session.connection(), Activation.__table__, rows))
+    db.session.commit()
+    return matches
+
+
+def _legacy_scan(key_id: int, kunin_employee_id: int, hwid: str):
+    db.session.expunge_all()
+    key = Key.query.get(key_id)
+    activation = [a for a in key.activations if a.kunin_employee_id == kunin_employee_id
+                  and a.hwid == hwid]
+    return activation[0] if activation else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--activations", type=int, default=100000)
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--scans", type=int, default=5)
+    args = parser.parse_args()
+
+    bench_app()
+    app_id = Application(name="bench").save().id
+    key_id = Key(token=rand_token(), remaining=-1, app_id=app_id).save().id
+    matches = _seed(key_id, args.activations)
+    db.session.expunge_all()
+
+    label = f"{args.activations} activations"
+    report(f"{label}, hit", timed(lambda: find_activation(key_id, *random.choice(matches)),
+                                  args.lookups))
+    report(f"{label}, miss", timed(lambda: find_activation(key_id, 1, "missing"), args.lookups))
+    report(f"{label}, legacy scan", timed(lambda: _legacy_scan(key_id, *random.choice(matches)),
+                                          args.scans))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""Concurrent claims from the key pool.
+
+    python -m benchmarks.bench_claims [--claimers 50] [--keys 5000] [--database-uri URI]
+
+Runs `claimers` threads claiming keys until the pool is empty and reports
+the claim latency, throughput and how many keys were handed out twice. The
+legacy read-then-write claim is run against a fresh pool for comparison.
+Pass a PostgreSQL `--database-uri` to exercise the `SKIP LOCKED` path.
+"""
+import argparse
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+from benchmarks import bench_app, report
+from keyserv.idblocks import id_blocks
+from keyserv.keymanager import claim_key, rand_token
+from keyserv.models import Application, Key, db, token_digest
+
+
+def _seed(app_id: int, count: int):
+    rows = []
+    for _ in range(count):
+        token = rand_token()
+        rows.append({"app_id": app_id, "token": token, "token_digest": token_digest(token),
+                     "enabled": True, "remaining": 1, "total_checks": 0, "version": 1})
+    db.session.execute(Key.__table__.insert(),
+                       id_blocks.assign(db.session.connection(), Key.__table__, rows))
+    db.session.commit()
+
+
+def _legacy_claim(app_id: int, claimed_by: str, memo: str) -> Key:
+    key = Key.query.filter_by(app_id=app_id, claimed_by=None, enabled=True) \
+        .filter(Key.remaining != 0).first()
+    if not key:
+        return None
+    key.claimed_by = claimed_by
+    key.claimed_at = datetime.utcnow()
+    key.memo = memo
+    db.session.commit()
+    return key
+
+
+def _race(app, claim, app_id: int, claimers: int):
+    latencies, claimed, errors = [], [], []
+
+    def claimer(n: int):
+        with app.app_context():
+            attempt = 0
+            while True:
+                attempt += 1
+                start = time.perf_counter()
+                try:
+                    key = claim(app_id, f"{n}-{attempt}@example.com", "bench")
+                except Exception as error:
+                    errors.append(error)
+                    db.session.rollback()
+                    continue
+                latencies.append((time.perf_counter() - start) * 1e6)
+                if not key:
+                    break
+                claimed.append(key.id)
+            db.session.remove()
+
+    workers = [threading.Thread(target=claimer, args=(n,)) for n in range(claimers)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.perf_counter() - start, sorted(latencies), claimed, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--claimers", type=int, default=50)
+    parser.add_argument("--keys", type=int, default=5000)
+    parser.add_argument("--database-uri")
+    args = parser.parse_args()
+
+    app = bench_app(args.database_uri)
+    for label, claim in (("claim_key", claim_key), ("legacy claim", _legacy_claim)):
+        app_id = Application(name=f"bench {label}").save().id
+        _seed(app_id, args.keys)
+        db.session.remove()
+
+        elapsed, latencies, claimed, errors = _race(app, claim, app_id, args.claimers)
+        report(f"{args.claimers} claimers, {label}", {
+            "mean": sum(latencies) / len(latencies),
+            "p50": latencies[len(latencies) // 2],
+            "p99": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]})
+        duplicates = sum(count - 1 for count in Counter(claimed).values())
+        print(f"{'':<32} {len(claimed) / elapsed:>10.0f} claims/s  {duplicates} duplicate(s)"
+              f"  {len(errors)} error(s)")
+
+
+if __name__ == "__main__":
+    main()
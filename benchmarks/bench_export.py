@@ -0,0 +1,76 @@
+"""Audit log export time and peak memory as the table grows.
+
+    python -m benchmarks.bench_export [--sizes 10000,100000,1000000]
+
+`stream` should hold memory flat across sizes; loading the ORM rows and
+rendering them at once, as scraping the admin page amounts to, is included
+for the smaller sizes for comparison.
+"""
+import argparse
+import time
+import tracemalloc
+from datetime import datetime
+
+from benchmarks import bench_app
+from keyserv.export import export_query, stream
+from keyserv.idblocks import id_blocks
+from keyserv.models import Application, AuditLog, Event, Key, db
+
+
+def _seed(count: int):
+    application = Application(name=f"bench {count}").save()
+    key = Key(token=f"BENCH{count}", remaining=1, app_id=application.id).save()
+    rows = []
+    for n in range(count):
+        rows.append({"key_id": key.id, "app_id": application.id, "message": f"check {n}",
+                     "event_type": int(Event.KeyAccess), "timestamp": datetime.now()})
+        if len(rows) == 10000:
+            db.session.execute(AuditLog.__table__.insert(),
+                               id_blocks.assign(db.session.connection(), AuditLog.__table__, rows))
+            rows = []
+    if rows:
+        db.session.execute(AuditLog.__table__.insert(),
+                           id_blocks.assign(db.session.connection(), AuditLog.__table__, rows))
+    db.session.commit()
+    return application.id
+
+
+def _streamed(app_id: int) -> int:
+    return sum(len(chunk) for chunk in stream(export_query("logs", app_id)))
+
+
+def _loaded(app_id: int) -> int:
+    logs = AuditLog.query.filter_by(app_id=app_id).all()
+    return len("".join(f"{log.id},{log.timestamp},{log.key.token},{log.app.name},{log.message}\n"
+                       for log in logs))
+
+
+def _measure(label: str, export, app_id: int):
+    db.session.expunge_all()
+    tracemalloc.start()
+    start = time.perf_counter()
+    written = export(app_id)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    print(f"{label:<32} {elapsed:>8.2f}s  peak {peak / 2 ** 20:>8.1f}MiB  "
+          f"{written / 2 ** 20:>8.1f}MiB written")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--load-limit", type=int, default=100000,
+                        help="largest table size to load at once for comparison")
+    args = parser.parse_args()
+
+    bench_app()
+    for size in map(int, args.sizes.split(",")):
+        app_id = _seed(size)
+        _measure(f"{size} rows, stream", _streamed, app_id)
+        if size <= args.load_limit:
+            _measure(f"{size} rows, load all", _loaded, app_id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+"""Kunin API call latency, pooled session against a new connection per call.
+
+    python -m benchmarks.bench_kunin [--calls 500] [--delay 0]
+
+Runs against the local Kunin stub from the test suite, so it needs no
+network. Over TLS the gap widens by a handshake per call.
+"""
+import argparse
+
+import requests
+
+from benchmarks import bench_app, report, timed
+from keyserv.kunin import kunin_client
+from tests.kunin_stub import KuninStub
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--calls", type=int, default=500)
+    parser.add_argument("--delay", type=float, default=0.0, help="stub response delay in seconds")
+    args = parser.parse_args()
+
+    app = bench_app()
+    stub = KuninStub().start()
+    stub.delay = args.delay
+    app.config["KUNIN_API"] = stub.url
+    kunin_client.init_app(app)
+    payload = {"user": {"email": "bench@example.com", "password": "secret", "client_id": 1}}
+
+    report("unpooled requests.post", timed(
+        lambda: requests.post(stub.url + "/api/v1/users", json=payload), args.calls))
+    connections = len(stub.connections)
+    report("KuninClient", timed(
+        lambda: kunin_client.register("bench@example.com", "secret", 1), args.calls))
+    print(f"connections opened: unpooled {connections}, "
+          f"pooled {len(stub.connections) - connections}")
+    stub.stop()
+
+
+if __name__ == "__main__":
+    main()
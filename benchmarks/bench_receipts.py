@@ -0,0 +1,36 @@
+"""Receipt signing and verification throughput.
+
+    python -m benchmarks.bench_receipts [--count 100000]
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+
+from benchmarks import bench_app
+from keyserv.keymanager import new_receipt_key, sign_receipt, verify_receipt
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--count", type=int, default=100000)
+    args = parser.parse_args()
+
+    app = bench_app("sqlite://")
+    app.config["RECEIPT_KEYS"] = {"bench": new_receipt_key()[0]}
+    app.config["RECEIPT_KEY_ID"] = "bench"
+    valid_until = datetime.utcnow() + timedelta(days=1)
+
+    start = time.perf_counter()
+    receipts = [sign_receipt(i, "00:11:22:33:44:55", i, valid_until) for i in range(args.count)]
+    elapsed = time.perf_counter() - start
+    print(f"sign    {args.count / elapsed:>12,.0f} receipts/s  ({len(receipts[-1])} bytes each)")
+
+    start = time.perf_counter()
+    for receipt in receipts:
+        verify_receipt(receipt)
+    elapsed = time.perf_counter() - start
+    print(f"verify  {args.count / elapsed:>12,.0f} receipts/s")
+
+
+if __name__ == "__main__":
+    main()
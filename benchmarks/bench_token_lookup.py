@@ -0,0 +1,71 @@
+"""Token lookup latency as the key table grows.
+
+    python -m benchmarks.bench_token_lookup [--sizes 1000,10000,100000,1000000]
+
+Latency of `find_key_const` should stay flat across sizes; the legacy
+full-table scan is included for the smaller sizes for comparison.
+"""
+import argparse
+import random
+import secrets
+from hmac import compare_digest
+
+from benchmarks import bench_app, report, timed
+from keyserv.idblocks import id_blocks
+from keyserv.keymanager import find_key_const
+from keyserv.models import Application, Key, db, token_digest
+
+
+def _seed(app_id: int, count: int, tokens: list):
+    rows = []
+    for _ in range(count):
+        token = secrets.token_hex(13)[:25].upper()
+        tokens.append(token)
+        rows.append({"app_id": app_id, "token": token, "token_digest": token_digest(token),
+                     "enabled": True, "remaining": 1, "total_checks": 0})
+        if len(rows) == 10000:
+            db.session.execute(Key.__table__.insert(),
+                               id_blocks.assign(db.session.connection(), Key.__table__, rows))
+            rows = []
+    if rows:
+        db.session.execute(Key.__table__.insert(),
+                           id_blocks.assign(db.session.connection(), Key.__table__, rows))
+    db.session.commit()
+
+
+def _legacy_scan(app_id: int, token: str):
+    found = None
+    for key in Key.query.all():
+        if compare_digest(token, key.token) and key.enabled and key.app_id == app_id:
+            found = key
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sizes", default="1000,10000,100000,1000000")
+    parser.add_argument("--lookups", type=int, default=2000)
+    parser.add_argument("--scan-limit", type=int, default=10000,
+                        help="largest table size to run the legacy scan against")
+    args = parser.parse_args()
+
+    bench_app()
+    app_id = Application(name="bench").save().id
+    tokens = []
+    for size in sorted(int(s) for s in args.sizes.split(",")):
+        _seed(app_id, size - len(tokens), tokens)
+        db.session.expunge_all()
+
+        report(f"{size:>8} keys, hit", timed(
+            lambda: find_key_const(app_id, random.choice(tokens)), args.lookups))
+        report(f"{size:>8} keys, miss", timed(
+            lambda: find_key_const(app_id, secrets.token_hex(13)[:25].upper()),
+            args.lookups))
+        if size <= args.scan_limit:
+            report(f"{size:>8} keys, legacy scan", timed(
+                lambda: _legacy_scan(app_id, random.choice(tokens)), 20))
+            db.session.expunge_all()
+
+
+if __name__ == "__main__":
+    main()
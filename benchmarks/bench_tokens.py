@@ -0,0 +1,41 @@
+"""Token generation throughput.
+
+    python -m benchmarks.bench_tokens [--tokens 100000] [--batch 500]
+
+Compares `TokenGenerator.tokens` batches and single `TokenGenerator.token`
+calls with the per-character `secrets.choice` loop `rand_token` used before.
+"""
+import argparse
+import secrets
+import time
+
+from keyserv.tokens import DEFAULT_ALPHABET, DEFAULT_LENGTH, TokenGenerator
+
+
+def _legacy_rand_token(length: int = DEFAULT_LENGTH, chars: str = DEFAULT_ALPHABET) -> str:
+    return "".join(secrets.choice(chars) for i in range(length))
+
+
+def _throughput(label: str, func, tokens: int, per_call: int = 1):
+    start = time.perf_counter()
+    for _ in range(tokens // per_call):
+        func()
+    elapsed = time.perf_counter() - start
+    print(f"{label:<32} {tokens / elapsed:>12,.0f} tokens/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tokens", type=int, default=100000)
+    parser.add_argument("--batch", type=int, default=500)
+    args = parser.parse_args()
+
+    generator = TokenGenerator()
+    _throughput("legacy rand_token", _legacy_rand_token, args.tokens)
+    _throughput("TokenGenerator.token", generator.token, args.tokens)
+    _throughput(f"TokenGenerator.tokens({args.batch})", lambda: generator.tokens(args.batch),
+                args.tokens, args.batch)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+"""UUIDGenerator against the baseconv string implementation it replaced.
+
+    python -m benchmarks.bench_uuid [--ids 10000]
+
+Needs python-baseconv from requirements-dev.txt for the legacy side.
+"""
+import argparse
+from uuid import UUID, uuid4
+
+from baseconv import BASE16_ALPHABET, BaseConverter
+
+from benchmarks import report, timed
+from keyserv.uuidgenerator import (HEX_DOUBLE_WORD_LENGTH, HEX_DOUBLE_WORD_UPPER_BYTE,
+                                   MAX_DOUBLE_WORD, NEW_BIT_FLAG_MASK, OLD_BIT_FLAG, UUIDGenerator)
+
+BASE16 = BaseConverter(BASE16_ALPHABET.lower())
+
+
+def _legacy_new():
+    while True:
+        uuid = uuid4()
+        upper = int(BASE16.decode(str(uuid)[HEX_DOUBLE_WORD_UPPER_BYTE]))
+        replacer = BASE16.encode(upper & NEW_BIT_FLAG_MASK)
+        if int(replacer, 16) >= 16:
+            break
+    return UUID(str(uuid)[:-(HEX_DOUBLE_WORD_LENGTH)] + replacer +
+                str(uuid)[-(HEX_DOUBLE_WORD_LENGTH - 2):])
+
+
+def _legacy_int_to_uuid(int_id):
+    myid = str(uuid4())
+    replacer1 = BASE16.encode(MAX_DOUBLE_WORD - int(int_id))
+    replacer2 = BASE16.encode(int(BASE16.decode(myid[HEX_DOUBLE_WORD_UPPER_BYTE])) | OLD_BIT_FLAG)
+    return UUID(replacer1 + myid[HEX_DOUBLE_WORD_LENGTH:-(HEX_DOUBLE_WORD_LENGTH)] +
+                replacer2 + myid[-(HEX_DOUBLE_WORD_LENGTH - 2):])
+
+
+def _legacy_uuid_to_int(uuid):
+    return MAX_DOUBLE_WORD - int(BASE16.decode(uuid[:HEX_DOUBLE_WORD_LENGTH]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ids", type=int, default=10000)
+    args = parser.parse_args()
+
+    ids = list(range(1, args.ids + 1))
+    stored = _legacy_int_to_uuid(1000).hex
+    report("legacy int_to_uuid", timed(lambda: _legacy_int_to_uuid(1000), args.ids))
+    report("int_to_uuid", timed(lambda: UUIDGenerator.int_to_uuid(1000), args.ids))
+    report("legacy uuid_to_int", timed(lambda: _legacy_uuid_to_int(stored), args.ids))
+    report("uuid_to_int", timed(lambda: UUIDGenerator.uuid_to_int(stored), args.ids))
+    report("legacy UUIDGenerator()", timed(_legacy_new, args.ids))
+    report("UUIDGenerator()", timed(UUIDGenerator, args.ids))
+    report(f"legacy int_to_uuid x{args.ids}",
+           timed(lambda: [_legacy_int_to_uuid(i) for i in ids], 5))
+    report(f"int_to_uuids x{args.ids}", timed(lambda: UUIDGenerator.int_to_uuids(ids), 5))
+
+
+if __name__ == "__main__":
+    main()
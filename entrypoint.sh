@@ -1,8 +1,11 @@
 #!/bin/sh
-set -x
+set -ex
 
 flask initdb
-flask create-user admin devpassword
+# brings databases created by earlier versions up to date; a no-op on a fresh one
+flask db upgrade
+# the admin user already exists after the first start
+flask create-user admin devpassword || true
 
 # start Nginx
 nginx
@@ -20,16 +20,29 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import csv
+import json
+from datetime import timedelta
+
 import click
 from flask import Flask
 from werkzeug.middleware.proxy_fix import ProxyFix
 from flask_bootstrap import Bootstrap
 from flask_migrate import Migrate
 
+from .auditpolicy import audit_policy
 from .auth import login_manager, add_user
 from .endpoints import api
-from .models import db, Event
+from .export import EXPORTS, FORMATS, export_query, stream
+from .idblocks import id_blocks
+from .keymanager import backfill_token_digests, cut_keys, new_receipt_key
+from .kunin import kunin_client
+from .models import db, Application, Event
+from .provisioning import provisioning
+from .retention import audit_retention
+from .verdictcache import verdict_cache
 from .views import frontend
+from .writebehind import audit_sink, check_counters
 
 
 def format_event(value):
@@ -46,6 +59,15 @@ def format_datetime(value):
         return ""
 
 
+def _application(app_ref: str) -> Application:
+    """The application with id or name `app_ref` for the --app option of a command."""
+    application = (Application.get_by_id(app_ref) or
+                   Application.query.filter_by(name=app_ref).first())
+    if not application:
+        raise click.BadParameter(f"no application {app_ref!r}", param_hint="--app")
+    return application
+
+
 def create_app(config):
     app = Flask(__name__)
     app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
@@ -59,8 +81,16 @@ def create_app(config):
     Bootstrap(app)
     api.init_app(app)
     db.init_app(app)
+    id_blocks.init_app(app)
     migrate.init_app(app, db)
     login_manager.init_app(app)
+    verdict_cache.init_app(app)
+    audit_policy.init_app(app)
+    audit_sink.init_app(app)
+    check_counters.init_app(app)
+    kunin_client.init_app(app)
+    provisioning.init_app(app)
+    audit_retention.init_app(app)
 
     app.register_blueprint(frontend)
 
@@ -76,4 +106,88 @@ def create_app(config):
     def create_user_command(username: str, password: str):
         add_user(username, password.encode())
 
+    @app.cli.command("backfill-token-digests")
+    @click.option("--batch-size", default=1000, show_default=True)
+    @click.option("--all", "recompute", is_flag=True,
+                  help="Recompute every digest, e.g. after changing TOKEN_DIGEST_KEY.")
+    def backfill_token_digests_command(batch_size: int, recompute: bool):
+        updated = backfill_token_digests(batch_size, recompute)
+        print(f"updated token digests for {updated} key(s)")
+
+    @app.cli.command("new-receipt-key")
+    def new_receipt_key_command():
+        private_key, public_key = new_receipt_key()
+        print(f"private key (RECEIPT_KEYS): {private_key}")
+        print(f"public key (for clients): {public_key}")
+
+    @app.cli.command("cut-keys")
+    @click.option("--app", "app_ref", required=True, help="Application id or name.")
+    @click.option("--count", type=click.IntRange(min=1), required=True)
+    @click.option("--activations", type=int, default=1, show_default=True,
+                  help="Activations per key, -1 for unlimited.")
+    @click.option("--ttl", type=int, default=30, show_default=True, help="Days the keys are valid.")
+    @click.option("--kunin-client-id", type=int, default=0)
+    @click.option("--memo", default="")
+    @click.option("--format", "output_format", type=click.Choice(["csv", "ndjson"]), default="csv",
+                  show_default=True)
+    @click.option("--output", type=click.File("w"), default="-", help="Defaults to stdout.")
+    def cut_keys_command(app_ref: str, count: int, activations: int, ttl: int, kunin_client_id: int,
+                         memo: str, output_format: str, output):
+        application = _application(app_ref)
+        writer = csv.writer(output)
+        if output_format == "csv":
+            writer.writerow(["id", "token", "valid_until"])
+        cut = 0
+        for key_id, token, valid_until in cut_keys(application.id, count, activations, ttl,
+                                                   kunin_client_id, memo, "cli"):
+            if output_format == "csv":
+                writer.writerow([key_id, token, valid_until.isoformat()])
+            else:
+                output.write(json.dumps({"id": key_id, "token": token,
+                                         "valid_until": valid_until.isoformat()}) + "\n")
+            cut += 1
+        click.echo(f"cut {cut} key(s) for {application.name}", err=True)
+
+    @app.cli.command("export")
+    @click.argument("kind", type=click.Choice(sorted(EXPORTS)))
+    @click.option("--app", "app_ref", help="Application id or name.")
+    @click.option("--since", type=click.DateTime(), help="Only rows from this date on.")
+    @click.option("--until", type=click.DateTime(), help="Only rows before this date.")
+    @click.option("--event", type=click.Choice([event.name for event in Event]),
+                  help="Only logs or rollups of this event.")
+    @click.option("--format", "output_format", type=click.Choice(sorted(FORMATS)), default="csv",
+                  show_default=True)
+    @click.option("--output", type=click.File("w"), default="-", help="Defaults to stdout.")
+    def export_command(kind: str, app_ref: str, since, until, event: str, output_format: str,
+                       output):
+        try:
+            query = export_query(kind, _application(app_ref).id if app_ref else None, since, until,
+                                 Event[event] if event else None)
+        except ValueError as error:
+            raise click.BadParameter(str(error), param_hint="--event")
+        for chunk in stream(query, output_format, app.config.get("EXPORT_BATCH_SIZE", 1000)):
+            output.write(chunk)
+
+    @app.cli.command("purge-audit-logs")
+    @click.option("--event", type=click.Choice([event.name for event in Event]),
+                  help="Only purge this event. Defaults to every event in AUDIT_RETENTION.")
+    @click.option("--days", type=click.IntRange(min=0),
+                  help="Days to keep instead of AUDIT_RETENTION's.")
+    def purge_audit_logs_command(event: str, days: int):
+        retention = dict(audit_retention.retention)
+        if event:
+            retention = {Event[event]: retention.get(Event[event])}
+        if days is not None:
+            retention = {event_type: timedelta(days=days) for event_type in retention}
+        if None in retention.values():
+            raise click.BadParameter(f"{event} has no retention configured, pass --days",
+                                     param_hint="--event")
+        purged = audit_retention.purge(retention)
+        print(f"purged {purged} audit log row(s)")
+
+    @app.cli.command("provision-users")
+    def provision_users_command():
+        ran = provisioning.drain()
+        print(f"ran {ran} provisioning job(s)")
+
     return app
@@ -0,0 +1,89 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class AuditPolicy:
+    """Per-event sampling of the audit log.
+
+    `AUDIT_SAMPLING` maps `Event` names to a window in seconds. Of the events
+    of one name logged for a key from one IP, at most one per window is
+    written, and the next one written notes how many were suppressed in
+    between. Events not named, and events logged without an IP, are always
+    written. Each worker process remembers the last `AUDIT_SAMPLING_SIZE` key
+    and IP pairs, so with several workers a pair can be written once per
+    worker and window.
+    """
+
+    def __init__(self, windows: dict = None, size: int = 100000):
+        self._lock = threading.Lock()
+        self.configure(windows or {}, size)
+
+    def init_app(self, app):
+        self.configure(app.config.get("AUDIT_SAMPLING", {}),
+                       app.config.get("AUDIT_SAMPLING_SIZE", 100000))
+
+    def configure(self, windows: dict, size: int):
+        with self._lock:
+            self.windows = dict(windows)
+            self.size = size
+            # (key_id, event name, ip) -> [end of its window, events suppressed in it]
+            self._entries = OrderedDict()
+            self.written = self.evictions = 0
+            self.suppressed = {}
+
+    def admit(self, key_id: int, event_type, ip: str) -> Optional[int]:
+        """Whether to write an `event_type` event of key `key_id` from `ip`:
+        None to drop it, otherwise how many like it were dropped since the
+        last one written."""
+        window = self.windows.get(event_type.name)
+        if not window or ip is None:
+            return 0
+        now = time.monotonic()
+        entry_key = (key_id, event_type.name, ip)
+        with self._lock:
+            entry = self._entries.get(entry_key)
+            if entry is not None and entry[0] > now:
+                entry[1] += 1
+                self._entries.move_to_end(entry_key)
+                self.suppressed[event_type.name] = self.suppressed.get(event_type.name, 0) + 1
+                return None
+            self._entries.pop(entry_key, None)
+            self._entries[entry_key] = [now + window, 0]
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+            self.written += 1
+            return entry[1] if entry is not None else 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"windows": self.windows, "tracked": len(self._entries), "capacity": self.size,
+                    "written": self.written, "suppressed": dict(self.suppressed),
+                    "evictions": self.evictions}
+
+
+audit_policy = AuditPolicy()
@@ -6,6 +6,7 @@ class DefaultConfig(object):
     # a decent way to generate a secret key is by running: python -c "import os; print(repr(os.urandom(24)))"
     # then pasting the output here.
     SECRET_KEY = os.environ['SECRET_KEY']
+    TOKEN_DIGEST_KEY = os.environ.get('TOKEN_DIGEST_KEY')
 
     DEBUG = False
     TESTING = False
@@ -13,6 +14,47 @@ class DefaultConfig(object):
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_DATABASE_URI = "sqlite:///data/sqlite.db"
     KUNIN_API = 'https://dev.kuninai.com'
+    ID_BLOCK_SIZE = int(os.environ.get('ID_BLOCK_SIZE', 100))
+    CHECK_CACHE_SIZE = int(os.environ.get('CHECK_CACHE_SIZE', 10000))
+    CHECK_CACHE_TTL = int(os.environ.get('CHECK_CACHE_TTL', 60))
+    AUDIT_ASYNC = os.environ.get('AUDIT_ASYNC', '1') == '1'
+    AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', 500))
+    AUDIT_FLUSH_INTERVAL = float(os.environ.get('AUDIT_FLUSH_INTERVAL', 1.0))
+    # AUDIT_SAMPLING is "event:seconds,event:seconds"
+    AUDIT_SAMPLING = {event: float(seconds) for event, seconds in
+                      (pair.split(':', 1) for pair in
+                       os.environ.get('AUDIT_SAMPLING', 'KeyAccess:300').split(',') if pair)}
+    AUDIT_SAMPLING_SIZE = int(os.environ.get('AUDIT_SAMPLING_SIZE', 100000))
+    # AUDIT_RETENTION is "event:days,event:days"
+    AUDIT_RETENTION = {event: int(days) for event, days in
+                       (pair.split(':', 1) for pair in
+                        os.environ.get('AUDIT_RETENTION', 'KeyAccess:90').split(',') if pair)}
+    AUDIT_RETENTION_INTERVAL = float(os.environ.get('AUDIT_RETENTION_INTERVAL', 0))
+    AUDIT_RETENTION_CHUNK = int(os.environ.get('AUDIT_RETENTION_CHUNK', 500))
+    AUDIT_RETENTION_PAUSE = float(os.environ.get('AUDIT_RETENTION_PAUSE', 0.1))
+    CHECK_COUNTERS_ASYNC = os.environ.get('CHECK_COUNTERS_ASYNC', '1') == '1'
+    CHECK_COUNTERS_INTERVAL = float(os.environ.get('CHECK_COUNTERS_INTERVAL', 5.0))
+    # RECEIPT_KEYS is "id:private key,id:private key", RECEIPT_PUBLIC_KEYS "id:public key,..."
+    RECEIPT_KEYS = dict(pair.split(':', 1)
+                        for pair in os.environ.get('RECEIPT_KEYS', '').split(',') if pair)
+    RECEIPT_PUBLIC_KEYS = dict(pair.split(':', 1) for pair in
+                               os.environ.get('RECEIPT_PUBLIC_KEYS', '').split(',') if pair)
+    RECEIPT_KEY_ID = os.environ.get('RECEIPT_KEY_ID')
+    ADMIN_PAGE_SIZE = int(os.environ.get('ADMIN_PAGE_SIZE', 100))
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+    KUNIN_CONNECT_TIMEOUT = float(os.environ.get('KUNIN_CONNECT_TIMEOUT', 3.05))
+    KUNIN_READ_TIMEOUT = float(os.environ.get('KUNIN_READ_TIMEOUT', 10.0))
+    KUNIN_DEADLINE = float(os.environ.get('KUNIN_DEADLINE', 15.0))
+    KUNIN_RETRIES = int(os.environ.get('KUNIN_RETRIES', 2))
+    KUNIN_POOL_SIZE = int(os.environ.get('KUNIN_POOL_SIZE', 10))
+    KUNIN_BREAKER_THRESHOLD = int(os.environ.get('KUNIN_BREAKER_THRESHOLD', 5))
+    KUNIN_BREAKER_RESET = float(os.environ.get('KUNIN_BREAKER_RESET', 30.0))
+    KUNIN_EMPLOYEE_TTL = int(os.environ.get('KUNIN_EMPLOYEE_TTL', 7 * 86400))
+    KUNIN_ASYNC_PROVISIONING = os.environ.get('KUNIN_ASYNC_PROVISIONING', '0') == '1'
+    PROVISIONING_WORKER = os.environ.get('PROVISIONING_WORKER', '1') == '1'
+    PROVISIONING_CONCURRENCY = int(os.environ.get('PROVISIONING_CONCURRENCY', 4))
+    PROVISIONING_MAX_ATTEMPTS = int(os.environ.get('PROVISIONING_MAX_ATTEMPTS', 5))
+    PROVISIONING_KEY = os.environ.get('PROVISIONING_KEY')
 
 
 class ProductionConfig(DefaultConfig):
@@ -5,6 +5,9 @@ class DefaultConfig(object):
     # a decent way to generate a secret key is by running: python -c "import os; print(repr(os.urandom(24)))"
     # then pasting the output here.
     SECRET_KEY = __NOT_SET__
+    # keys are looked up by an HMAC of their token; this falls back to SECRET_KEY when unset.
+    # changing it requires running `flask backfill-token-digests --all`.
+    TOKEN_DIGEST_KEY = None
 
     DEBUG = False
     TESTING = False
@@ -12,13 +15,112 @@ class DefaultConfig(object):
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_DATABASE_URI = "sqlite:///:memory:"
 
+    # new rows get their id (and the uuid derived from it) before the INSERT, from blocks of
+    # ID_BLOCK_SIZE ids each process reserves per table. ids left in a block when a process
+    # exits are skipped.
+    ID_BLOCK_SIZE = 100
+
+    # /api/check verdicts are cached per worker; the TTL bounds how stale a verdict can be
+    # after a key is changed through another worker. A size of 0 disables the cache.
+    CHECK_CACHE_SIZE = 10000
+    CHECK_CACHE_TTL = 60
+
+    # audit log rows are buffered and inserted in batches from a background thread. when the
+    # buffer is full a request waits AUDIT_BUFFER_TIMEOUT seconds for room, then drops its row.
+    AUDIT_ASYNC = True
+    AUDIT_BATCH_SIZE = 500
+    AUDIT_FLUSH_INTERVAL = 1.0
+    AUDIT_BUFFER_SIZE = 10000
+    AUDIT_BUFFER_TIMEOUT = 0.1
+
+    # of the events named here that a key gets from one IP, at most one per the given number of
+    # seconds is logged; the row notes how many were left out. counts are per process, and the
+    # last AUDIT_SAMPLING_SIZE key and IP pairs are remembered.
+    AUDIT_SAMPLING = {"KeyAccess": 300}
+    AUDIT_SAMPLING_SIZE = 100000
+
+    # audit rows older than AUDIT_RETENTION[event name] days are counted into daily per-key rollups
+    # and deleted, AUDIT_RETENTION_CHUNK rows per transaction with AUDIT_RETENTION_PAUSE seconds
+    # between them; other events are kept. each process purges every AUDIT_RETENTION_INTERVAL
+    # seconds, or set it to 0 and run `flask purge-audit-logs` from a scheduler.
+    AUDIT_RETENTION = {"KeyAccess": 90}
+    AUDIT_RETENTION_INTERVAL = 0
+    AUDIT_RETENTION_CHUNK = 500
+    AUDIT_RETENTION_PAUSE = 0.1
+
+    # key check counters are aggregated per worker and written every CHECK_COUNTERS_INTERVAL seconds
+    CHECK_COUNTERS_ASYNC = True
+    CHECK_COUNTERS_INTERVAL = 5.0
+
+    # /api/activate and /api/check sign an offline receipt when asked with receipt=true.
+    # receipts are signed with the Ed25519 private key RECEIPT_KEYS[RECEIPT_KEY_ID] (base64url,
+    # made by `flask new-receipt-key`) and verified with the public key of any key in RECEIPT_KEYS
+    # or RECEIPT_PUBLIC_KEYS, which /api/receipt-keys lists. to rotate, add a key, point
+    # RECEIPT_KEY_ID at it and move the old key's public key to RECEIPT_PUBLIC_KEYS; drop it once
+    # RECEIPT_TTL seconds have passed.
+    RECEIPT_KEYS = {}
+    RECEIPT_PUBLIC_KEYS = {}
+    RECEIPT_KEY_ID = None
+    RECEIPT_TTL = 86400
+
+    # largest number of checks accepted by /api/check/batch
+    CHECK_BATCH_LIMIT = 1000
+
+    # rows per page in the admin listings
+    ADMIN_PAGE_SIZE = 100
+    # rows /export and `flask export` fetch from the database at a time
+    EXPORT_BATCH_SIZE = 1000
+
+    # activations of keys cut for a Kunin client register the user with the Kunin API. only
+    # connection failures are retried; a whole activation waits at most KUNIN_DEADLINE seconds.
+    # after KUNIN_BREAKER_THRESHOLD failures in a row calls fail fast for KUNIN_BREAKER_RESET
+    # seconds. KUNIN_API is Kunin's development API here and its production API in
+    # ProductionConfig, as in config.docker.py; point it at the Kunin deployment to use.
+    KUNIN_API = "https://dev.kuninai.com"
+    KUNIN_CONNECT_TIMEOUT = 3.05
+    KUNIN_READ_TIMEOUT = 10.0
+    KUNIN_DEADLINE = 15.0
+    KUNIN_RETRIES = 2
+    KUNIN_POOL_SIZE = 10
+    KUNIN_BREAKER_THRESHOLD = 5
+    KUNIN_BREAKER_RESET = 30.0
+    # a user Kunin resolved is remembered for KUNIN_EMPLOYEE_TTL seconds, so their activations
+    # on other machines skip the Kunin API as long as the password matches
+    KUNIN_EMPLOYEE_TTL = 7 * 86400
+
+    # with KUNIN_ASYNC_PROVISIONING on, activations return at once and the Kunin registration runs
+    # from an outbox table; clients get the kunin_employee_id from their next /api/check. a job
+    # failing for any reason is retried with backoff up to PROVISIONING_MAX_ATTEMPTS times.
+    # PROVISIONING_WORKER runs the worker inside each app process; turn it off to run
+    # `flask provision-users` from a scheduler instead. passwords waiting in the outbox are
+    # encrypted with PROVISIONING_KEY, or SECRET_KEY when it is None.
+    KUNIN_ASYNC_PROVISIONING = False
+    PROVISIONING_WORKER = True
+    PROVISIONING_CONCURRENCY = 4
+    PROVISIONING_INTERVAL = 1.0
+    PROVISIONING_MAX_ATTEMPTS = 5
+    PROVISIONING_LEASE = 60
+    PROVISIONING_KEY = None
+
 
 class ProductionConfig(DefaultConfig):
 
     SQLALCHEMY_DATABASE_URI = "postgres://localhost/keyserver"
+    KUNIN_API = "https://api.kuninai.com"  # see DefaultConfig
 
 
 class DevelopmentConfig(ProductionConfig):
     DEBUG = True
     TESTING = True
     SQLALCHEMY_TRACK_MODIFICATIONS = True
+
+
+class TestConfig(DefaultConfig):
+    TESTING = True
+    SECRET_KEY = "not-so-secret-in-tests"
+    WTF_CSRF_ENABLED = False
+    AUDIT_ASYNC = False
+    CHECK_COUNTERS_ASYNC = False
+    PROVISIONING_WORKER = False
+    RECEIPT_KEYS = {"test": "bm90LXNvLXNlY3JldC1yZWNlaXB0cy1pbi10ZXN0cyE"}
+    RECEIPT_KEY_ID = "test"
@@ -22,14 +22,18 @@
 
 
 import hmac
-from datetime import datetime
 
 from flask import request, current_app
-from flask_restful import Api, Resource, reqparse
+from flask_restful import Api, Resource, inputs, reqparse
 
-from keyserv.keymanager import (Origin, activate_key_unsafe, key_exists_const,
-                                key_get_unsafe, key_valid_const, key_still_valid, key_for_kunin_client_employee)
-from keyserv.models import Application, EarlyBirdApplication, Key, db
+from keyserv.keymanager import (ExhaustedActivations, KeyExpired, KeyNotFound,
+                                KuninRegistrationFailed, Origin, activate_key, check_etag,
+                                check_key, check_keys_bulk, check_not_modified, claim_key,
+                                provisioning_for, receipt_public_keys, receipt_valid_until,
+                                sign_receipt)
+from keyserv.kunin import KuninUnavailable
+from keyserv.models import Application, EarlyBirdApplication, Key, ProvisioningStatus, db
+from keyserv.tokens import app_id_of, token_filter
 
 api = Api()
 
@@ -42,6 +46,23 @@ def _cors_headers():
     }
 
 
+def _app_id(app_id: int, token: str) -> int:
+    """`app_id`, or the application id in the prefix of `token` when none was
+    given. 0, which is no application, when they disagree."""
+    prefixed = app_id_of(token)
+    if app_id is None:
+        return prefixed
+    return app_id if prefixed in (None, app_id) else 0
+
+
+_APP_ID_REQUIRED = {"result": "failure", "error": "app_id is required for this token"}, 400
+
+
+def _support_message(app_id: int) -> str:
+    app = Application.query.get(app_id)
+    return app.support_message if app else None
+
+
 class ActivateKey(Resource):
     """Endpoint used for key activation."""
 
@@ -57,50 +78,80 @@ class ActivateKey(Resource):
         parser.add_argument("token", required=True)
         parser.add_argument("machine", required=True)
         parser.add_argument("user", required=True)
-        parser.add_argument("app_id", required=True, type=int)
+        parser.add_argument("app_id", type=int)
         parser.add_argument("hwid", required=True)
         parser.add_argument("email")
         parser.add_argument("password")
+        parser.add_argument("receipt", type=inputs.boolean, default=False)
         args = parser.parse_args()
 
         origin = Origin(request.remote_addr, args.machine, args.user, args.hwid)
-
-        if not key_exists_const(args.app_id, args.token, origin):
-            resp = {"result": "failure", "error": "invalid activation token", "support_message": None}
-            if args.app_id:
-                app = Application.query.get(args.app_id)
+        token = token_filter.parse(args.token)
+        app_id = _app_id(args.app_id, token) if token else args.app_id
+        if token and app_id is None:
+            return _APP_ID_REQUIRED
+
+        try:
+            if not token or not app_id:
+                raise KeyNotFound("malformed token")
+            result = activate_key(app_id, token, origin, args.email, args.password)
+        except KeyNotFound:
+            resp = {"result": "failure", "error": "invalid activation token",
+                    "support_message": None}
+            if app_id:
+                app = Application.query.get(app_id)
                 if app and app.support_message:
                     resp["support_message"] = app.support_message
             return resp, 404
-
-        key = key_get_unsafe(args.app_id, args.token, origin)
-
-        if key.remaining == 0:
-            resp = {"result": "failure", "error": "key is out of activations",
-                    "support_message": key.app.support_message}
-            return resp, 410
-
-        if not key_still_valid(key):
-            resp = {"result": "failure", "error": "key is no longer valid",
-                    "support_message": key.app.support_message}
-            return resp, 410
-
-        # setup the new account using the key's kunin_client_id, kunin_email and kunin_password
-        kunin_employee_id = 0
-        if key.kunin_client_id:
-            kunin_employee_id = key_for_kunin_client_employee(key, key.kunin_client_id, args.email, args.password, origin)
-            if not kunin_employee_id:
-                resp = {"result": "failure", "error": "this account is already registered (or has had a trial)",
-                        "support_message": key.app.support_message}
-                return resp, 410
-
-        activation = activate_key_unsafe(args.app_id, args.token, kunin_employee_id, origin, key)
-
-        return {"result": "ok",
-                "remainingActivations": str(key.remaining) if key.remaining != -1 else 'unlimited',
-                "expiresOn": str(activation.valid_until),
-                "kunin_employee_id": kunin_employee_id,
-                "kunin_client_id": key.kunin_client_id}, 201
+        except ExhaustedActivations:
+            return {"result": "failure", "error": "key is out of activations",
+                    "support_message": _support_message(app_id)}, 410
+        except KeyExpired:
+            return {"result": "failure", "error": "key is no longer valid",
+                    "support_message": _support_message(app_id)}, 410
+        except KuninRegistrationFailed:
+            return {"result": "failure",
+                    "error": "this account is already registered (or has had a trial)",
+                    "support_message": _support_message(app_id)}, 410
+        except KuninUnavailable:
+            return {"result": "failure",
+                    "error": "activation is temporarily unavailable, try again later",
+                    "support_message": _support_message(app_id)}, 503
+
+        resp = {"result": "ok",
+                "remainingActivations":
+                    str(result.remaining) if result.remaining != -1 else 'unlimited',
+                "expiresOn": str(result.valid_until),
+                "kunin_employee_id": result.kunin_employee_id,
+                "kunin_client_id": result.kunin_client_id}
+        if result.provisioning:
+            # the Kunin user is registered in the background; checks report the employee id
+            resp.update(kunin_employee_id=None, provisioning="pending")
+        elif args.receipt:
+            resp["receipt"] = sign_receipt(result.key_id, args.hwid, result.kunin_employee_id,
+                                           receipt_valid_until(result.valid_until))
+        return resp, 201
+
+
+def _check_response(verdict, hwid: str, kunin_employee_id: int, receipt: bool) -> tuple:
+    """The /api/check response body and status for `verdict`."""
+    if verdict and verdict.still_valid():
+        extra = {"expiresOn": str(verdict.activation_valid_until)} if verdict.activation else {}
+        remaining = str(verdict.remaining) if verdict.remaining != -1 else 'unlimited'
+        # a receipt vouches for an activation, which a key checked from an unknown machine lacks
+        if receipt and verdict.activation:
+            extra["receipt"] = sign_receipt(verdict.key_id, hwid, kunin_employee_id,
+                                            receipt_valid_until(verdict.activation_valid_until,
+                                                                verdict.valid_until))
+        return {**{"remainingActivations": remaining, "kunin_employee_id": kunin_employee_id,
+                   "result": "ok", "kunin_client_id": verdict.kunin_client_id}, **extra}, \
+            200 if verdict.activation else 201
+
+    if not verdict:
+        return {"result": "failure", "error": "invalid key"}, 404
+    else:
+        expiry = verdict.activation_valid_until if verdict.activation else verdict.valid_until
+        return {"result": "failure", "error": f"invalid key; expired {expiry}"}, 404
 
 
 class CheckKey(Resource):
@@ -112,32 +163,93 @@ class CheckKey(Resource):
         parser.add_argument("machine", required=True, location='args')
         parser.add_argument("user", required=True, location='args')
         parser.add_argument("hwid", required=True, location='args')
-        parser.add_argument("app_id", required=True, type=int, location='args')
+        parser.add_argument("app_id", type=int, location='args')
         parser.add_argument("kunin_employee_id", required=False, type=int, location='args')
         parser.add_argument("kunin_client_id", required=False, type=int, location='args')
+        parser.add_argument("receipt", type=inputs.boolean, default=False, location='args')
 
         args = parser.parse_args()
 
         origin = Origin(request.remote_addr, args.machine, args.user, args.hwid)
+        token = token_filter.parse(args.token)
+        app_id = token and _app_id(args.app_id, token)
+        if token and app_id is None:
+            return _APP_ID_REQUIRED
+        if not token or not app_id:
+            return _check_response(None, args.hwid, args.kunin_employee_id, args.receipt)
+
+        # receipts are signed afresh on every check, so those responses carry no ETag
+        if not args.receipt:
+            for etag in request.if_none_match.as_set():
+                if check_not_modified(app_id, token, origin, args.kunin_employee_id, etag):
+                    return "", 304, {"ETag": f'"{etag}"'}
+
+        verdict = check_key(app_id, token, origin, args.kunin_employee_id)
+        body, status = _check_response(verdict, args.hwid, args.kunin_employee_id, args.receipt)
+        if (status != 404 and not args.kunin_employee_id and verdict.kunin_client_id and
+                current_app.config.get("KUNIN_ASYNC_PROVISIONING")):
+            job = provisioning_for(verdict.key_id, args.hwid)
+            if job:
+                body.update(kunin_employee_id=job.kunin_employee_id,
+                            provisioning=ProvisioningStatus(job.status).name.lower())
+        if status == 404 or "receipt" in body:
+            return body, status
+        return body, status, {"ETag": f'"{check_etag(verdict, args.hwid, args.kunin_employee_id)}"'}
+
+
+class CheckKeyBatch(Resource):
+    """Endpoint used for checking many keys in one request."""
 
-        possibly_valid_key = key_valid_const(args.app_id, args.token, origin)
-        activation = None
-        if args.kunin_employee_id and possibly_valid_key:
-            activation = [a for a in possibly_valid_key.activations if a.kunin_employee_id == args.kunin_employee_id
-                          and a.hwid == args.hwid]
-            activation = activation[0] if activation else None
-        if possibly_valid_key and key_still_valid(possibly_valid_key, activation):
-            expiry = {"expiresOn": str(activation.valid_until)} if activation else {}
-            remaining = str(possibly_valid_key.remaining) if possibly_valid_key.remaining != -1 else 'unlimited'
-            return {**{"remainingActivations": remaining, "kunin_employee_id": args.kunin_employee_id,
-                       "result": "ok", "kunin_client_id": possibly_valid_key.kunin_client_id}, **expiry}, \
-                200 if activation else 201
-
-        if not possibly_valid_key:
-            return {"result": "failure", "error": "invalid key"}, 404
-        else:
-            expiry = activation.valid_until if activation else possibly_valid_key.valid_until
-            return {"result": "failure", "error": f"invalid key; expired {expiry}"}, 404
+    def post(self):
+        """
+        Check a batch of keys
+
+        Each entry of `checks` takes the arguments of /api/check, with
+        `app_id` defaulting to the top level one, or to the one in the token
+        prefix; `receipt` applies to the whole batch. The results are returned
+        in order, each with the status /api/check would answer.
+        """
+        parser = reqparse.RequestParser()
+        parser.add_argument("checks", required=True, type=list, location='json')
+        parser.add_argument("app_id", type=int, location='json')
+        parser.add_argument("receipt", type=inputs.boolean, default=False, location='json')
+        args = parser.parse_args()
+
+        limit = current_app.config.get("CHECK_BATCH_LIMIT", 1000)
+        if len(args.checks) > limit:
+            return {"result": "failure", "error": f"at most {limit} checks per batch"}, 400
+
+        results = [None] * len(args.checks)
+        checks, positions = [], []
+        for i, item in enumerate(args.checks):
+            try:
+                app_id = item.get("app_id", args.app_id)
+                app_id = int(app_id) if app_id is not None else None
+                kunin_employee_id = item.get("kunin_employee_id")
+                kunin_employee_id = (int(kunin_employee_id) if kunin_employee_id is not None
+                                     else None)
+                origin = Origin(request.remote_addr, str(item["machine"]), str(item["user"]),
+                                str(item["hwid"]))
+                token = token_filter.parse(str(item["token"]))
+            except (AttributeError, KeyError, TypeError, ValueError) as error:
+                results[i] = {"result": "failure", "error": f"bad check: {error}", "status": 400}
+                continue
+            app_id = token and _app_id(app_id, token)
+            if token and app_id is None:
+                body, status = _APP_ID_REQUIRED
+                results[i] = {**body, "status": status}
+                continue
+            if not token or not app_id:
+                body, status = _check_response(None, origin.hwid, kunin_employee_id, args.receipt)
+                results[i] = {**body, "status": status}
+                continue
+            checks.append((app_id, token, origin, kunin_employee_id))
+            positions.append(i)
+
+        for i, check, verdict in zip(positions, checks, check_keys_bulk(checks)):
+            body, status = _check_response(verdict, check[2].hwid, check[3], args.receipt)
+            results[i] = {**body, "status": status}
+        return {"result": "ok", "results": results}, 200
 
 
 class GetAppId(Resource):
@@ -152,7 +264,11 @@ class GetAppId(Resource):
 
         args = parser.parse_args()
 
-        key = Key.query.filter_by(token=args.token).first()
+        token = token_filter.parse(args.token)
+        if token and app_id_of(token):
+            # the check character vouches for the prefix; whether the key exists is for /api/check
+            return {"result": "ok", "app_id": app_id_of(token)}, 200
+        key = token and Key.query.filter_by(token=token).first()
         if key:
             return {"result": "ok", "app_id": key.app_id}, 200
         else:
@@ -181,21 +297,15 @@ class ClaimKey(Resource):
             formatted = '-'.join([token[i:i+5] for i in range(0, len(token), 5)])
             return {"result": "ok", "token": formatted, "already_claimed": True}, 200
 
-        # find an unclaimed key with remaining activations
-        key = Key.query.filter_by(app_id=args.app_id, claimed_by=None, enabled=True) \
-            .filter(Key.remaining != 0).first()
+        if args.name:
+            memo = f"early-tester: {args.name} <{args.email}>"
+        else:
+            memo = f"early-tester: {args.email}"
+        key = claim_key(args.app_id, args.email, memo)
 
         if not key:
             return {"result": "failure", "error": "no keys available"}, 410
 
-        key.claimed_by = args.email
-        key.claimed_at = datetime.utcnow()
-        if args.name:
-            key.memo = f"early-tester: {args.name} <{args.email}>"
-        else:
-            key.memo = f"early-tester: {args.email}"
-        db.session.commit()
-
         token = key.token
         formatted = '-'.join([token[i:i+5] for i in range(0, len(token), 5)])
         return {"result": "ok", "token": formatted, "already_claimed": False}, 201
@@ -252,9 +362,18 @@ class EarlyBirdSpots(Resource):
         return {"total": 20, "claimed": claimed}, 200, _cors_headers()
 
 
+class ReceiptKeys(Resource):
+    """Public endpoint listing the public keys receipts are verified with."""
+
+    def get(self):
+        return {"keys": receipt_public_keys()}
+
+
 api.add_resource(ActivateKey, "/api/activate")
 api.add_resource(CheckKey, "/api/check")
+api.add_resource(CheckKeyBatch, "/api/check/batch")
 api.add_resource(GetAppId, "/api/appid")
 api.add_resource(ClaimKey, "/api/claim")
 api.add_resource(ApplyEarlyBird, "/api/apply")
-api.add_resource(EarlyBirdSpots, "/api/spots")
\ No newline at end of file
+api.add_resource(EarlyBirdSpots, "/api/spots")
+api.add_resource(ReceiptKeys, "/api/receipt-keys")
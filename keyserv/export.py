@@ -0,0 +1,166 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import csv
+import io
+import json
+from datetime import date, datetime, time, timedelta
+
+from sqlalchemy import Date, case, or_
+
+from keyserv.models import Activation, Application, AuditLog, AuditRollup, Event, Key, db
+
+
+def filter_keys(query, enabled: bool = None, claimed: bool = None, expired: bool = None):
+    """`query` narrowed to keys that are enabled, claimed or expired or not;
+    a filter left at None is not applied."""
+    if enabled is not None:
+        query = query.filter(Key.enabled == enabled)
+    if claimed is not None:
+        query = query.filter(Key.claimed_by.isnot(None) if claimed else Key.claimed_by.is_(None))
+    if expired is not None:
+        now = datetime.utcnow()
+        query = query.filter(Key.valid_until <= now if expired
+                             else or_(Key.valid_until.is_(None), Key.valid_until > now))
+    return query
+
+
+def _keys():
+    query = db.session.query(Key.id, Key.token, Key.app_id, Application.name.label("app_name"),
+                             Key.enabled, Key.remaining, Key.total_activations, Key.total_checks,
+                             Key.cutdate, Key.valid_until, Key.memo, Key.kunin_client_id,
+                             Key.claimed_by, Key.claimed_at) \
+        .join(Application, Application.id == Key.app_id)
+    return query, Key.app_id, Key.cutdate, None, (Key.id,)
+
+
+def _activations():
+    query = db.session.query(Activation.id, Activation.key_id, Key.token, Key.app_id,
+                             Application.name.label("app_name"), Activation.hwid,
+                             Activation.activation_ts, Activation.activation_ip,
+                             Activation.kunin_client_id, Activation.kunin_employee_id,
+                             Activation.valid_until) \
+        .join(Key, Key.id == Activation.key_id) \
+        .join(Application, Application.id == Key.app_id)
+    return query, Key.app_id, Activation.activation_ts, None, (Activation.id,)
+
+
+def _event_name(column):
+    return case({int(event): event.name for event in Event}, value=column).label("event")
+
+
+def _logs():
+    query = db.session.query(AuditLog.id, AuditLog.timestamp, AuditLog.event_type,
+                             _event_name(AuditLog.event_type), AuditLog.key_id, Key.token,
+                             AuditLog.app_id, Application.name.label("app_name"),
+                             AuditLog.message) \
+        .join(Key, Key.id == AuditLog.key_id) \
+        .join(Application, Application.id == AuditLog.app_id)
+    # in the order of ix_audit_log_timestamp_id and the per-filter indexes after it
+    return query, AuditLog.app_id, AuditLog.timestamp, AuditLog.event_type, \
+        (AuditLog.timestamp, AuditLog.id)
+
+
+def _rollups():
+    query = db.session.query(AuditRollup.day, AuditRollup.event_type,
+                             _event_name(AuditRollup.event_type), AuditRollup.key_id, Key.token,
+                             AuditRollup.app_id, Application.name.label("app_name"),
+                             AuditRollup.count) \
+        .join(Key, Key.id == AuditRollup.key_id) \
+        .join(Application, Application.id == AuditRollup.app_id)
+    return query, AuditRollup.app_id, AuditRollup.day, AuditRollup.event_type, \
+        (AuditRollup.day, AuditRollup.key_id, AuditRollup.event_type)
+
+
+# what `flask export` and /export can write; each returns its query, the columns the app, date
+# range and event filters apply to (None when it has no event) and its order
+EXPORTS = {"keys": _keys, "activations": _activations, "logs": _logs, "rollups": _rollups}
+FORMATS = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+# cells a spreadsheet would read as a formula; they are written after a quote in CSV
+FORMULA_STARTS = ("=", "+", "-", "@", "\t", "\r")
+
+
+def export_query(kind: str, app_id: int = None, since: datetime = None, until: datetime = None,
+                 event_type: int = None, **key_filters):
+    """The column query behind export `kind`, filtered and in a stable order.
+
+    `since` is inclusive and `until` exclusive. Only logs and rollups filter
+    on `event_type` and only keys take the `filter_keys` filters; asking for
+    either elsewhere raises ValueError, as does an unknown `kind`.
+    """
+    if kind not in EXPORTS:
+        raise ValueError(f"no export named {kind!r}")
+    query, app_column, date_column, event_column, order = EXPORTS[kind]()
+    if kind == "keys":
+        query = filter_keys(query, **key_filters)
+    elif any(value is not None for value in key_filters.values()):
+        raise ValueError(f"{kind} cannot be filtered like keys")
+    if app_id is not None:
+        query = query.filter(app_column == app_id)
+    if isinstance(date_column.type, Date):
+        # rollups are per day; a range covers the days it starts and ends in, so an `until` past
+        # midnight takes the whole of its day
+        if since:
+            since = since.date()
+        if until:
+            until = until.date() + timedelta(days=1) if until.time() != time() else until.date()
+    if since:
+        query = query.filter(date_column >= since)
+    if until:
+        query = query.filter(date_column < until)
+    if event_type is not None:
+        if event_column is None:
+            raise ValueError(f"{kind} cannot be filtered by event type")
+        query = query.filter(event_column == int(event_type))
+    return query.order_by(*order)
+
+
+def stream(query, output_format: str = "csv", batch_size: int = 1000):
+    """Yield the rows of `query` as CSV or NDJSON text, a batch of rows per chunk.
+
+    Rows are fetched `batch_size` at a time through `yield_per`, which reads
+    from a server-side cursor on PostgreSQL, and only the batch being written
+    is held, so memory stays flat however many rows the export has. Text
+    cells starting with one of `FORMULA_STARTS` get a leading `'` in CSV so
+    spreadsheets do not evaluate them; NDJSON is written as stored.
+    """
+    columns = [column["name"] for column in query.column_descriptions]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if output_format == "csv":
+        writer.writerow(columns)
+
+    for count, row in enumerate(query.yield_per(batch_size), 1):
+        values = [value.isoformat() if isinstance(value, (date, datetime)) else value
+                  for value in row]
+        if output_format == "csv":
+            writer.writerow([f"'{value}" if isinstance(value, str) and
+                             value.startswith(FORMULA_STARTS) else value for value in values])
+        else:
+            buffer.write(json.dumps(dict(zip(columns, values))) + "\n")
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
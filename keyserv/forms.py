@@ -22,7 +22,9 @@
 from flask_wtf import FlaskForm
 from wtforms import (BooleanField, IntegerField, PasswordField, SelectField,
                      StringField, SubmitField, DateField)
-from wtforms.validators import required, optional, DataRequired
+from wtforms.validators import required, optional, DataRequired, NumberRange, ValidationError
+
+from keyserv.tokens import DEFAULT_LENGTH, TokenGenerator
 
 
 class LoginForm(FlaskForm):
@@ -46,7 +48,20 @@ class KeyForm(FlaskForm):
     submit = SubmitField("Submit")
 
 
+def token_alphabet(form, field):
+    if field.data:
+        try:
+            TokenGenerator(form.token_length.data or DEFAULT_LENGTH, field.data)
+        except ValueError as error:
+            raise ValidationError(str(error))
+
+
 class AppForm(FlaskForm):
     name = StringField("Application Name")
     support = StringField("Support Message")
+    token_length = IntegerField("Token Length (default 30)",
+                                validators=[optional(), NumberRange(min=20, max=255)])
+    token_alphabet = StringField("Token Alphabet (default A-Z0-9)",
+                                 validators=[optional(), token_alphabet])
+    token_app_prefix = BooleanField("Start tokens with the application id (default format only)")
     submit = SubmitField("Submit")
@@ -0,0 +1,179 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import os
+import threading
+from collections import defaultdict
+
+from sqlalchemy import event, func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import Pool
+
+from keyserv.uuidgenerator import UUIDGenerator
+
+
+class IdBlocks:
+    """Hands out primary keys from blocks reserved in the `id_block` table.
+
+    Ids are known before a row is inserted, so its id-derived uuid goes into
+    the same INSERT and rows of one table flush as a single executemany. Each
+    process reserves `ID_BLOCK_SIZE` ids of a table at a time with one UPDATE
+    of `id_block.next_id`, seeded from the largest id already in the table.
+    Ids of blocks a process does not use up are skipped.
+
+    A block is reserved in a transaction of its own. SQLite allows a single
+    writer, which may be the flush asking for the ids, so there the block is
+    reserved on the flush connection and only used by that connection until
+    its transaction commits; a rollback gives the block back.
+    """
+
+    def __init__(self, size: int = 100):
+        self._lock = threading.Lock()
+        self.size = size
+        self._reset()
+
+    def init_app(self, app):
+        with self._lock:
+            self.size = app.config.get("ID_BLOCK_SIZE", 100)
+            self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        # table name -> [[next id, end], ...]
+        self._blocks = defaultdict(list)
+        # DBAPI connection -> blocks reserved in its open transaction
+        self._pending = {}
+        self.reserved = self.allocated = 0
+
+    def allocate(self, connection, table, count: int = 1) -> list:
+        """`count` unused ids of `table`, for inserts through `connection`."""
+        ids = []
+        while True:
+            with self._lock:
+                if self._pid != os.getpid():  # blocks are not shared with a forked parent
+                    self._reset()
+                pending = self._pending.get(_dbapi_connection(connection), {})
+                for blocks in (pending.get(table.name, []), self._blocks[table.name]):
+                    ids.extend(_take(blocks, count - len(ids)))
+                if len(ids) == count:
+                    self.allocated += count
+                    return ids
+            self._reserve(connection, table, max(self.size, count - len(ids)))
+
+    def assign(self, connection, table, rows: list) -> list:
+        """Set `id` and `uuid` on the row dicts of a Core insert into `table`."""
+        ids = self.allocate(connection, table, len(rows))
+        for row, row_id, row_uuid in zip(rows, ids, UUIDGenerator.int_to_uuids(ids)):
+            row["id"] = row_id
+            row["uuid"] = row_uuid.hex
+        return rows
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": self.size, "reserved": self.reserved, "allocated": self.allocated}
+
+    def _reserve(self, connection, table, size: int):
+        if connection.dialect.name == "sqlite":
+            end = self._bump(connection, table, size)
+            with self._lock:
+                pending = self._pending.setdefault(_dbapi_connection(connection), defaultdict(list))
+                pending[table.name].append([end - size, end])
+                self.reserved += 1
+        else:
+            with connection.engine.begin() as own:
+                end = self._bump(own, table, size)
+            with self._lock:
+                self._blocks[table.name].append([end - size, end])
+                self.reserved += 1
+
+    def _bump(self, connection, table, size: int) -> int:
+        from keyserv.models import IdBlock
+
+        blocks = IdBlock.__table__
+        bump = blocks.update().where(blocks.c.name == table.name) \
+            .values(next_id=blocks.c.next_id + size)
+        if not connection.execute(bump).rowcount:
+            self._seed(connection, table)
+            connection.execute(bump)
+        return connection.execute(select([blocks.c.next_id])
+                                  .where(blocks.c.name == table.name)).scalar()
+
+    def _seed(self, connection, table):
+        from keyserv.models import IdBlock
+
+        first = connection.execute(select([func.coalesce(func.max(table.c.id), 0) + 1])).scalar()
+        insert = IdBlock.__table__.insert().values(name=table.name, next_id=first)
+        if connection.dialect.name == "sqlite":
+            connection.execute(insert.prefix_with("OR IGNORE"))
+            return
+        try:
+            with connection.begin_nested():
+                connection.execute(insert)
+        except IntegrityError:
+            pass  # another process seeded it first
+
+    def _settle(self, dbapi_connection, committed: bool):
+        with self._lock:
+            pending = self._pending.pop(dbapi_connection, None)
+            if committed and pending:
+                for name, blocks in pending.items():
+                    self._blocks[name].extend(block for block in blocks if block[0] < block[1])
+
+
+def _take(blocks: list, count: int) -> list:
+    ids = []
+    while blocks and len(ids) < count:
+        block = blocks[0]
+        taken = min(block[1] - block[0], count - len(ids))
+        ids.extend(range(block[0], block[0] + taken))
+        block[0] += taken
+        if block[0] == block[1]:
+            blocks.pop(0)
+    return ids
+
+
+def _dbapi_connection(connection):
+    return connection.connection.connection
+
+
+id_blocks = IdBlocks()
+
+
+@event.listens_for(Engine, "commit")
+def _on_commit(connection):
+    if id_blocks._pending:
+        id_blocks._settle(_dbapi_connection(connection), True)
+
+
+@event.listens_for(Engine, "rollback")
+def _on_rollback(connection):
+    if id_blocks._pending:
+        id_blocks._settle(_dbapi_connection(connection), False)
+
+
+@event.listens_for(Pool, "reset")
+def _on_reset(dbapi_connection, _):
+    # a connection returned to the pool mid-transaction is rolled back without a "rollback" event
+    if id_blocks._pending:
+        id_blocks._settle(dbapi_connection, False)
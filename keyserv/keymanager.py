@@ -20,16 +20,48 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-import secrets
-import string
-from datetime import datetime
+import base64
+import calendar
+import itertools
+import json
+import threading
+from datetime import datetime, timedelta
+from functools import lru_cache
 from hmac import compare_digest
+from typing import NamedTuple
 
+import argon2
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+from cryptography.hazmat.primitives.serialization import (Encoding, NoEncryption, PrivateFormat,
+                                                          PublicFormat)
 from flask import current_app, request
 from flask_login import current_user
-from sqlalchemy import exists
+from sqlalchemy import and_, bindparam, case, exists, func, or_, select
+from sqlalchemy.exc import IntegrityError
 
-from keyserv.models import AuditLog, Event, Key, Activation, db
+from keyserv.idblocks import id_blocks
+
+from keyserv.kunin import KuninUnavailable, kunin_client
+from keyserv.models import (Application, AuditLog, Event, Key, Activation, KuninEmployee,
+                            ProvisioningJob, ProvisioningStatus, db, open_password, seal_password,
+                            token_digest)
+from keyserv.provisioning import provisioning
+from keyserv.tokens import (DEFAULT_ALPHABET, DEFAULT_LENGTH, TokenGenerator, generator_for,
+                            token_generator)
+from keyserv.verdictcache import Verdict, verdict_cache
+from keyserv.writebehind import check_counters
+
+
+# keeps IN (...) lists under SQLite's limit of 999 bound parameters
+BULK_CHUNK_SIZE = 500
+
+# draws in a row that may turn up only existing tokens before giving up; with the entropy every
+# generator has, running into this means the randomness is broken rather than the tokens used up
+MAX_TOKEN_DRAWS = 10
+
+# hashes the passwords of cached Kunin users; cheap enough to verify on activation
+_password_hasher = argon2.PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
 
 
 class ExhaustedActivations(Exception):
@@ -43,6 +75,30 @@ class KeyNotFound(Exception):
     pass
 
 
+class KeyExpired(Exception):
+    """Raised when an activation attempt is made on a key that is no longer
+    valid."""
+    pass
+
+
+class KuninRegistrationFailed(Exception):
+    """Raised when the Kunin API refuses to register or log in the user an
+    activation is made for."""
+    pass
+
+
+class TokenSpaceExhausted(Exception):
+    """Raised when `MAX_TOKEN_DRAWS` draws in a row turn up no token that is
+    not taken already."""
+    pass
+
+
+class InvalidReceipt(Exception):
+    """Raised when a license receipt is malformed, forged, signed with an
+    unknown key or expired."""
+    pass
+
+
 class Origin:
     """Origin that identifies a key action."""
 
@@ -60,17 +116,17 @@ class Origin:
         return f"<Origin({self.ip}, {self.machine}, {self.user})>"
 
 
-def rand_token(length: int = 25,
-               chars: str = string.ascii_uppercase + string.digits) -> str:
+def rand_token(length: int = DEFAULT_LENGTH, chars: str = DEFAULT_ALPHABET) -> str:
     """
     Generate a random token. Does not check for duplicates yet.
 
-    A length of 25 should give us 8.082812775E38 keys.
+    The default 29 random characters and a check character give us about
+    1.4E45 keys.
 
     length: - length of token to generate
     chars: - characters used in seeding of token
     """
-    return "".join(secrets.choice(chars) for i in range(length))
+    return token_generator(length, chars).token()
 
 
 def token_exists_unsafe(token: str) -> bool:
@@ -81,22 +137,37 @@ def token_exists_unsafe(token: str) -> bool:
 
 def token_matches_hwid(token: str, hwid: str) -> bool:
     """Check if the supplied hwid matches the hwid on a key's activations"""
-    k = Key.query(token=token)
+    key = Key.query.filter_by(token_digest=token_digest(token)).first()
+    if not key or not compare_digest(token.encode(), key.token.encode()):
+        return False
+    return db.session.query(exists().where(and_(Activation.key_id == key.id,
+                                                Activation.hwid == hwid))).scalar()
+
+
+def find_activation(key_id: int, kunin_employee_id: int, hwid: str) -> Activation:
+    """The activation of key `key_id` by `kunin_employee_id` on `hwid` that
+    stays valid the longest, or None.
 
-    return any([bool(_compare(hwid, a.hwid)) for a in k.activations])
+    Served by the (key_id, kunin_employee_id, hwid) index, so only matching
+    activations are read no matter how many the key has."""
+    return Activation.query \
+        .filter_by(key_id=key_id, kunin_employee_id=kunin_employee_id, hwid=hwid) \
+        .order_by(Activation.valid_until.desc()).first()
 
 
-def generate_token_unsafe() -> str:
+def generate_token_unsafe(application: Application = None) -> str:
     """
-    Generate a new token.
+    Generate a new token, in the format set for `application`.
 
     Does not perform constant time comparison when checking if the generated
     token is a duplicate.
     """
-    key = rand_token()
-    while token_exists_unsafe(key):
-        key = rand_token()
-    return key
+    generator = generator_for(application)
+    for _ in range(MAX_TOKEN_DRAWS):
+        key = generator.token()
+        if not token_exists_unsafe(key):
+            return key
+    raise TokenSpaceExhausted(f"no fresh token in {MAX_TOKEN_DRAWS} draws")
 
 
 def cut_key_unsafe(activations: int, app_id: int, kunin_client_id: int = 0,
@@ -107,7 +178,7 @@ def cut_key_unsafe(activations: int, app_id: int, kunin_client_id: int = 0,
     Cuts a new key with # `activations` allowed activations. -1 is considered
     unlimited activations.
     """
-    token = generate_token_unsafe()
+    token = generate_token_unsafe(Application.query.get(app_id))
     key = Key(token, activations, app_id, active, memo, kunin_client_id=kunin_client_id)
     key.cutdate = datetime.utcnow()
 
@@ -124,6 +195,118 @@ def cut_key_unsafe(activations: int, app_id: int, kunin_client_id: int = 0,
     return token
 
 
+def cut_keys(app_id: int, count: int, activations: int, ttl: int = 30, kunin_client_id: int = 0,
+             memo: str = "", cut_by: str = "", chunk_size: int = BULK_CHUNK_SIZE):
+    """
+    Cuts `count` keys for `app_id` and yields `(key_id, token, valid_until)`
+    for each, a chunk at a time as the chunks commit.
+
+    Each chunk of tokens is deduplicated in memory and against the existing
+    token digests, then inserted with its KeyCreated audit rows in one
+    executemany per table. A chunk losing a token to a concurrent writer is
+    retried with new tokens.
+    """
+    keys, logs = Key.__table__, AuditLog.__table__
+    generator = generator_for(Application.query.get(app_id))
+    message = f"new key cut by {cut_by}" if cut_by else "new key cut in bulk"
+    seen = set()
+    cut = 0
+    while cut < count:
+        size = min(chunk_size, count - cut)
+        for attempt in itertools.count(1):
+            now = datetime.utcnow()
+            rows = [{"token": token, "token_digest": digest, "app_id": app_id,
+                     "remaining": activations, "enabled": True, "memo": memo,
+                     "kunin_client_id": kunin_client_id or None, "cutdate": now,
+                     "valid_until": now + timedelta(days=ttl), "ttl": ttl}
+                    for digest, token in _new_tokens(generator, size, seen).items()]
+            try:
+                connection = db.session.connection()
+                db.session.execute(keys.insert(), id_blocks.assign(connection, keys, rows))
+                db.session.execute(logs.insert(), id_blocks.assign(connection, logs, [
+                    {"key_id": row["id"], "app_id": app_id, "message": message,
+                     "event_type": int(Event.KeyCreated), "timestamp": datetime.now()}
+                    for row in rows]))
+                db.session.commit()
+                break
+            except IntegrityError:
+                db.session.rollback()
+                if attempt == 3:
+                    raise
+        cut += size
+        current_app.logger.info(f"cut {cut}/{count} key(s) for app {app_id} "
+                                f"with {activations} activation(s)")
+        for row in rows:
+            yield row["id"], row["token"], row["valid_until"]
+
+
+def _new_tokens(generator: TokenGenerator, count: int, seen: set) -> dict:
+    """`count` new tokens by digest, none of them in `seen` or the key table.
+
+    Raises `TokenSpaceExhausted` after `MAX_TOKEN_DRAWS` draws in a row
+    without a fresh token."""
+    tokens = {}
+    stale = 0
+    while len(tokens) < count:
+        if stale == MAX_TOKEN_DRAWS:
+            raise TokenSpaceExhausted(f"no fresh token in {MAX_TOKEN_DRAWS} draws")
+        batch = {token_digest(token): token for token in generator.tokens(count - len(tokens))
+                 if token not in seen}
+        taken = {digest for digest, in
+                 db.session.query(Key.token_digest).filter(Key.token_digest.in_(batch))} \
+            if batch else set()
+        seen.update(batch.values())
+        fresh = {digest: token for digest, token in batch.items() if digest not in taken}
+        tokens.update(fresh)
+        stale = 0 if fresh else stale + 1
+    return tokens
+
+
+_claim_lock = threading.Lock()
+
+
+def claim_key(app_id: int, claimed_by: str, memo: str, commit: bool = True) -> Key:
+    """Claim an unclaimed, enabled key of `app_id` with activations left for
+    `claimed_by`, or return None when the pool is empty.
+
+    The key is picked and claimed by a single UPDATE, so concurrent claims
+    never receive the same key. On PostgreSQL the pick skips rows locked by
+    other claims (`FOR UPDATE SKIP LOCKED`) instead of queueing behind them;
+    elsewhere claims take turns and the claimed key is read back inside the
+    same transaction. With `commit` False the claim is left
+    in the session for the caller to commit."""
+    table = Key.__table__
+    claimed_at = datetime.utcnow()
+    candidate = select([table.c.id]) \
+        .where(and_(table.c.app_id == app_id, table.c.claimed_by.is_(None),
+                    table.c.enabled.is_(True), table.c.remaining != 0)) \
+        .order_by(table.c.id).limit(1)
+    postgres = db.session.get_bind().dialect.name == "postgresql"
+    if postgres:
+        candidate = candidate.with_for_update(skip_locked=True)
+    claim = table.update() \
+        .where(and_(table.c.id == candidate.as_scalar(), table.c.claimed_by.is_(None))) \
+        .values(claimed_by=claimed_by, claimed_at=claimed_at, memo=memo)
+
+    if postgres:
+        key_id = db.session.execute(claim.returning(table.c.id)).scalar()
+        if commit:
+            db.session.commit()
+    else:
+        # SQLite fails rather than waits when two writers upgrade their locks at
+        # once, so claims from this process take turns
+        with _claim_lock:
+            key_id = None
+            if db.session.execute(claim).rowcount:
+                key_id = db.session.execute(
+                    select([table.c.id]).where(and_(table.c.app_id == app_id,
+                                                    table.c.claimed_by == claimed_by,
+                                                    table.c.claimed_at == claimed_at))).scalar()
+            if commit:
+                db.session.commit()
+    return Key.query.get(key_id) if key_id else None
+
+
 def disable_key_unsafe(token: str):
     """Disable a key by its token."""
     key = Key.query.filter(Key.token == token).first()
@@ -135,6 +318,7 @@ def disable_key_unsafe(token: str):
     current_app.logger.info(f"disabled key {key}")
     AuditLog.from_key(key, "key was disabled", Event.KeyModified)
     db.session.commit()
+    verdict_cache.invalidate(key.id)
 
 
 def _compare(left: str, right: str) -> int:
@@ -146,37 +330,211 @@ def _compare(left: str, right: str) -> int:
     return res % 1
 
 
+def find_key_const(app_id: int, token: str) -> Key:
+    """Find the enabled key of `app_id` whose token is `token`.
+
+    The key is located through the indexed keyed digest of the token, so the
+    lookup is a single query whose timing reveals nothing about how close a
+    guessed token was. The stored token is still compared in constant time."""
+    key = Key.query.filter_by(token_digest=token_digest(token)).first()
+    if (key and compare_digest(token.encode(), key.token.encode()) and
+            key.enabled and key.app_id == app_id):
+        return key
+    return None
+
+
+def _record_check(key: Key, origin: Origin, commit: bool = True):
+    if check_counters.enabled:
+        check_counters.record(key.id, origin.ip)
+    else:
+        key.last_check_ts = datetime.utcnow()
+        key.last_check_ip = origin.ip
+        key.total_checks += 1
+    AuditLog.from_key(key, f"key check from {origin}", Event.KeyAccess, commit=commit, ip=origin.ip)
+
+
 def key_exists_const(app_id: int, token: str, origin: Origin) -> bool:
-    """Constant time check to see if `token` exists in the database. Compares
-    against all keys even if a match is found."""
+    """Constant time check to see if `token` exists in the database."""
     current_app.logger.info(f"key lookup by token {token}")
-    found = False
-    for key in Key.query.all():
-        if (compare_digest(token, key.token) and
-                key.enabled and key.app_id == app_id):
-
-            found = True
-            key.last_check_ts = datetime.utcnow()
-            key.last_check_ip = origin.ip
-            key.total_checks += 1
-            AuditLog.from_key(key, f"key check from {origin}", Event.KeyAccess)
-    return found
+    key = find_key_const(app_id, token)
+    if key:
+        _record_check(key, origin)
+    return key is not None
 
 
 def key_valid_const(app_id: int, token: str, origin: Origin) -> any:
-    """Constant time check to see if `token` exists in the database. Compares
-    against all keys even if a match is found. Validates against the app id
-    and the hardware id provided."""
+    """Constant time check to see if `token` exists in the database.
+    Validates against the app id and returns the key, or False."""
     current_app.logger.info(f"key lookup by token {token} from {origin}")
-    found = False
-    for key in Key.query.all():
-        if compare_digest(token, key.token) and key.enabled and key.app_id == app_id:
-            found = key
-            key.last_check_ts = datetime.utcnow()
-            key.last_check_ip = origin.ip
-            key.total_checks += 1
-            AuditLog.from_key(key, f"key check from {origin}", Event.KeyAccess)
-    return found
+    key = find_key_const(app_id, token)
+    if key:
+        _record_check(key, origin)
+        return key
+    return False
+
+
+def backfill_token_digests(batch_size: int = 1000, recompute: bool = False) -> int:
+    """Fill in `Key.token_digest` for keys that predate it, in batches.
+
+    With `recompute` every digest is rewritten, which is needed after
+    changing `TOKEN_DIGEST_KEY`. Returns the number of keys updated."""
+    statement = Key.__table__.update() \
+        .where(Key.id == bindparam("key_id")) \
+        .values(token_digest=bindparam("digest"))
+    updated = 0
+    last_id = 0
+    while True:
+        query = db.session.query(Key.id, Key.token).filter(Key.id > last_id)
+        if not recompute:
+            query = query.filter(Key.token_digest.is_(None))
+        rows = query.order_by(Key.id).limit(batch_size).all()
+        if not rows:
+            break
+        db.session.execute(statement, [{"key_id": key_id, "digest": token_digest(token)}
+                                       for key_id, token in rows])
+        db.session.commit()
+        updated += len(rows)
+        last_id = rows[-1].id
+    return updated
+
+
+def check_key(app_id: int, token: str, origin: Origin, kunin_employee_id: int = None) -> Verdict:
+    """Check `token` for the activation of `kunin_employee_id` on `origin.hwid`.
+
+    Verdicts are served from `verdict_cache` when possible; on a miss the key
+    is checked with `key_valid_const`. Returns None for an unknown key."""
+    cache_key = (app_id, token, origin.hwid, kunin_employee_id)
+    verdict = verdict_cache.get(cache_key)
+    if verdict:
+        if check_counters.enabled:
+            check_counters.record(verdict.key_id, origin.ip)
+        return verdict
+
+    key = key_valid_const(app_id, token, origin)
+    if not key:
+        return None
+    activation = (find_activation(key.id, kunin_employee_id, origin.hwid) if kunin_employee_id
+                  else None)
+
+    verdict = Verdict(key.id, key.remaining, key.kunin_client_id, key.valid_until,
+                      activation is not None, activation.valid_until if activation else None,
+                      key.version)
+    verdict_cache.put(cache_key, verdict)
+    return verdict
+
+
+def check_etag(verdict: Verdict, hwid: str, kunin_employee_id: int) -> str:
+    """Entity tag of a successful check of `verdict` from `hwid`.
+
+    The tag is `<version>.<activation expiry>.<signature>`, the signature
+    being a truncated `token_digest` of the tag and the check arguments, so
+    `check_not_modified` can trust the expiry it carries."""
+    return _check_etag(verdict.key_id, verdict.version, _timestamp(verdict.activation_valid_until),
+                       hwid, kunin_employee_id)
+
+
+def _check_etag(key_id: int, version: int, until: int, hwid: str, kunin_employee_id: int) -> str:
+    signature = token_digest(f"{key_id}.{version}.{until}.{hwid}.{kunin_employee_id or 0}")
+    return f"{version}.{until}.{signature[:16]}"
+
+
+def _timestamp(value: datetime) -> int:
+    return calendar.timegm(value.utctimetuple()) if value else 0
+
+
+def check_not_modified(app_id: int, token: str, origin: Origin, kunin_employee_id: int,
+                       etag: str) -> bool:
+    """Whether a check answered with `etag` would still be answered the same.
+
+    The current key version comes from `verdict_cache` or a single indexed
+    query of the key row; activations are not loaded. A matching check is
+    counted like a cached one."""
+    try:
+        version, until, _ = etag.split(".")
+        version, until = int(version), int(until)
+    except ValueError:
+        return False
+    if until and until <= _timestamp(datetime.utcnow()):
+        return False
+
+    verdict = verdict_cache.get((app_id, token, origin.hwid, kunin_employee_id))
+    if verdict:
+        key_id, current = verdict.key_id, verdict.version
+    else:
+        row = db.session.query(Key.id, Key.version, Key.token) \
+            .filter_by(token_digest=token_digest(token), app_id=app_id, enabled=True).first()
+        if row is None or not compare_digest(token.encode(), row.token.encode()):
+            return False
+        key_id, current = row.id, row.version
+    expected = _check_etag(key_id, current, until, origin.hwid, kunin_employee_id)
+    if version != current or not compare_digest(etag.encode(), expected.encode()):
+        return False
+    if check_counters.enabled:
+        check_counters.record(key_id, origin.ip)
+    return True
+
+
+def check_keys_bulk(checks: list) -> list:
+    """`check_key` for many `(app_id, token, origin, kunin_employee_id)`
+    checks at once.
+
+    Verdicts not in `verdict_cache` are resolved with one query for the keys
+    and one for their activations, and the checks are recorded with a single
+    commit. Returns a verdict, or None, for each check in order."""
+    verdicts = [None] * len(checks)
+    misses = []
+    for i, (app_id, token, origin, kunin_employee_id) in enumerate(checks):
+        verdict = verdict_cache.get((app_id, token, origin.hwid, kunin_employee_id))
+        if verdict:
+            if check_counters.enabled:
+                check_counters.record(verdict.key_id, origin.ip)
+            verdicts[i] = verdict
+        else:
+            misses.append(i)
+    if not misses:
+        return verdicts
+
+    digests = {token_digest(checks[i][1]) for i in misses}
+    keys = {}
+    for chunk in _chunks(list(digests), BULK_CHUNK_SIZE):
+        keys.update((key.token_digest, key)
+                    for key in Key.query.filter(Key.token_digest.in_(chunk)))
+
+    found = {}
+    for i in misses:
+        app_id, token, origin, _ = checks[i]
+        key = keys.get(token_digest(token))
+        if (key and compare_digest(token.encode(), key.token.encode()) and
+                key.enabled and key.app_id == app_id):
+            found[i] = key
+
+    wanted = {(found[i].id, checks[i][3], checks[i][2].hwid) for i in found if checks[i][3]}
+    activations = {}
+    if wanted:
+        key_ids, employee_ids, hwids = (list({w[n] for w in wanted}) for n in range(3))
+        query = Activation.query.filter(Activation.key_id.in_(key_ids),
+                                        Activation.kunin_employee_id.in_(employee_ids),
+                                        Activation.hwid.in_(hwids)).order_by(Activation.valid_until)
+        for activation in query:
+            match = (activation.key_id, activation.kunin_employee_id, activation.hwid)
+            if match in wanted:
+                activations[match] = activation
+
+    for i, key in found.items():
+        app_id, token, origin, kunin_employee_id = checks[i]
+        _record_check(key, origin, commit=False)
+        activation = activations.get((key.id, kunin_employee_id, origin.hwid))
+        verdicts[i] = Verdict(key.id, key.remaining, key.kunin_client_id, key.valid_until,
+                              activation is not None,
+                              activation.valid_until if activation else None, key.version)
+        verdict_cache.put((app_id, token, origin.hwid, kunin_employee_id), verdicts[i])
+    db.session.commit()
+    return verdicts
+
+
+def _chunks(items: list, size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
 
 
 def key_still_valid(key: Key, activation: Activation = None) -> bool:
@@ -192,67 +550,379 @@ def key_get_unsafe(app_id: int, token: str, origin) -> Key:
 
     key = Key.query.filter_by(app_id=app_id, token=token, enabled=True).first()
     if key:
-        AuditLog.from_key(key, f"key retrieval from {origin}", Event.KeyAccess)
+        AuditLog.from_key(key, f"key retrieval from {origin}", Event.KeyAccess, ip=origin.ip)
         return key
     return None
 
 
-def key_for_kunin_client_employee(key: Key, kunin_client_id: int, email: str, password: str, origin) -> int:
-    """Check if an attempted License activation is occurring for a new user, not someone we've seen"""
-    import requests, json
+def key_for_kunin_client_employee(key: Key, kunin_client_id: int, email: str, password: str, origin,
+                                  commit: bool = True) -> int:
+    """Check if an attempted License activation is occurring for a new user, not someone we've seen
 
+    Raises `KuninUnavailable` when the Kunin API cannot answer within
+    `KUNIN_DEADLINE` seconds."""
     current_app.logger.info(f"key activation check for user {email} from client {kunin_client_id} at {origin}")
 
-    user_details = {"user": {"email": email, "password": password, "client_id": key.kunin_client_id}}
-    new_kunin_user = requests.post(current_app.config['KUNIN_API'] + '/api/v1/users', data=json.dumps(user_details),
-                                   headers={'Content-Type': 'application/json'})
+    kunin_employee_id = cached_kunin_employee(key.kunin_client_id, email, password)
+    if kunin_employee_id:
+        AuditLog.from_key(key, f"key activated for known {email} of client ID {kunin_client_id} "
+                          f"from {origin}", Event.KeyAccess, commit=commit)
+        return kunin_employee_id
+
+    deadline = kunin_client.start_deadline()
+    new_kunin_user = kunin_client.register(email, password, key.kunin_client_id, deadline)
 
-    current_app.logger.info(f"Kunin API responded to REGISTER request with: {new_kunin_user.json()}")
+    current_app.logger.info(f"Kunin API responded to REGISTER request with "
+                            f"{new_kunin_user.status_code}: {new_kunin_user.text[:200]}")
     if new_kunin_user.status_code in (201, 422):
+        kunin_employee_id = new_kunin_user.json()["user"]["kunin_employee_id"]
+        remember_kunin_employee(key.kunin_client_id, email, password, kunin_employee_id,
+                                commit=commit)
         AuditLog.from_key(key, f"key activated for {email} of client ID {kunin_client_id} from {origin}",
-                          Event.KeyAccess)
-        return new_kunin_user.json()["user"]["kunin_employee_id"]
+                          Event.KeyAccess, commit=commit)
+        return kunin_employee_id
     else:  # check that the user may exist already for this client
-        del user_details['user']['client_id']
-        existing_kunin_user = requests.post(current_app.config['KUNIN_API'] + '/api/v1/users/login',
-                                            data=json.dumps(user_details), headers={'Content-Type': 'application/json'})
+        existing_kunin_user = kunin_client.login(email, password, deadline)
         if existing_kunin_user.status_code == 200:
-            return existing_kunin_user.json()['user']['kunin_employee_id']
+            kunin_employee_id = existing_kunin_user.json()['user']['kunin_employee_id']
+            remember_kunin_employee(key.kunin_client_id, email, password, kunin_employee_id,
+                                    commit=commit)
+            return kunin_employee_id
     return None
 
 
-def activate_key_unsafe(app_id: int, token: str, kunin_employee_id: int, origin: Origin, key: Key = None) -> Activation:
+def _employee_digest(kunin_client_id: int, email: str) -> str:
+    return token_digest(f"{kunin_client_id}:{(email or '').strip().lower()}")
+
+
+def cached_kunin_employee(kunin_client_id: int, email: str, password: str) -> int:
+    """The `kunin_employee_id` Kunin last resolved `email` of
+    `kunin_client_id` to, if that has not expired and `password` is the one
+    Kunin accepted then; otherwise None."""
+    digest = _employee_digest(kunin_client_id, email)
+    entry = KuninEmployee.query.filter(KuninEmployee.email_digest == digest,
+                                       KuninEmployee.expires_at > datetime.utcnow()) \
+        .order_by(KuninEmployee.id.desc()).first()
+    if not entry or not password:
+        return None
+    try:
+        _password_hasher.verify(entry.password_hash, password)
+    except argon2.exceptions.VerificationError:
+        return None
+    return entry.kunin_employee_id
+
+
+def remember_kunin_employee(kunin_client_id: int, email: str, password: str, kunin_employee_id: int,
+                            commit: bool = False):
+    """Cache a Kunin resolution for `KUNIN_EMPLOYEE_TTL` seconds, replacing
+    earlier ones of the same user. The email is only stored as a digest and
+    the password as an argon2 hash."""
+    if not kunin_employee_id or not password:
+        return
+    digest = _employee_digest(kunin_client_id, email)
+    KuninEmployee.query.filter_by(email_digest=digest).delete(synchronize_session=False)
+    ttl = timedelta(seconds=current_app.config.get("KUNIN_EMPLOYEE_TTL", 7 * 86400))
+    KuninEmployee(email_digest=digest, kunin_client_id=kunin_client_id,
+                  kunin_employee_id=kunin_employee_id,
+                  password_hash=_password_hasher.hash(password),
+                  expires_at=datetime.utcnow() + ttl).save(commit=commit)
+
+
+def activate_key_unsafe(app_id: int, token: str, kunin_employee_id: int, origin: Origin,
+                        key: Key = None, commit: bool = True) -> Activation:
     """Mark a key as activated by its token. Does not perform constant time
     comparisons.
 
     `ip`, `machine`, and `user` are of the originating activation attempt.
+    With `commit` False the changes are left in the session for the caller to
+    commit.
     """
     key = Key.query.filter_by(token=token, app_id=app_id, enabled=True).first() if not key else key
-    activation = None
     valid_or_ttl = key.valid_until if not key.ttl else key.ttl
 
     if key.remaining == -1:
         current_app.logger.info(f"new unlimited activation: Key {key!r} from {origin}")
-        AuditLog.from_key(key, f"new unlimited activation from from {origin}", Event.AppActivation)
+        AuditLog.from_key(key, f"new unlimited activation from from {origin}", Event.AppActivation,
+                          commit=False)
 
     if key.remaining == 0:
         current_app.logger.info(f"failed activation attempt: Key {key!r} from {origin}")
-        AuditLog.from_key(key, f"failed activation attempt from {origin}", Event.FailedActivation)
+        AuditLog.from_key(key, f"failed activation attempt from {origin}", Event.FailedActivation,
+                          commit=commit)
         raise ExhaustedActivations(f"token {token} has exhausted all remaining activations")
 
-    if key.remaining:  # if we can activate, we activate
-        activation = Activation(key.id, origin.ip, key.kunin_client_id, kunin_employee_id, valid_or_ttl,
-                                origin.hwid).save()
-    key.remaining -= 1 if key.remaining != -1 else 0
+    # the UPDATE only matches while activations remain, so concurrent activations can
+    # never overdraw the key; its row count decides whether this one got a slot
+    table = Key.__table__
+    claimed = db.session.execute(
+        table.update()
+        .where(and_(table.c.id == key.id, or_(table.c.remaining > 0, table.c.remaining == -1)))
+        .values(remaining=case([(table.c.remaining == -1, -1)], else_=table.c.remaining - 1),
+                total_activations=func.coalesce(table.c.total_activations, 0) + 1,
+                last_activation_ts=datetime.utcnow(),
+                last_activation_ip=origin.ip,
+                version=table.c.version + 1)).rowcount
+    db.session.expire(key, ["remaining", "total_activations", "last_activation_ts",
+                            "last_activation_ip", "version"])
+    if not claimed:
+        current_app.logger.info(f"failed activation attempt: Key {key!r} from {origin}")
+        AuditLog.from_key(key, f"failed activation attempt from {origin}", Event.FailedActivation,
+                          commit=commit)
+        raise ExhaustedActivations(f"token {token} has exhausted all remaining activations")
 
-    current_app.logger.info(f"new activation: Key {key!r} from {origin}. remaining activations: {key.remaining}")
+    activation = Activation(key.id, origin.ip, key.kunin_client_id, kunin_employee_id, valid_or_ttl,
+                            origin.hwid).save(commit=False)
 
-    key.total_activations += 1
-    key.last_activation_ts = datetime.utcnow()
-    key.last_activation_ip = origin.ip
-    key.hwid = origin.hwid
+    current_app.logger.info(f"new activation: Key {key!r} from {origin}. "
+                            f"remaining activations: {key.remaining}")
 
-    AuditLog.from_key(key, f"new activation from {origin}", Event.AppActivation)
+    AuditLog.from_key(key, f"new activation from {origin}", Event.AppActivation, commit=False)
 
-    db.session.commit()
+    if commit:
+        db.session.commit()
+        verdict_cache.invalidate(key.id)
     return activation
+
+
+class ActivationResult(NamedTuple):
+    """What a client is told about a successful activation."""
+    key_id: int
+    remaining: int
+    valid_until: datetime
+    kunin_employee_id: int
+    kunin_client_id: int
+    provisioning: bool = False
+
+
+def activate_key(app_id: int, token: str, origin: Origin, email: str = None,
+                 password: str = None) -> ActivationResult:
+    """Activate the key of `app_id` matching `token` for `origin`.
+
+    The key is resolved once and the check record, Kunin registration,
+    activation, counters and audit entries are written in a single commit.
+    With `KUNIN_ASYNC_PROVISIONING` on, the Kunin registration is left to a
+    `ProvisioningJob` written in that commit instead.
+    Raises `KeyNotFound`, `ExhaustedActivations`, `KeyExpired`,
+    `KuninRegistrationFailed` or `KuninUnavailable`; failed attempts are still
+    audited.
+    """
+    key = find_key_const(app_id, token)
+    if not key:
+        raise KeyNotFound(f"no key found for token {token}")
+    _record_check(key, origin, commit=False)
+
+    try:
+        if key.remaining == 0:
+            AuditLog.from_key(key, f"failed activation attempt from {origin}",
+                              Event.FailedActivation, commit=False)
+            raise ExhaustedActivations(f"token {token} has exhausted all remaining activations")
+        if not key_still_valid(key):
+            raise KeyExpired(f"token {token} is no longer valid")
+
+        # setup the new account using the key's kunin_client_id, kunin_email and kunin_password
+        kunin_employee_id = 0
+        deferred = key.kunin_client_id and current_app.config.get("KUNIN_ASYNC_PROVISIONING")
+        if key.kunin_client_id and not deferred:
+            try:
+                kunin_employee_id = key_for_kunin_client_employee(key, key.kunin_client_id, email,
+                                                                  password, origin, commit=False)
+            except KuninUnavailable as error:
+                AuditLog.from_key(key, f"activation for {email} from {origin} not registered: "
+                                  f"{error}", Event.FailedActivation, commit=False)
+                raise
+            if not kunin_employee_id:
+                AuditLog.from_key(key, f"activation for {email} refused by Kunin from {origin}",
+                                  Event.FailedActivation, commit=False)
+                raise KuninRegistrationFailed(f"{email} is already registered with client "
+                                              f"{key.kunin_client_id}")
+
+        # raises ExhaustedActivations too when a concurrent activation took the last one
+        activation = activate_key_unsafe(app_id, token, kunin_employee_id, origin, key,
+                                         commit=False)
+    except (ExhaustedActivations, KeyExpired, KuninRegistrationFailed, KuninUnavailable):
+        db.session.commit()
+        raise
+
+    if deferred:
+        ProvisioningJob(key_id=key.id, activation=activation, kunin_client_id=key.kunin_client_id,
+                        hwid=origin.hwid, origin=str(origin), email=email,
+                        password=seal_password(password)).save(commit=False)
+    result = ActivationResult(key.id, key.remaining, activation.valid_until, kunin_employee_id,
+                              key.kunin_client_id, bool(deferred))
+    db.session.commit()
+    verdict_cache.invalidate(result.key_id)
+    if deferred:
+        provisioning.wake()
+    return result
+
+
+def claim_provisioning_jobs(limit: int) -> list:
+    """Claim up to `limit` due provisioning jobs and return their ids.
+
+    Pending jobs are due once `next_attempt_at` has passed; running jobs are
+    taken over when their claim is older than `PROVISIONING_LEASE` seconds,
+    which covers workers that died mid-job."""
+    table = ProvisioningJob.__table__
+    now = datetime.utcnow()
+    stale = now - timedelta(seconds=current_app.config.get("PROVISIONING_LEASE", 60))
+    due = or_(and_(table.c.status == int(ProvisioningStatus.Pending),
+                   table.c.next_attempt_at <= now),
+              and_(table.c.status == int(ProvisioningStatus.Running), table.c.updated_at < stale))
+
+    claimed = []
+    rows = db.session.execute(select([table.c.id]).where(due).order_by(table.c.id).limit(limit))
+    for row in rows.fetchall():
+        if db.session.execute(table.update().where(and_(table.c.id == row.id, due)).values(
+                status=int(ProvisioningStatus.Running), attempts=table.c.attempts + 1,
+                updated_at=now)).rowcount:
+            claimed.append(row.id)
+    db.session.commit()
+    return claimed
+
+
+def run_provisioning_job(job_id: int):
+    """Register the user of a claimed provisioning job with the Kunin API.
+
+    On success the activation gets its `kunin_employee_id`. A refused
+    registration, or one still failing after `PROVISIONING_MAX_ATTEMPTS`
+    tries, expires the activation and gives its slot back to the key;
+    otherwise the job is retried with exponential backoff, whatever the
+    error was. The password is stored encrypted and dropped once the job is
+    settled either way, and the key version is bumped so that clients
+    holding a check ETag see the outcome."""
+    job = ProvisioningJob.query.get(job_id)
+    key = job.key
+    try:
+        kunin_employee_id = key_for_kunin_client_employee(key, job.kunin_client_id, job.email,
+                                                          open_password(job.password), job.origin,
+                                                          commit=False)
+    except Exception as error:
+        db.session.rollback()
+        if not isinstance(error, KuninUnavailable):
+            current_app.logger.exception(f"provisioning job {job_id} failed")
+        job.last_error = f"{type(error).__name__}: {error}"[:512]
+        if job.attempts < current_app.config.get("PROVISIONING_MAX_ATTEMPTS", 5):
+            backoff = current_app.config.get("PROVISIONING_INTERVAL", 1.0) * 2 ** job.attempts
+            job.status = int(ProvisioningStatus.Pending)
+            job.next_attempt_at = datetime.utcnow() + timedelta(seconds=backoff)
+            db.session.commit()
+            return
+        kunin_employee_id = None
+
+    table = Key.__table__
+    if kunin_employee_id:
+        job.status = int(ProvisioningStatus.Done)
+        job.kunin_employee_id = job.activation.kunin_employee_id = kunin_employee_id
+        db.session.execute(table.update().where(table.c.id == key.id)
+                           .values(version=table.c.version + 1))
+    else:
+        job.status = int(ProvisioningStatus.Failed)
+        job.activation.valid_until = datetime.utcnow()
+        db.session.execute(table.update().where(table.c.id == key.id).values(
+            remaining=case([(table.c.remaining == -1, -1)], else_=table.c.remaining + 1),
+            version=table.c.version + 1))
+        reason = f"not registered: {job.last_error}" if job.last_error else "refused by Kunin"
+        AuditLog.from_key(key, f"activation for {job.email} from {job.origin} {reason}",
+                          Event.FailedActivation, commit=False)
+    job.password = None
+    job.updated_at = datetime.utcnow()
+    db.session.commit()
+    verdict_cache.invalidate(key.id)
+
+
+def provisioning_for(key_id: int, hwid: str) -> ProvisioningJob:
+    """The latest provisioning job of an activation of key `key_id` on `hwid`."""
+    return ProvisioningJob.query.filter_by(key_id=key_id, hwid=hwid) \
+        .order_by(ProvisioningJob.id.desc()).first()
+
+
+class Receipt(NamedTuple):
+    """The claims of a signed license receipt."""
+    key_id: int
+    hwid: str
+    kunin_employee_id: int
+    valid_until: datetime
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+@lru_cache(maxsize=16)
+def _receipt_private_key(value: str) -> Ed25519PrivateKey:
+    return Ed25519PrivateKey.from_private_bytes(_b64decode(value))
+
+
+@lru_cache(maxsize=16)
+def _receipt_public_key(value: str) -> Ed25519PublicKey:
+    return Ed25519PublicKey.from_public_bytes(_b64decode(value))
+
+
+def new_receipt_key() -> tuple:
+    """A new Ed25519 key pair for `RECEIPT_KEYS`, as base64url private and public keys."""
+    private_key = Ed25519PrivateKey.generate()
+    return _b64encode(private_key.private_bytes(Encoding.Raw, PrivateFormat.Raw, NoEncryption())), \
+        _b64encode(private_key.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw))
+
+
+def receipt_public_keys() -> dict:
+    """The base64url public keys receipts are verified with, by key id: those
+    of `RECEIPT_KEYS` and the retired ones in `RECEIPT_PUBLIC_KEYS`."""
+    keys = dict(current_app.config.get("RECEIPT_PUBLIC_KEYS", {}))
+    for key_name, value in current_app.config.get("RECEIPT_KEYS", {}).items():
+        public_key = _receipt_private_key(value).public_key()
+        keys[key_name] = _b64encode(public_key.public_bytes(Encoding.Raw, PublicFormat.Raw))
+    return keys
+
+
+def receipt_valid_until(*expiries: datetime) -> datetime:
+    """The earliest of `RECEIPT_TTL` seconds from now and the given expiries."""
+    ttl = timedelta(seconds=current_app.config.get("RECEIPT_TTL", 86400))
+    valid_until = datetime.utcnow() + ttl
+    return min([valid_until] + [expiry for expiry in expiries if expiry])
+
+
+def sign_receipt(key_id: int, hwid: str, kunin_employee_id: int, valid_until: datetime) -> str:
+    """Sign a compact receipt a client can verify offline until `valid_until`.
+
+    The receipt is `<key id>.<payload>.<signature>`, an Ed25519 signature made
+    with the private key `RECEIPT_KEYS[RECEIPT_KEY_ID]`, so clients verify it
+    with the public key alone. Returns None when receipts are not
+    configured."""
+    key_name = current_app.config.get("RECEIPT_KEY_ID")
+    private_key = current_app.config.get("RECEIPT_KEYS", {}).get(key_name)
+    if not private_key:
+        return None
+    payload = _b64encode(json.dumps([key_id, hwid, kunin_employee_id,
+                                     calendar.timegm(valid_until.utctimetuple())],
+                                    separators=(",", ":")).encode())
+    signed = f"{key_name}.{payload}"
+    return f"{signed}.{_b64encode(_receipt_private_key(private_key).sign(signed.encode()))}"
+
+
+def verify_receipt(receipt: str) -> Receipt:
+    """Verify a receipt made by `sign_receipt` with any of the
+    `receipt_public_keys`, so receipts signed before a key rotation stay
+    valid until they expire."""
+    try:
+        key_name, payload, signature = receipt.split(".")
+    except ValueError:
+        raise InvalidReceipt("malformed receipt")
+    public_key = receipt_public_keys().get(key_name)
+    if not public_key:
+        raise InvalidReceipt(f"unknown receipt key {key_name!r}")
+    try:
+        _receipt_public_key(public_key).verify(_b64decode(signature),
+                                               f"{key_name}.{payload}".encode())
+    except (InvalidSignature, ValueError):
+        raise InvalidReceipt("bad receipt signature")
+
+    key_id, hwid, kunin_employee_id, valid_until = json.loads(_b64decode(payload))
+    receipt = Receipt(key_id, hwid, kunin_employee_id, datetime.utcfromtimestamp(valid_until))
+    if receipt.valid_until <= datetime.utcnow():
+        raise InvalidReceipt(f"receipt expired {receipt.valid_until}")
+    return receipt
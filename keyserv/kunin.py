@@ -0,0 +1,169 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class KuninUnavailable(Exception):
+    """Raised when the Kunin API cannot be reached in time or the circuit
+    breaker is open."""
+    pass
+
+
+class KuninClient:
+    """Pooled client for the Kunin user API.
+
+    Requests share one keep-alive session per process with a bounded
+    connection pool. Each call has a connect and a read timeout and never
+    outlives the deadline it is given. Server errors raise `KuninUnavailable`
+    like timeouts do. Only connection failures are retried, since a request
+    that reached Kunin may have registered the user. After
+    `KUNIN_BREAKER_THRESHOLD` consecutive failures the breaker opens and
+    calls fail fast for `KUNIN_BREAKER_RESET` seconds, after which a single
+    trial call decides whether it closes again.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._session = None
+        self._pid = None
+        self.base_url = None
+        self.connect_timeout = 3.05
+        self.read_timeout = 10.0
+        self.deadline = 15.0
+        self.retries = 2
+        self.pool_size = 10
+        self.breaker_threshold = 5
+        self.breaker_reset = 30.0
+        self._reset_stats()
+
+    def init_app(self, app):
+        with self._lock:
+            self.base_url = (app.config.get("KUNIN_API") or "").rstrip("/")
+            self.connect_timeout = app.config.get("KUNIN_CONNECT_TIMEOUT", 3.05)
+            self.read_timeout = app.config.get("KUNIN_READ_TIMEOUT", 10.0)
+            self.deadline = app.config.get("KUNIN_DEADLINE", 15.0)
+            self.retries = app.config.get("KUNIN_RETRIES", 2)
+            self.pool_size = app.config.get("KUNIN_POOL_SIZE", 10)
+            self.breaker_threshold = app.config.get("KUNIN_BREAKER_THRESHOLD", 5)
+            self.breaker_reset = app.config.get("KUNIN_BREAKER_RESET", 30.0)
+            if self._session is not None:
+                self._session.close()
+            self._session = None
+            self._reset_stats()
+
+    def start_deadline(self) -> float:
+        """A deadline `KUNIN_DEADLINE` seconds from now, for a group of calls."""
+        return time.monotonic() + self.deadline
+
+    def register(self, email: str, password: str, client_id: int,
+                 deadline: float = None) -> requests.Response:
+        return self._post("/api/v1/users", {"user": {"email": email, "password": password,
+                                                     "client_id": client_id}}, deadline)
+
+    def login(self, email: str, password: str, deadline: float = None) -> requests.Response:
+        return self._post("/api/v1/users/login", {"user": {"email": email, "password": password}},
+                          deadline)
+
+    def stats(self) -> dict:
+        with self._lock:
+            latencies = sorted(self._latencies)
+            return {"requests": self.requests, "failures": self.failures,
+                    "short_circuited": self.short_circuited,
+                    "breaker_open": self._open_until is not None,
+                    "latency_p50_ms": round(latencies[len(latencies) // 2] * 1e3, 1)
+                    if latencies else None,
+                    "latency_p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1e3, 1)
+                    if latencies else None}
+
+    def _post(self, path: str, payload: dict, deadline: float = None) -> requests.Response:
+        deadline = deadline or self.start_deadline()
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise KuninUnavailable(f"deadline passed before POST {path}")
+        session = self._acquire(path)
+
+        start = time.monotonic()
+        try:
+            response = session.post(self.base_url + path, json=payload,
+                                    timeout=(min(self.connect_timeout, remaining),
+                                             min(self.read_timeout, remaining)))
+        except requests.RequestException as error:
+            self._record(time.monotonic() - start, False)
+            raise KuninUnavailable(f"POST {path} failed: {error}") from error
+        self._record(time.monotonic() - start, response.status_code < 500)
+        if response.status_code >= 500:
+            raise KuninUnavailable(f"POST {path} answered {response.status_code}")
+        return response
+
+    def _acquire(self, path: str) -> requests.Session:
+        """The session of this process, unless the breaker is open."""
+        with self._lock:
+            if self._open_until is not None:
+                if time.monotonic() < self._open_until or self._trial:
+                    self.short_circuited += 1
+                    raise KuninUnavailable(f"circuit open, not sending POST {path}")
+                self._trial = True
+            if self._session is None or self._pid != os.getpid():
+                self._session = self._new_session()
+                self._pid = os.getpid()
+            return self._session
+
+    def _new_session(self) -> requests.Session:
+        retry = Retry(total=self.retries, connect=self.retries, read=0, status=0, redirect=0,
+                      backoff_factor=0.1, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _record(self, elapsed: float, ok: bool):
+        with self._lock:
+            self.requests += 1
+            self._latencies.append(elapsed)
+            self._trial = False
+            if ok:
+                self._consecutive_failures = 0
+                self._open_until = None
+                return
+            self.failures += 1
+            self._consecutive_failures += 1
+            if self._consecutive_failures >= self.breaker_threshold:
+                self._open_until = time.monotonic() + self.breaker_reset
+
+    def _reset_stats(self):
+        self.requests = self.failures = self.short_circuited = 0
+        self._latencies = deque(maxlen=1000)
+        self._consecutive_failures = 0
+        self._open_until = None
+        self._trial = False
+
+
+kunin_client = KuninClient()
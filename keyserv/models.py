@@ -20,14 +20,22 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import base64
+import hashlib
+import hmac
 from datetime import datetime, timedelta
 from enum import IntEnum
 from typing import Any  # NOQA: F401
+from cryptography.fernet import Fernet
+from flask import current_app
 from flask_caching import Cache
 
-from sqlalchemy import event
+from sqlalchemy import event, inspect
 from flask_sqlalchemy import SQLAlchemy, Model
+from keyserv.auditpolicy import audit_policy
+from keyserv.idblocks import id_blocks
 from keyserv.uuidgenerator import UUIDGenerator
+from keyserv.writebehind import audit_sink
 
 basestring = (str, bytes)
 cache = Cache()
@@ -92,6 +100,23 @@ class SurrogatePK(object):
         return cls.query.get(int(UUIDGenerator.uuid_to_int(str(record_uuid))))
 
 
+@event.listens_for(SurrogatePK, 'before_insert', propagate=True)
+def assign_id(mapper, connection, target):
+    """Take the id from `id_blocks` so the uuid is part of the INSERT."""
+    if target.id is None:
+        target.id = id_blocks.allocate(connection, mapper.local_table)[0]
+    if not target.uuid:
+        target.uuid = UUIDGenerator.int_to_uuid(target.id).hex
+
+
+class IdBlock(db.Model):
+    """The next id `id_blocks` hands out for a table."""
+    __tablename__ = 'id_block'
+
+    name = db.Column(db.String(64), primary_key=True)
+    next_id = db.Column(db.Integer, nullable=False)
+
+
 def reference_col(tablename, nullable=False, pk_name='id', **kwargs):
     """Column that adds primary key foreign key reference.
 
@@ -109,17 +134,50 @@ class Application(db.Model, SurrogatePK):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), nullable=False, unique=True)
     support_message = db.Column(db.String(255))
+    # the tokens of keys cut for this application; the defaults in keyserv.tokens when unset
+    token_length = db.Column(db.Integer)
+    token_alphabet = db.Column(db.String(256))
+    # new tokens start with the application id, so clients need not send it or ask /api/appid
+    token_app_prefix = db.Column(db.Boolean, nullable=False, default=False,
+                                 server_default=db.false())
 
     def __init__(self, name=None, support_message=None):
         self.name = name
         self.support_message = support_message
 
 
-@event.listens_for(Application, 'after_insert')
-def after_insert(_, connection, target):
-    if not target.uuid:  # Generate UUID
-        myuuid = UUIDGenerator.int_to_uuid(target.id).hex
-        connection.execute(Application.__table__.update().where(Application.id == target.id).values(uuid=myuuid))
+def token_digest(token: str) -> str:
+    """Keyed HMAC-SHA256 of `token`.
+
+    Keys are looked up by this digest so the database never compares the
+    token itself. `TOKEN_DIGEST_KEY` is used if set, otherwise `SECRET_KEY`.
+    """
+    secret = current_app.config.get("TOKEN_DIGEST_KEY") or current_app.config["SECRET_KEY"]
+    if isinstance(secret, str):
+        secret = secret.encode()
+    return hmac.new(secret, token.encode(), hashlib.sha256).hexdigest()
+
+
+def _password_cipher() -> Fernet:
+    secret = current_app.config.get("PROVISIONING_KEY") or current_app.config["SECRET_KEY"]
+    if isinstance(secret, str):
+        secret = secret.encode()
+    return Fernet(base64.urlsafe_b64encode(hashlib.sha256(b"provisioning:" + secret).digest()))
+
+
+def seal_password(password: str) -> str:
+    """Encrypt `password` for a provisioning job.
+
+    The Fernet key is derived from `PROVISIONING_KEY` if set, otherwise from
+    `SECRET_KEY`. Raises `cryptography.fernet.InvalidToken` from
+    `open_password` when the key changed in between.
+    """
+    return password and _password_cipher().encrypt(password.encode()).decode()
+
+
+def open_password(sealed: str) -> str:
+    """The password `seal_password` encrypted into `sealed`."""
+    return sealed and _password_cipher().decrypt(sealed.encode()).decode()
 
 
 class Key(db.Model, SurrogatePK):
@@ -131,6 +189,16 @@ class Key(db.Model, SurrogatePK):
     remaining: remaining activations for a key. -1 if unlimited
     enabled: if the license is able to
     """
+    # the pool `claim_key` draws from, in claim order
+    __table_args__ = (db.Index("ix_key_unclaimed", "app_id", "id",
+                               postgresql_where=db.text("claimed_by IS NULL"),
+                               sqlite_where=db.text("claimed_by IS NULL")),
+                      # the orders the admin key listing pages through
+                      db.Index("ix_key_app_id_id", "app_id", "id"),
+                      db.Index("ix_key_valid_until_id", "valid_until", "id"),
+                      db.Index("ix_key_claimed_at_id", "claimed_at", "id"),
+                      {'extend_existing': True})
+
     id = db.Column(db.Integer, primary_key=True)
     app = db.relationship("Application", uselist=False, backref="keys")
     app_id = db.Column(db.Integer,
@@ -142,6 +210,7 @@ class Key(db.Model, SurrogatePK):
     # hwid = db.Column(db.String, default="")
     remaining = db.Column(db.Integer)
     token = db.Column(db.String(512), unique=True)
+    token_digest = db.Column(db.String(64), unique=True, index=True)
     total_activations = db.Column(db.Integer, default=0)
     total_checks = db.Column(db.Integer, default=0)
     last_activation_ts = db.Column(db.DateTime)
@@ -152,6 +221,12 @@ class Key(db.Model, SurrogatePK):
     ttl = db.Column(db.Integer)
     claimed_by = db.Column(db.String(255))
     claimed_at = db.Column(db.DateTime)
+    # bumped whenever a column in VERSIONED_COLUMNS changes; feeds the /api/check ETag
+    version = db.Column(db.Integer, nullable=False, default=1, server_default="1")
+
+    # the columns a check response depends on; activations always bump total_activations
+    VERSIONED_COLUMNS = ("app_id", "enabled", "kunin_client_id", "remaining", "token",
+                         "total_activations", "valid_until")
 
     def __init__(self, token: str, remaining: int, app_id: int, enabled: bool = True, memo: str = "", # hwid: str = "",
                  expiry_date: str = "30", kunin_client_id: int = 0) -> None:
@@ -175,11 +250,17 @@ class Key(db.Model, SurrogatePK):
         return f"<Key({self.token}) valid until {self.valid_until}>"
 
 
-@event.listens_for(Key, 'after_insert')
-def after_insert(_, connection, target):
-    if not target.uuid:  # Generate UUID
-        myuuid = UUIDGenerator.int_to_uuid(target.id).hex
-        connection.execute(Key.__table__.update().where(Key.id == target.id).values(uuid=myuuid))
+@event.listens_for(Key, 'before_insert')
+def before_insert(_, connection, target):
+    if not target.token_digest and target.token:
+        target.token_digest = token_digest(target.token)
+
+
+@event.listens_for(Key, 'before_update')
+def before_update(_, connection, target):
+    state = inspect(target)
+    if any(state.attrs[name].history.has_changes() for name in Key.VERSIONED_COLUMNS):
+        target.version = Key.version + 1
 
 
 class Activation(db.Model, SurrogatePK):
@@ -190,6 +271,10 @@ class Activation(db.Model, SurrogatePK):
     key: the key associated with this activation
     valid_until: taking into account how the key was cut, the date when this is NO LONGER valid
     """
+    __table_args__ = (db.Index("ix_activation_key_employee_hwid",
+                               "key_id", "kunin_employee_id", "hwid"),
+                      {'extend_existing': True})
+
     id = db.Column(db.Integer, primary_key=True)
     key = db.relationship("Key", uselist=False, backref="activations")
     key_id = db.Column(db.Integer,
@@ -219,13 +304,6 @@ class Activation(db.Model, SurrogatePK):
         return f"<Activation [of Key({self.token})] valid until {self.valid_until}>"
 
 
-@event.listens_for(Activation, 'after_insert')
-def after_insert(_, connection, target):
-    if not target.uuid:  # Generate UUID
-        myuuid = UUIDGenerator.int_to_uuid(target.id).hex
-        connection.execute(Activation.__table__.update().where(Activation.id == target.id).values(uuid=myuuid))
-
-
 class Event(IntEnum):
     Info = 0
     Warn = 1
@@ -243,6 +321,15 @@ class AuditLog(db.Model, SurrogatePK):
     """
     Database representation of an audit log.
     """
+    # the audit log viewer pages through (timestamp, id), optionally within one event type, app
+    # or key
+    __table_args__ = (db.Index("ix_audit_log_timestamp_id", "timestamp", "id"),
+                      db.Index("ix_audit_log_event_type_timestamp_id",
+                               "event_type", "timestamp", "id"),
+                      db.Index("ix_audit_log_app_id_timestamp_id", "app_id", "timestamp", "id"),
+                      db.Index("ix_audit_log_key_id_timestamp_id", "key_id", "timestamp", "id"),
+                      {'extend_existing': True})
+
     id = db.Column(db.Integer, primary_key=True)
     app = db.relationship("Application", backref="logs")
     app_id = db.Column(db.Integer, db.ForeignKey("application.id"), nullable=False)
@@ -261,15 +348,112 @@ class AuditLog(db.Model, SurrogatePK):
         self.timestamp = datetime.now()
 
     @classmethod
-    def from_key(cls, key: Key, message: str, event_type: Event):
-        cls(key.id, key.app.id, message, event_type).save()
+    def from_key(cls, key: Key, message: str, event_type: Event, commit: bool = True,
+                 ip: str = None):
+        """Log an event for `key`, through `audit_sink` when it is enabled.
+
+        Events given the `ip` they came from go through `audit_policy`, which
+        may drop them; the session is still committed when asked to. Rows for
+        the sink wait for the session to commit, so work that is rolled back
+        logs nothing."""
+        suppressed = audit_policy.admit(key.id, event_type, ip)
+        if suppressed is None:
+            if commit:
+                db.session.commit()
+            return
+        if suppressed:
+            message = f"{message} ({suppressed} more suppressed)"
+        if audit_sink.enabled:
+            db.session.info.setdefault("audit_rows", []) \
+                .append((key.id, key.app_id, message, event_type))
+            if commit:
+                db.session.commit()
+        else:
+            cls(key.id, key.app_id, message, event_type).save(commit)
+
+
+@event.listens_for(db.session, "after_commit")
+def _emit_audit_rows(session):
+    for row in session.info.pop("audit_rows", ()):
+        audit_sink.emit(*row)
 
 
-@event.listens_for(AuditLog, 'after_insert')
-def after_insert(_, connection, target):
-    if not target.uuid:  # Generate UUID
-        myuuid = UUIDGenerator.int_to_uuid(target.id).hex
-        connection.execute(AuditLog.__table__.update().where(AuditLog.id == target.id).values(uuid=myuuid))
+@event.listens_for(db.session, "after_transaction_end")
+def _drop_audit_rows(session, transaction):
+    # runs after `after_commit` too, by when the rows are gone
+    if transaction.parent is None:
+        session.info.pop("audit_rows", None)
+
+
+class AuditRollup(db.Model):
+    """
+    Daily count of the audit rows of one key and event that retention purged.
+    """
+    __tablename__ = 'audit_rollup'
+
+    day = db.Column(db.Date, primary_key=True)
+    key_id = db.Column(db.Integer, db.ForeignKey("key.id"), primary_key=True)
+    event_type = db.Column(db.Integer, primary_key=True)
+    app_id = db.Column(db.Integer, db.ForeignKey("application.id"), nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+
+
+class KuninEmployee(db.Model, SurrogatePK):
+    """
+    Cached resolution of a Kunin user to their `kunin_employee_id`.
+
+    email_digest: `token_digest` of the client id and lowercased email
+    password_hash: argon2 hash of the password Kunin accepted
+    expires_at: when the entry is no longer used
+    """
+    __tablename__ = 'kunin_employee'
+
+    id = db.Column(db.Integer, primary_key=True)
+    email_digest = db.Column(db.String(64), nullable=False, index=True)
+    kunin_client_id = db.Column(db.Integer, nullable=False)
+    kunin_employee_id = db.Column(db.Integer, nullable=False)
+    password_hash = db.Column(db.String(255), nullable=False)
+    resolved_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+
+class ProvisioningStatus(IntEnum):
+    Pending = 0
+    Running = 1
+    Done = 2
+    Failed = 3
+
+
+class ProvisioningJob(db.Model, SurrogatePK):
+    """
+    Outbox entry registering the user of an activation with the Kunin API.
+
+    password: encrypted with `seal_password`, only kept until the job is settled
+    next_attempt_at: when a pending job is next due
+    updated_at: when a running job was claimed; stale claims are taken over
+    """
+    __tablename__ = 'provisioning_job'
+    __table_args__ = (db.Index("ix_provisioning_job_due", "status", "next_attempt_at"),
+                      db.Index("ix_provisioning_job_key_hwid", "key_id", "hwid"),
+                      {'extend_existing': True})
+
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.relationship("Key", uselist=False)
+    key_id = db.Column(db.Integer, db.ForeignKey("key.id"), nullable=False)
+    activation = db.relationship("Activation", uselist=False)
+    activation_id = db.Column(db.Integer, db.ForeignKey("activation.id"), nullable=False)
+    kunin_client_id = db.Column(db.Integer, nullable=False)
+    hwid = db.Column(db.String(128))
+    origin = db.Column(db.String(255))
+    email = db.Column(db.String(255))
+    password = db.Column(db.Text)
+    status = db.Column(db.Integer, default=int(ProvisioningStatus.Pending), nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    kunin_employee_id = db.Column(db.Integer)
+    last_error = db.Column(db.String(512))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime)
 
 
 class EarlyBirdApplication(db.Model, SurrogatePK):
@@ -291,14 +475,3 @@ class EarlyBirdApplication(db.Model, SurrogatePK):
     reviewer_notes = db.Column(db.Text, nullable=True)
     key_id = db.Column(db.Integer, db.ForeignKey('key.id'), nullable=True)
     key = db.relationship('Key', uselist=False, backref='early_bird_application')
-
-
-@event.listens_for(EarlyBirdApplication, 'after_insert')
-def after_insert(_, connection, target):
-    if not target.uuid:
-        myuuid = UUIDGenerator.int_to_uuid(target.id).hex
-        connection.execute(
-            EarlyBirdApplication.__table__.update()
-            .where(EarlyBirdApplication.id == target.id)
-            .values(uuid=myuuid)
-        )
@@ -0,0 +1,107 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import operator
+from datetime import datetime
+
+from sqlalchemy import and_, or_
+
+
+DATETIME_FORMATS = ("%Y-%m-%d", "%Y-%m-%dT%H:%M", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M:%S.%f")
+
+
+def parse_datetime(value: str) -> datetime:
+    """Parse the ISO 8601 forms `datetime.isoformat` writes, without an offset.
+
+    A space may stand in for the "T". Raises ValueError when `value` is none
+    of them.
+    """
+    value = value.strip().replace(" ", "T", 1)
+    for date_format in DATETIME_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            pass
+    raise ValueError(f"not an ISO 8601 date or time: {value!r}")
+
+
+class Page:
+    """A page of rows and the cursor of the page after it, None on the last page."""
+
+    def __init__(self, items: list, cursor: str = None):
+        self.items = items
+        self.cursor = cursor
+
+
+def keyset_page(query, column, tiebreak, after: str = None, descending: bool = False,
+                per_page: int = 100, nullable: bool = None) -> Page:
+    """Fetch the page of `query` following the cursor `after`.
+
+    Rows are ordered on `(column, tiebreak)`, NULLs last in either direction.
+    A page starts right after the last row of the previous one instead of at an
+    OFFSET, so a deep page costs the same as the first as long as an index
+    covers the order. `tiebreak` must be unique and not null, usually the
+    primary key; pass it as `column` too to order on it alone. `nullable`
+    overrides the column's own flag for columns every writer fills in, which
+    keeps the page condition a plain range on the index. Raises ValueError
+    when `after` does not parse.
+    """
+    if nullable is None:
+        nullable = column.nullable
+    compare = operator.lt if descending else operator.gt
+    if after:
+        value, last = _decode(after, column, tiebreak)
+        if column is tiebreak:
+            query = query.filter(compare(tiebreak, last))
+        elif value is None:
+            query = query.filter(and_(column.is_(None), compare(tiebreak, last)))
+        else:
+            beyond = or_(compare(column, value), and_(column == value, compare(tiebreak, last)))
+            query = query.filter(or_(beyond, column.is_(None)) if nullable else beyond)
+
+    order = [tiebreak.desc() if descending else tiebreak.asc()]
+    if column is not tiebreak:
+        first = column.desc() if descending else column.asc()
+        order.insert(0, first.nullslast() if nullable else first)
+
+    items = query.order_by(*order).limit(per_page + 1).all()
+    if len(items) <= per_page:
+        return Page(items)
+    last = items[per_page - 1]
+    return Page(items[:per_page], _encode(getattr(last, column.key), getattr(last, tiebreak.key)))
+
+
+def _encode(value, last) -> str:
+    if value is None:
+        value = ""
+    elif isinstance(value, datetime):
+        value = value.isoformat()
+    return f"{last},{value}"
+
+
+def _decode(cursor: str, column, tiebreak) -> tuple:
+    last, _, value = cursor.partition(",")
+    last = tiebreak.type.python_type(last)
+    if not value:
+        return None, last
+    kind = column.type.python_type
+    return (parse_datetime(value) if kind is datetime else kind(value)), last
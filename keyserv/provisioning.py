@@ -0,0 +1,109 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from keyserv.writebehind import WriteBehind
+
+
+class ProvisioningWorker(WriteBehind):
+    """Drains the Kunin provisioning outbox.
+
+    With `KUNIN_ASYNC_PROVISIONING` on, activations of Kunin client keys
+    record a `ProvisioningJob` instead of calling the Kunin API. The worker is
+    woken by each new job and polls every `PROVISIONING_INTERVAL` seconds
+    while running; jobs are claimed in the database, so several processes can
+    drain the same outbox, and at most `PROVISIONING_CONCURRENCY` of them run
+    at once per process. With `PROVISIONING_WORKER` off no process runs the
+    worker and `flask provision-users`, which drains the outbox once, is left
+    to a scheduler.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._woken = False
+        self.concurrency = 4
+        self.processed = 0
+
+    def init_app(self, app):
+        super().init_app(app, app.config.get("KUNIN_ASYNC_PROVISIONING", False) and
+                         app.config.get("PROVISIONING_WORKER", True),
+                         app.config.get("PROVISIONING_INTERVAL", 1.0))
+        self.concurrency = app.config.get("PROVISIONING_CONCURRENCY", 4)
+        self._woken = False
+
+    def wake(self):
+        """Have the worker look for due jobs now."""
+        if not self.enabled:
+            return
+        with self._cond:
+            self._ensure_worker()
+            self._woken = True
+            self._cond.notify_all()
+
+    def drain(self) -> int:
+        """Run due jobs until none are left; call inside an app context.
+        Returns the number of jobs run."""
+        from keyserv.keymanager import claim_provisioning_jobs
+
+        ran = 0
+        with ThreadPoolExecutor(self.concurrency, thread_name_prefix="provisioning") as pool:
+            while True:
+                job_ids = claim_provisioning_jobs(self.concurrency)
+                if not job_ids:
+                    return ran
+                list(pool.map(self._run_job, job_ids))
+                ran += len(job_ids)
+                with self._cond:
+                    self.processed += len(job_ids)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"enabled": self.enabled, "processed": self.processed, "failed": self.failed}
+
+    def _run_job(self, job_id: int):
+        from keyserv.keymanager import run_provisioning_job
+        from keyserv.models import db
+
+        with self._app.app_context():
+            try:
+                run_provisioning_job(job_id)
+            finally:
+                db.session.remove()
+
+    def _ready(self) -> bool:
+        return self._woken
+
+    def _pending(self, batch) -> int:
+        return 1
+
+    def _take(self) -> bool:
+        # the worker thread polls on every tick; a flush on stop only runs if woken
+        woken, self._woken = self._woken, False
+        return woken or threading.current_thread() is self._thread
+
+    def _write(self, batch):
+        self.drain()
+
+
+provisioning = ProvisioningWorker()
@@ -0,0 +1,171 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, bindparam
+
+from keyserv.models import AuditLog, AuditRollup, Event, db
+from keyserv.writebehind import WriteBehind
+
+# chunks in a row a purge may find taken by another before it gives up
+MAX_CONFLICTS = 3
+
+
+class AuditRetention(WriteBehind):
+    """Rolls audit rows past their retention up into daily counts and purges them.
+
+    `AUDIT_RETENTION` maps `Event` names to the days their rows are kept;
+    events not named are kept forever. Old rows are counted into
+    `AuditRollup` per day, key and event and deleted in the same transaction,
+    `AUDIT_RETENTION_CHUNK` rows at a time with `AUDIT_RETENTION_PAUSE`
+    seconds between chunks, so writers to the audit log never wait long. A
+    chunk another process purged first is rolled back and read again, so
+    nothing is counted twice. With `AUDIT_RETENTION_INTERVAL` set every
+    process runs a purge that often; otherwise run `flask purge-audit-logs`
+    from a scheduler.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.retention = {}
+        self.chunk_size = 500
+        self.pause = 0.1
+        self.purged = self.runs = self.conflicts = 0
+
+    def init_app(self, app):
+        self.retention = {Event[name]: timedelta(days=days)
+                          for name, days in app.config.get("AUDIT_RETENTION", {}).items()}
+        interval = app.config.get("AUDIT_RETENTION_INTERVAL", 0)
+        super().init_app(app, bool(interval and self.retention), interval or 3600)
+        self.chunk_size = app.config.get("AUDIT_RETENTION_CHUNK", 500)
+        self.pause = app.config.get("AUDIT_RETENTION_PAUSE", 0.1)
+        self.purged = self.runs = self.conflicts = 0
+        if self.enabled:
+            app.before_first_request(self.start)
+
+    def start(self):
+        """Start this process's worker; the first purge runs an interval later."""
+        with self._cond:
+            self._ensure_worker()
+
+    def purge(self, retention: dict = None, now: datetime = None) -> int:
+        """Roll up and delete the rows older than their retention; call inside an
+        app context. `retention` maps events to a timedelta and defaults to
+        `AUDIT_RETENTION`. Returns the number of rows purged."""
+        now = now or datetime.now()
+        purged = 0
+        for event_type, keep in (self.retention if retention is None else retention).items():
+            conflicts = 0
+            while True:
+                chunk = self._purge_chunk(event_type, now - keep)
+                if chunk is None:
+                    # another purge is taking the same rows; let it, unless this keeps happening
+                    conflicts += 1
+                    if conflicts == MAX_CONFLICTS:
+                        raise RuntimeError(f"gave up purging {event_type.name} rows after "
+                                           f"{conflicts} conflicts")
+                    continue
+                conflicts = 0
+                purged += chunk
+                with self._cond:
+                    self.purged += chunk
+                if chunk < self.chunk_size:
+                    break
+                time.sleep(self.pause)
+        with self._cond:
+            self.runs += 1
+        return purged
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"enabled": self.enabled, "runs": self.runs, "purged": self.purged,
+                    "conflicts": self.conflicts, "failed": self.failed}
+
+    def _purge_chunk(self, event_type: Event, before: datetime) -> int:
+        """Purge the oldest chunk of `event_type` rows before `before`.
+        Returns the rows purged, or None when another purge got there first."""
+        rows = db.session.query(AuditLog.id, AuditLog.key_id, AuditLog.app_id, AuditLog.timestamp) \
+            .filter(AuditLog.event_type == int(event_type), AuditLog.timestamp < before) \
+            .order_by(AuditLog.timestamp, AuditLog.id).limit(self.chunk_size).all()
+        if not rows:
+            return 0
+
+        deleted = AuditLog.query.filter(AuditLog.id.in_([row.id for row in rows])) \
+            .delete(synchronize_session=False)
+        if deleted != len(rows):
+            db.session.rollback()
+            with self._cond:
+                self.conflicts += 1
+            return None
+
+        counts, app_ids = Counter(), {}
+        for row in rows:
+            counts[row.timestamp.date(), row.key_id] += 1
+            # a key moved to another app is rolled up under the app of its latest row
+            app_ids[row.timestamp.date(), row.key_id] = row.app_id
+        self._roll_up(event_type, counts, app_ids)
+        db.session.commit()
+        return len(rows)
+
+    def _roll_up(self, event_type: Event, counts: Counter, app_ids: dict):
+        """Add `counts` of `(day, key_id)` to the rollups, inserting new ones
+        under `app_ids[day, key_id]`: one SELECT for the rollups that exist,
+        one executemany each to update them and to insert the rest."""
+        table = AuditRollup.__table__
+        existing = {tuple(row) for row in
+                    db.session.query(AuditRollup.day, AuditRollup.key_id).filter(
+                        AuditRollup.event_type == int(event_type),
+                        AuditRollup.day.in_({day for day, _ in counts}),
+                        AuditRollup.key_id.in_({key_id for _, key_id in counts}))}
+
+        updates = [{"b_day": day, "b_key_id": key_id, "b_count": count}
+                   for (day, key_id), count in counts.items() if (day, key_id) in existing]
+        inserts = [{"day": day, "key_id": key_id, "app_id": app_ids[day, key_id],
+                    "event_type": int(event_type), "count": count}
+                   for (day, key_id), count in counts.items() if (day, key_id) not in existing]
+        if updates:
+            db.session.execute(table.update().where(and_(
+                table.c.day == bindparam("b_day"), table.c.key_id == bindparam("b_key_id"),
+                table.c.event_type == int(event_type)))
+                .values(count=table.c.count + bindparam("b_count")), updates)
+        if inserts:
+            db.session.execute(table.insert(), inserts)
+
+    def _pending(self, batch) -> int:
+        return 1
+
+    def _take(self) -> bool:
+        # only the worker purges, on each tick; stopping the process does not start one
+        return threading.current_thread() is self._thread and not self._stopping
+
+    def _write(self, batch):
+        try:
+            self.purge()
+        finally:
+            db.session.remove()
+
+
+audit_retention = AuditRetention()
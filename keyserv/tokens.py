@@ -0,0 +1,228 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import math
+import secrets
+import string
+import threading
+from functools import lru_cache
+
+DEFAULT_ALPHABET = string.ascii_uppercase + string.digits
+# 29 random characters and a Luhn mod 36 check character, given out in six groups of five
+CHECKED_LENGTH = 30
+DEFAULT_LENGTH = CHECKED_LENGTH
+# keys cut before the check character have 25 characters and are looked up without it
+LEGACY_LENGTH = 25
+# checked tokens can start with the id of their application in base 36, marked by a Luhn
+# sum of 1 instead of 0 so the check character vouches for the prefix as well
+PREFIX_LENGTH = 3
+PREFIXED = 1
+MAX_PREFIX_APP_ID = 36 ** PREFIX_LENGTH - 1
+# the longest token a key can have
+MAX_LENGTH = 512
+# the fewest random bits a generated token may carry, so that tokens cannot be guessed and
+# the generator never runs out of fresh ones
+MIN_ENTROPY_BITS = 100
+
+_DEFAULT_CODES = {char: code for code, char in enumerate(DEFAULT_ALPHABET)}
+
+
+class TokenGenerator:
+    """Random tokens of `length` characters drawn uniformly from `alphabet`.
+
+    Entropy is read with one `secrets.token_bytes` call per batch. Each byte
+    maps to `alphabet[byte % len(alphabet)]`; bytes at or above the largest
+    multiple of the alphabet size are dropped rather than wrapped, so every
+    character is equally likely. `bytes.translate` does the mapping and the
+    rejection in one pass.
+
+    Alphabets have no lowercase letters, dashes or whitespace, so that
+    `normalize_token` leaves every token it generates unchanged. The random
+    part of a token must carry at least `MIN_ENTROPY_BITS`. Tokens of
+    `CHECKED_LENGTH` characters from `DEFAULT_ALPHABET` end in a check
+    character, see `is_checked`, and may start with an `app_prefix`.
+    """
+
+    def __init__(self, length: int = DEFAULT_LENGTH, alphabet: str = DEFAULT_ALPHABET,
+                 prefix: str = ""):
+        if not 1 <= length <= MAX_LENGTH:
+            raise ValueError(f"token length must be between 1 and {MAX_LENGTH}")
+        if (not 2 <= len(alphabet) <= 256 or len(set(alphabet)) != len(alphabet) or
+                not all(ord(char) < 128 for char in alphabet)):
+            raise ValueError("token alphabet must be 2 to 256 distinct ASCII characters")
+        if alphabet != normalize_token(alphabet):
+            raise ValueError("token alphabet cannot have lowercase letters, dashes or whitespace")
+        self.length = length
+        self.alphabet = alphabet
+        self.checked = length == CHECKED_LENGTH and set(alphabet) <= set(DEFAULT_ALPHABET)
+        if prefix and not self.checked:
+            raise ValueError("only tokens in the default format can start with the application id")
+        self.prefix = prefix
+        self._layout = PREFIXED if prefix else 0
+        self._random_length = length - 1 - len(prefix) if self.checked else length
+        if self.entropy < MIN_ENTROPY_BITS:
+            raise ValueError(f"tokens of {length} characters from an alphabet of {len(alphabet)} "
+                             f"carry {self.entropy:.0f} random bits, at least {MIN_ENTROPY_BITS} "
+                             "are needed")
+        self._accepted = 256 - 256 % len(alphabet)
+        encoded = alphabet.encode("ascii")
+        self._table = bytes(encoded[byte % len(alphabet)] for byte in range(256))
+        self._rejected = bytes(range(self._accepted, 256))
+
+    @property
+    def entropy(self) -> float:
+        """Random bits in each token."""
+        return self._random_length * math.log2(len(self.alphabet))
+
+    def token(self) -> str:
+        return self.tokens(1)[0]
+
+    def tokens(self, count: int) -> list:
+        """`count` new tokens. Duplicates are not checked for."""
+        length = self._random_length
+        needed = count * length
+        chars = b""
+        while len(chars) < needed:
+            # read enough that a second round is rarely needed
+            missing = needed - len(chars)
+            raw = secrets.token_bytes(missing * 256 // self._accepted + 16)
+            chars += raw.translate(self._table, self._rejected)
+        text = chars[:needed].decode("ascii")
+        tokens = [text[start:start + length] for start in range(0, needed, length)]
+        if self.checked:
+            return [self.prefix + token + check_character(self.prefix + token, self._layout)
+                    for token in tokens]
+        return tokens
+
+
+@lru_cache(maxsize=64)
+def token_generator(length: int = DEFAULT_LENGTH, alphabet: str = DEFAULT_ALPHABET,
+                    prefix: str = "") -> TokenGenerator:
+    return TokenGenerator(length, alphabet, prefix)
+
+
+def generator_for(application) -> TokenGenerator:
+    """The generator for keys of `application`, which may override the length
+    and alphabet of its tokens and have them start with its id."""
+    if application is None:
+        return token_generator()
+    return token_generator(application.token_length or DEFAULT_LENGTH,
+                           application.token_alphabet or DEFAULT_ALPHABET,
+                           app_prefix(application.id) if application.token_app_prefix else "")
+
+
+def app_prefix(app_id: int) -> str:
+    """`app_id` in `PREFIX_LENGTH` base 36 digits of `DEFAULT_ALPHABET`."""
+    if not 0 < app_id <= MAX_PREFIX_APP_ID:
+        raise ValueError(f"application ids above {MAX_PREFIX_APP_ID} do not fit in a token prefix")
+    digits = []
+    for _ in range(PREFIX_LENGTH):
+        app_id, digit = divmod(app_id, 36)
+        digits.append(DEFAULT_ALPHABET[digit])
+    return "".join(reversed(digits))
+
+
+def app_id_of(token: str):
+    """The application id in the prefix of a normalized `token`, or None when
+    it has none."""
+    if not is_checked(token) or _layout(token) != PREFIXED:
+        return None
+    app_id = 0
+    for char in token[:PREFIX_LENGTH]:
+        app_id = app_id * 36 + _DEFAULT_CODES[char]
+    return app_id
+
+
+def _luhn_sum(codes, double_first: bool) -> int:
+    """The Luhn mod 36 sum of `codes`, given from the right."""
+    total = 0
+    factor = 2 if double_first else 1
+    for code in codes:
+        addend = factor * code
+        total += addend // 36 + addend % 36
+        factor = 3 - factor
+    return total
+
+
+def check_character(body: str, layout: int = 0) -> str:
+    """The Luhn mod 36 check character appended to `body`, which makes the
+    sum of the token `layout`."""
+    total = _luhn_sum((_DEFAULT_CODES[char] for char in reversed(body)), True)
+    return DEFAULT_ALPHABET[(layout - total) % 36]
+
+
+def is_checked(token: str) -> bool:
+    """Whether `token` is in the checked format: `CHECKED_LENGTH` characters
+    of `DEFAULT_ALPHABET`, the last one the check character of the others."""
+    return len(token) == CHECKED_LENGTH and all(char in _DEFAULT_CODES for char in token)
+
+
+def _layout(token: str) -> int:
+    return _luhn_sum((_DEFAULT_CODES[char] for char in reversed(token)), False) % 36
+
+
+def checksum_valid(token: str) -> bool:
+    return _layout(token) in (0, PREFIXED)
+
+
+def normalize_token(token: str) -> str:
+    """`token` as stored: without whitespace or dashes and in upper case, so
+    that grouped (`ABCDE-FGHIJ-...`) and lowercased copies match."""
+    return "".join(token.split()).replace("-", "").upper()
+
+
+class TokenFilter:
+    """Turns tokens sent by clients into stored form and rejects those that
+    cannot belong to any key, before anything is queried.
+
+    A token is rejected when it is empty, longer than `MAX_LENGTH`, not
+    printable ASCII, or in the checked format with a wrong check character.
+    A mistyped character always breaks the check; about one in 36 times it
+    instead makes the token look prefixed, for an application the request
+    rarely names. Tokens of other lengths, including the legacy 25
+    character ones, are passed on to be looked up.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.accepted = self.rejected = 0
+
+    def parse(self, token: str):
+        """The stored form of `token`, or None when no key can have it."""
+        token = normalize_token(token or "")
+        valid = (0 < len(token) <= MAX_LENGTH and all(ord(char) < 128 for char in token) and
+                 token.isprintable() and
+                 (not is_checked(token) or _layout(token) == 0 or app_id_of(token)))
+        with self._lock:
+            if valid:
+                self.accepted += 1
+            else:
+                self.rejected += 1
+        return token if valid else None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"accepted": self.accepted, "rejected": self.rejected}
+
+
+token_filter = TokenFilter()
@@ -1,4 +1,5 @@
-from baseconv import BaseConverter, BASE16_ALPHABET
+import os
+import secrets
 from uuid import UUID, uuid4
 
 BASE = 16
@@ -7,37 +8,52 @@ HEX_DOUBLE_WORD_UPPER_BYTE = slice(-HEX_DOUBLE_WORD_LENGTH, -(HEX_DOUBLE_WORD_LE
 MAX_DOUBLE_WORD = (1 << 31)
 OLD_BIT_FLAG = 0x80
 NEW_BIT_FLAG_MASK = OLD_BIT_FLAG - 1
-BASE16 = BaseConverter(BASE16_ALPHABET.lower())
+
+# the same layout as integers: the id goes in the top 32 bits and the flag byte is
+# the upper byte of the last 32 bits, with the rest of the uuid4 random
+ID_SHIFT = 96
+FLAG_BYTE_SHIFT = 24
+RANDOM_MASK = (1 << ID_SHIFT) - 1
+FLAG_BYTE_MASK = ~(0xff << FLAG_BYTE_SHIFT)
+OLD_FLAG = OLD_BIT_FLAG << FLAG_BYTE_SHIFT
+# the version 4 and RFC 4122 variant bits uuid4 sets
+VERSION_MASK = ~((0xf000 << 64) | (0xc000 << 48))
+VERSION_BITS = (0x4000 << 64) | (0x8000 << 48)
+# int_to_uuid keeps 2**31 - id to eight hex digits without a leading zero
+MIN_INVERSE_ID = 1 << 28
+MAX_INVERSE_ID = (1 << 32) - 1
+
 
 class UUIDGenerator():
     uuid = None
 
     def __init__(self):
-        while True:
-            uuid = uuid4()
-            replacer = BASE16.encode(int(BASE16.decode(str(uuid)[HEX_DOUBLE_WORD_UPPER_BYTE])) & NEW_BIT_FLAG_MASK)
-            if int(replacer, BASE) >= 16:
-                break
-        self.uuid = UUID(str(uuid)[:-(HEX_DOUBLE_WORD_LENGTH)] + replacer + str(uuid)[-(HEX_DOUBLE_WORD_LENGTH-2):])
+        # a new version uuid has the flag byte clear of OLD_BIT_FLAG and at least 16,
+        # so that it is two hex digits
+        flag_byte = 16 + secrets.randbelow(OLD_BIT_FLAG - 16)
+        self.uuid = UUID(int=uuid4().int & FLAG_BYTE_MASK | flag_byte << FLAG_BYTE_SHIFT)
 
     @staticmethod
     def new_version(uuid):
-        return not bool(int(BASE16.decode(str(uuid)[HEX_DOUBLE_WORD_UPPER_BYTE])) & OLD_BIT_FLAG)
+        return not int(str(uuid)[HEX_DOUBLE_WORD_UPPER_BYTE], BASE) & OLD_BIT_FLAG
 
     @staticmethod
     def int_to_uuid(int_id):
-        int_id = int(int_id)
-        myid = str(uuid4())
+        return UUID(int=_inverse_id(int_id) << ID_SHIFT | uuid4().int & RANDOM_MASK | OLD_FLAG)
 
-        replacer1 = BASE16.encode(MAX_DOUBLE_WORD - int_id)
-        replacer2 = BASE16.encode(int(BASE16.decode(myid[HEX_DOUBLE_WORD_UPPER_BYTE])) | OLD_BIT_FLAG)
-        return UUID(replacer1 + myid[HEX_DOUBLE_WORD_LENGTH:-(HEX_DOUBLE_WORD_LENGTH)] +
-                    replacer2 + myid[-(HEX_DOUBLE_WORD_LENGTH-2):])
+    @staticmethod
+    def int_to_uuids(int_ids):
+        """`int_to_uuid` of each id in `int_ids`, drawing the random bits for all
+        of them at once."""
+        int_ids = list(int_ids)
+        random = os.urandom(12 * len(int_ids))
+        return [UUID(int=_inverse_id(int_id) << ID_SHIFT | OLD_FLAG | VERSION_BITS |
+                     int.from_bytes(random[n * 12:n * 12 + 12], "big") & VERSION_MASK)
+                for n, int_id in enumerate(int_ids)]
 
     @staticmethod
     def uuid_to_int(uuid):
-        inverse_id = int(BASE16.decode(uuid[:HEX_DOUBLE_WORD_LENGTH]))
-        return (MAX_DOUBLE_WORD - inverse_id)
+        return MAX_DOUBLE_WORD - int(uuid[:HEX_DOUBLE_WORD_LENGTH], BASE)
 
     @staticmethod
     def str_to_uuid(str_uuid):
@@ -54,3 +70,9 @@ class UUIDGenerator():
 
         return uuid_str[:7]+'-'+uuid_str[7:11]+'-'+uuid_str[11:15]+'-'+uuid_str[15:19]+'-'+uuid_str[19:]
 
+
+def _inverse_id(int_id):
+    inverse_id = MAX_DOUBLE_WORD - int(int_id)
+    if not MIN_INVERSE_ID <= inverse_id <= MAX_INVERSE_ID:
+        raise ValueError("id %s is out of range for a uuid" % int_id)
+    return inverse_id
@@ -0,0 +1,117 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+
+class Verdict(NamedTuple):
+    """The outcome of a key check, independent of the ORM session."""
+    key_id: int
+    remaining: int
+    kunin_client_id: Optional[int]
+    valid_until: Optional[datetime]
+    activation: bool = False
+    activation_valid_until: Optional[datetime] = None
+    version: int = 0
+
+    def still_valid(self) -> bool:
+        """Mirror of `key_still_valid`: a check without a matching activation
+        is valid, otherwise the activation must not have expired."""
+        return not self.activation or bool(self.activation_valid_until and
+                                           self.activation_valid_until > datetime.utcnow())
+
+
+class VerdictCache:
+    """Bounded LRU cache of check verdicts with a time to live.
+
+    Entries are keyed by the check arguments and indexed by key id so that a
+    change to a key drops every verdict derived from it. Each worker process
+    has its own cache, so `CHECK_CACHE_TTL` bounds how long a change made
+    through another worker can go unnoticed. A `CHECK_CACHE_SIZE` of 0
+    disables caching.
+    """
+
+    def __init__(self, size: int = 0, ttl: float = 60):
+        self._lock = threading.Lock()
+        self.configure(size, ttl)
+
+    def init_app(self, app):
+        self.configure(app.config.get("CHECK_CACHE_SIZE", 10000),
+                       app.config.get("CHECK_CACHE_TTL", 60))
+
+    def configure(self, size: int, ttl: float):
+        with self._lock:
+            self.size = size
+            self.ttl = ttl
+            self._entries = OrderedDict()
+            self._by_key_id = {}
+            self.hits = self.misses = self.evictions = 0
+
+    def get(self, cache_key: tuple) -> Optional[Verdict]:
+        with self._lock:
+            entry = self._entries.get(cache_key)
+            if entry is None or entry[0] < time.monotonic():
+                if entry is not None:
+                    self._discard(cache_key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(cache_key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, cache_key: tuple, verdict: Verdict):
+        if not self.size:
+            return
+        with self._lock:
+            self._discard(cache_key)
+            self._entries[cache_key] = (time.monotonic() + self.ttl, verdict)
+            self._by_key_id.setdefault(verdict.key_id, set()).add(cache_key)
+            while len(self._entries) > self.size:
+                self._discard(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, key_id: int):
+        """Drop every cached verdict of key `key_id`."""
+        with self._lock:
+            for cache_key in self._by_key_id.pop(key_id, ()):
+                self._entries.pop(cache_key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "capacity": self.size, "ttl": self.ttl,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+    def _discard(self, cache_key: tuple):
+        entry = self._entries.pop(cache_key, None)
+        if entry is not None:
+            siblings = self._by_key_id.get(entry[1].key_id)
+            if siblings is not None:
+                siblings.discard(cache_key)
+                if not siblings:
+                    del self._by_key_id[entry[1].key_id]
+
+
+verdict_cache = VerdictCache()
@@ -20,19 +20,35 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import operator
 import os
 
-from flask import (Blueprint, abort, current_app, flash, redirect,
-                   render_template, request, send_from_directory, url_for)
+from flask import (Blueprint, Response, abort, current_app, flash, jsonify, redirect,
+                   render_template, request, send_from_directory, stream_with_context, url_for)
 from flask_login import current_user, login_required, login_user, logout_user
+from sqlalchemy import func
+from sqlalchemy.orm import joinedload
 
+from keyserv.auditpolicy import audit_policy
 from keyserv.auth import Users
+from keyserv.export import EXPORTS, FORMATS, export_query, filter_keys, stream
 from keyserv.forms import AppForm, KeyForm, LoginForm
-from keyserv.keymanager import cut_key_unsafe
+from keyserv.idblocks import id_blocks
+from keyserv.keymanager import claim_key, cut_key_unsafe
+from keyserv.kunin import kunin_client
 from keyserv.models import Application, AuditLog, EarlyBirdApplication, Event, Key, db
+from keyserv.pagination import keyset_page, parse_datetime
+from keyserv.provisioning import provisioning
+from keyserv.retention import audit_retention
+from keyserv.tokens import generator_for, token_filter
+from keyserv.verdictcache import verdict_cache
+from keyserv.writebehind import audit_sink, check_counters
 
 frontend = Blueprint("frontend", __name__)
 
+# the orders the key listing offers, each backed by an index on (column, id)
+KEY_SORTS = {"id": Key.id, "app": Key.app_id, "expiry": Key.valid_until, "claimed": Key.claimed_at}
+
 
 @frontend.route("/favicon.ico")
 def favicon():
@@ -67,19 +83,125 @@ def logout():
 @frontend.route("/keys")
 @login_required
 def keys():
-    return render_template("keys.html", keys=Key.query.all())
+    apps = db.session.query(Application.id, Application.name).order_by(Application.name).all()
+    return _render_keys(request.args.get("app", type=int), apps=apps)
+
+
+def _render_keys(app_id: int = None, **context):
+    """Render one page of keys, filtered and ordered by the query string.
+
+    The application of each key comes in the same query, so a page costs one
+    SELECT however many keys there are.
+    """
+    args = request.args
+    query = Key.query.options(joinedload(Key.app, innerjoin=True))
+    if app_id:
+        query = query.filter(Key.app_id == app_id)
+    query = filter_keys(query, **_key_filters(args))
+
+    try:
+        page = keyset_page(query, KEY_SORTS.get(args.get("sort"), Key.id), Key.id,
+                           args.get("after"), args.get("order") == "desc",
+                           current_app.config.get("ADMIN_PAGE_SIZE", 100))
+    except ValueError:
+        abort(400)
+
+    export_args = {name: args[name] for name in ("enabled", "claimed", "expiry") if args.get(name)}
+    if app_id:
+        export_args["app"] = app_id
+    return render_template("keys.html", keys=page.items, cursor=page.cursor, page_url=_page_url,
+                           app_id=app_id, export_args=export_args, **context)
+
+
+def _key_filters(args) -> dict:
+    """The `filter_keys` filters set by the enabled, claimed and expiry query arguments."""
+    yes_no = {"yes": True, "no": False}
+    return {"enabled": yes_no.get(args.get("enabled")), "claimed": yes_no.get(args.get("claimed")),
+            "expired": {"expired": True, "valid": False}.get(args.get("expiry"))}
+
+
+def _page_url(after: str) -> str:
+    """The URL of the current listing with the same filters, starting after the cursor `after`."""
+    return url_for(request.endpoint, **request.view_args,
+                   **{**request.args.to_dict(), "after": after})
 
 
 @frontend.route("/applications")
 @login_required
 def apps():
-    return render_template("applications.html", apps=Application.query.all())
+    counts = dict(db.session.query(Key.app_id, func.count(Key.id)).group_by(Key.app_id))
+    return render_template("applications.html", apps=Application.query.all(), counts=counts)
 
 
 @frontend.route("/logs")
 @login_required
 def logs():
-    return render_template("logs.html", logs=AuditLog.query.all())
+    """Render one page of the audit log, newest first, filtered by the query string.
+
+    Key tokens and application names are plain columns of the same query, so
+    a page costs one SELECT and holds only its own rows.
+    """
+    args = request.args
+    query = db.session.query(AuditLog.id, AuditLog.key_id, AuditLog.app_id, AuditLog.timestamp,
+                             AuditLog.message, AuditLog.event_type, Key.token,
+                             Application.name.label("app_name")) \
+        .join(Key, Key.id == AuditLog.key_id) \
+        .join(Application, Application.id == AuditLog.app_id)
+    for name, column in (("event", AuditLog.event_type), ("app", AuditLog.app_id),
+                         ("key", AuditLog.key_id)):
+        if args.get(name, type=int) is not None:
+            query = query.filter(column == args.get(name, type=int))
+
+    try:
+        for name, compare in (("since", operator.ge), ("until", operator.lt)):
+            if args.get(name):
+                query = query.filter(compare(AuditLog.timestamp, parse_datetime(args[name])))
+        # every writer stamps its row, so the page condition stays a range on the indexes
+        page = keyset_page(query, AuditLog.timestamp, AuditLog.id, args.get("after"),
+                           args.get("order") != "asc",
+                           current_app.config.get("ADMIN_PAGE_SIZE", 100), nullable=False)
+    except ValueError:
+        abort(400)
+
+    apps = db.session.query(Application.id, Application.name).order_by(Application.name).all()
+    events = [(str(int(event)), event.name) for event in Event]
+    export_args = {name: args[name] for name in ("app", "event", "since", "until")
+                   if args.get(name)}
+    return render_template("logs.html", logs=page.items, cursor=page.cursor, page_url=_page_url,
+                           apps=apps, app_id=args.get("app", type=int), events=events,
+                           export_args=export_args)
+
+
+@frontend.route("/export/<kind>.<output_format>")
+@login_required
+def export(kind: str, output_format: str):
+    """Stream an export as it is read, filtered by app, since, until and event like
+    `flask export`, and keys also like the key listing."""
+    if kind not in EXPORTS or output_format not in FORMATS:
+        abort(404)
+    args = request.args
+    try:
+        since, until = (parse_datetime(args[name]) if args.get(name) else None
+                        for name in ("since", "until"))
+        query = export_query(kind, args.get("app", type=int), since, until,
+                             args.get("event", type=int),
+                             **(_key_filters(args) if kind == "keys" else {}))
+    except ValueError:
+        abort(400)
+
+    chunks = stream(query, output_format, current_app.config.get("EXPORT_BATCH_SIZE", 1000))
+    return Response(stream_with_context(chunks), mimetype=FORMATS[output_format],
+                    headers={"Content-Disposition": f"attachment; filename={kind}.{output_format}"})
+
+
+@frontend.route("/stats")
+@login_required
+def stats():
+    return jsonify({"check_cache": verdict_cache.stats(), "audit_sink": audit_sink.stats(),
+                    "audit_policy": audit_policy.stats(),
+                    "check_counters": check_counters.stats(), "kunin": kunin_client.stats(),
+                    "provisioning": provisioning.stats(), "id_blocks": id_blocks.stats(),
+                    "tokens": token_filter.stats(), "retention": audit_retention.stats()})
 
 
 @frontend.route("/modify/key/<int:key_id>", methods=["GET", "POST"])
@@ -124,6 +246,7 @@ def modify_key(key_id: int):
 
         try:
             db.session.commit()
+            verdict_cache.invalidate(key.id)
             flash("Changes successful!")
             return redirect(url_for("frontend.detail_key", key_id=key.id))
         except Exception as error:
@@ -171,12 +294,18 @@ def add_app():
         app = Application()
         app.name = form.name.data
         app.support_message = form.support.data
+        app.token_length = form.token_length.data
+        app.token_alphabet = form.token_alphabet.data or None
+        app.token_app_prefix = form.token_app_prefix.data
 
         db.session.add(app)
         try:
+            db.session.flush()
+            generator_for(app)  # the prefix needs the id
             db.session.commit()
             flash("Success!")
         except Exception as error:
+            db.session.rollback()
             flash(f"Failed to add application: {error}")
 
     return render_template("add_modify.html",
@@ -196,15 +325,23 @@ def modify_app(app_id: int):
 
         app.name = form.name.data
         app.support_message = form.support.data
+        app.token_length = form.token_length.data
+        app.token_alphabet = form.token_alphabet.data or None
+        app.token_app_prefix = form.token_app_prefix.data
         try:
+            generator_for(app)
             db.session.commit()
             flash("Success.")
             return redirect(url_for("frontend.detail_app", app_id=app.id))
         except Exception as error:
+            db.session.rollback()
             flash(f"Failed to modify application: {error}", "error")
 
     form.name.data = app.name
     form.support.data = app.support_message
+    form.token_length.data = app.token_length
+    form.token_alphabet.data = app.token_alphabet
+    form.token_app_prefix.data = app.token_app_prefix
 
     return render_template("add_modify.html", form=form)
 
@@ -213,6 +350,7 @@ def modify_app(app_id: int):
 @login_required
 def detail_key(key_id: int):
 
+    check_counters.flush()
     key = Key.query.get(key_id)
 
     if not key:
@@ -230,7 +368,8 @@ def detail_app(app_id: int):
     if not app:
         abort(404)
 
-    return render_template("detail_app.html", app=app)
+    return render_template("detail_app.html", app=app,
+                           key_count=Key.query.filter_by(app_id=app.id).count())
 
 
 @frontend.route("/keys/app/<int:app_id>")
@@ -242,7 +381,7 @@ def keys_for_app(app_id):
     if not app:
         abort(404)
 
-    return render_template("keys.html", keys=app.keys)
+    return _render_keys(app.id, app=app)
 
 
 @frontend.route("/keys/deactivate/<int:key_id>")
@@ -256,6 +395,7 @@ def disable_key(key_id):
 
     key.enabled = False
     db.session.commit()
+    verdict_cache.invalidate(key.id)
 
     return redirect(url_for("frontend.detail_key", key_id=key_id))
 
@@ -271,6 +411,7 @@ def enable_key(key_id):
 
     key.enabled = True
     db.session.commit()
+    verdict_cache.invalidate(key.id)
 
     return redirect(url_for("frontend.detail_key", key_id=key_id))
 
@@ -315,18 +456,13 @@ def earlybird_approve(app_id):
         flash("No application configured for key allocation.", "error")
         return redirect(url_for("frontend.earlybird_detail", app_id=app_id))
 
-    # find an unclaimed key
-    key = Key.query.filter_by(app_id=tp_app.id, claimed_by=None, enabled=True) \
-        .filter(Key.remaining != 0).first()
+    key = claim_key(tp_app.id, application.email,
+                    f"first-bell: {application.name} <{application.email}>", commit=False)
 
     if not key:
         flash("No keys available to allocate.", "error")
         return redirect(url_for("frontend.earlybird_detail", app_id=app_id))
 
-    key.claimed_by = application.email
-    key.claimed_at = datetime.utcnow()
-    key.memo = f"first-bell: {application.name} <{application.email}>"
-
     application.status = 1
     application.reviewed_at = datetime.utcnow()
     application.key_id = key.id
@@ -0,0 +1,239 @@
+# MIT License
+
+# Copyright (c) 2019 Samuel Hoffman
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import atexit
+import os
+import threading
+from datetime import datetime
+
+from sqlalchemy import bindparam
+
+
+class WriteBehind:
+    """A buffer of pending writes flushed to the database by a daemon thread.
+
+    Subclasses hold their pending writes under `_cond` and implement `_pending`
+    (how many writes are buffered), `_take` (remove and return the buffered
+    writes) and `_write` (persist them; called inside an app context). The
+    worker flushes every `interval` seconds, sooner when `_ready` says so, and
+    once more when the process exits. The thread is started on first use and
+    restarted after a fork, so buffers never cross worker processes.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._app = None
+        self._thread = None
+        self._pid = None
+        self._stopping = False
+        self._registered = False
+        self.enabled = False
+        self.interval = 1.0
+        self.failed = 0
+
+    def init_app(self, app, enabled: bool, interval: float):
+        self.stop()
+        self._app = app
+        self.enabled = enabled
+        self.interval = interval
+        self._stopping = False
+        if not self._registered:
+            atexit.register(self.stop)
+            self._registered = True
+
+    def flush(self):
+        """Write everything buffered so far from the calling thread."""
+        with self._cond:
+            batch = self._take()
+            self._cond.notify_all()
+        if batch:
+            with self._app.app_context():
+                self._write(batch)
+
+    def stop(self):
+        """Stop the worker and flush what is left."""
+        thread = self._thread
+        if thread is not None and self._pid == os.getpid():
+            with self._cond:
+                self._stopping = True
+                self._cond.notify_all()
+            thread.join()
+        self._thread = None
+        if self._app is not None:
+            try:
+                self.flush()
+            except Exception:
+                self._app.logger.exception(f"{type(self).__name__} failed to flush on stop")
+
+    def _ensure_worker(self):
+        """Start the worker if this process has none; `_cond` must be held."""
+        if self._thread is None or self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._stopping = False
+            self._thread = threading.Thread(target=self._run, name=type(self).__name__,
+                                            daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._stopping or self._ready(), self.interval)
+                batch = self._take()
+                stopping = self._stopping
+                self._cond.notify_all()
+            if batch:
+                with self._app.app_context():
+                    try:
+                        self._write(batch)
+                    except Exception:
+                        self._app.logger.exception(f"{type(self).__name__} failed to write "
+                                                   f"{self._pending(batch)} pending write(s)")
+                        self.failed += self._pending(batch)
+            if stopping:
+                return
+
+    def _ready(self) -> bool:
+        return False
+
+
+class AuditSink(WriteBehind):
+    """Buffers AuditLog rows and inserts them in batches.
+
+    Rows are flushed in `AUDIT_BATCH_SIZE` executemany batches whenever that
+    many are waiting or every `AUDIT_FLUSH_INTERVAL` seconds. At most
+    `AUDIT_BUFFER_SIZE` rows are held; a writer finding the buffer full waits
+    up to `AUDIT_BUFFER_TIMEOUT` seconds for room and then drops its row,
+    counted in `dropped`. With `AUDIT_ASYNC` off rows are saved through the
+    session as they are logged, which is what the tests use.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._rows = []
+        self.batch_size = 500
+        self.buffer_size = 10000
+        self.buffer_timeout = 0.1
+        self.written = self.dropped = self.batches = 0
+
+    def init_app(self, app):
+        super().init_app(app, app.config.get("AUDIT_ASYNC", True),
+                         app.config.get("AUDIT_FLUSH_INTERVAL", 1.0))
+        self.batch_size = app.config.get("AUDIT_BATCH_SIZE", 500)
+        self.buffer_size = app.config.get("AUDIT_BUFFER_SIZE", 10000)
+        self.buffer_timeout = app.config.get("AUDIT_BUFFER_TIMEOUT", 0.1)
+
+    def emit(self, key_id: int, app_id: int, message: str, event_type: int):
+        row = {"key_id": key_id, "app_id": app_id, "message": message,
+               "event_type": int(event_type), "timestamp": datetime.now()}
+        with self._cond:
+            self._ensure_worker()
+            if not self._cond.wait_for(lambda: len(self._rows) < self.buffer_size,
+                                       self.buffer_timeout):
+                self.dropped += 1
+                return
+            self._rows.append(row)
+            if len(self._rows) >= self.batch_size:
+                self._cond.notify_all()
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"enabled": self.enabled, "buffered": len(self._rows),
+                    "written": self.written, "batches": self.batches,
+                    "dropped": self.dropped, "failed": self.failed}
+
+    def _ready(self) -> bool:
+        return len(self._rows) >= self.batch_size
+
+    def _pending(self, batch: list) -> int:
+        return len(batch)
+
+    def _take(self) -> list:
+        rows, self._rows = self._rows, []
+        return rows
+
+    def _write(self, rows: list):
+        from keyserv.idblocks import id_blocks
+        from keyserv.models import AuditLog, db
+
+        table = AuditLog.__table__
+        for start in range(0, len(rows), self.batch_size):
+            batch = rows[start:start + self.batch_size]
+            with db.engine.begin() as connection:
+                connection.execute(table.insert(), id_blocks.assign(connection, table, batch))
+            with self._cond:
+                self.written += len(batch)
+                self.batches += 1
+
+
+class CheckCounters(WriteBehind):
+    """Aggregates key check counters and writes them behind.
+
+    Checks only bump an in-process counter; every `CHECK_COUNTERS_INTERVAL`
+    seconds each key checked since the last flush gets one UPDATE adding its
+    count and setting the latest check time and ip. With
+    `CHECK_COUNTERS_ASYNC` off the key row is updated on every check.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._checks = {}
+        self.written = 0
+
+    def init_app(self, app):
+        super().init_app(app, app.config.get("CHECK_COUNTERS_ASYNC", True),
+                         app.config.get("CHECK_COUNTERS_INTERVAL", 5.0))
+
+    def record(self, key_id: int, ip: str):
+        with self._cond:
+            self._ensure_worker()
+            checks, _, _ = self._checks.get(key_id, (0, None, None))
+            self._checks[key_id] = (checks + 1, datetime.utcnow(), ip)
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {"enabled": self.enabled, "dirty_keys": len(self._checks),
+                    "written": self.written, "failed": self.failed}
+
+    def _pending(self, batch: dict) -> int:
+        return sum(checks for checks, _, _ in batch.values())
+
+    def _take(self) -> dict:
+        checks, self._checks = self._checks, {}
+        return checks
+
+    def _write(self, batch: dict):
+        from keyserv.models import Key, db
+
+        table = Key.__table__
+        statement = table.update().where(table.c.id == bindparam("key_id")).values(
+            total_checks=table.c.total_checks + bindparam("checks"),
+            last_check_ts=bindparam("ts"),
+            last_check_ip=bindparam("ip"))
+        with db.engine.begin() as connection:
+            connection.execute(statement, [{"key_id": key_id, "checks": checks, "ts": ts, "ip": ip}
+                                           for key_id, (checks, ts, ip) in batch.items()])
+        with self._cond:
+            self.written += self._pending(batch)
+
+
+audit_sink = AuditSink()
+check_counters = CheckCounters()
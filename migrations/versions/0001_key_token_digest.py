@@ -0,0 +1,49 @@
+"""Look keys up by a keyed digest of their token.
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+
+Adds `key.token_digest` with its unique index and fills it in for every
+key. Databases created by `flask initdb` already have the column; only the
+backfill runs there.
+"""
+import sqlalchemy as sa
+from alembic import op
+
+from keyserv.models import token_digest
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    bind = op.get_bind()
+    inspector = sa.inspect(bind)
+    if "token_digest" not in {column["name"] for column in inspector.get_columns("key")}:
+        op.add_column("key", sa.Column("token_digest", sa.String(64)))
+    if "ix_key_token_digest" not in {index["name"] for index in inspector.get_indexes("key")}:
+        op.create_index("ix_key_token_digest", "key", ["token_digest"], unique=True)
+
+    key = sa.table("key", sa.column("id", sa.Integer), sa.column("token", sa.String),
+                   sa.column("token_digest", sa.String))
+    update = key.update().where(key.c.id == sa.bindparam("key_id")) \
+        .values(token_digest=sa.bindparam("digest"))
+    while True:
+        rows = bind.execute(sa.select([key.c.id, key.c.token])
+                            .where(sa.and_(key.c.token_digest.is_(None), key.c.token.isnot(None)))
+                            .order_by(key.c.id).limit(BATCH_SIZE)).fetchall()
+        if not rows:
+            break
+        bind.execute(update, [{"key_id": row.id, "digest": token_digest(row.token)}
+                              for row in rows])
+
+
+def downgrade():
+    op.drop_index("ix_key_token_digest", table_name="key")
+    with op.batch_alter_table("key") as batch:
+        batch.drop_column("token_digest")
@@ -0,0 +1,56 @@
+"""Encrypt the passwords of provisioning jobs.
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+
+Widens `provisioning_job.password` to hold Fernet tokens and encrypts the
+passwords of jobs still waiting with `seal_password`. Passwords that are
+already encrypted, as in databases created by `flask initdb`, are left
+alone.
+"""
+import sqlalchemy as sa
+from alembic import op
+from cryptography.fernet import InvalidToken
+
+from keyserv.models import open_password, seal_password
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+job = sa.table("provisioning_job", sa.column("id", sa.Integer), sa.column("password", sa.Text))
+
+
+def _is_sealed(password: str) -> bool:
+    try:
+        open_password(password)
+    except InvalidToken:
+        return False
+    return True
+
+
+def _rewrite(bind, change):
+    update = job.update().where(job.c.id == sa.bindparam("job_id")) \
+        .values(password=sa.bindparam("secret"))
+    rows = bind.execute(sa.select([job.c.id, job.c.password])
+                        .where(job.c.password.isnot(None))).fetchall()
+    changed = [{"job_id": row.id, "secret": change(row.password)} for row in rows]
+    changed = [row for row in changed if row["secret"] is not None]
+    if changed:
+        bind.execute(update, changed)
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != "sqlite":  # SQLite does not enforce lengths
+        op.alter_column("provisioning_job", "password", type_=sa.Text, existing_type=sa.String(255))
+    _rewrite(bind, lambda password: None if _is_sealed(password) else seal_password(password))
+
+
+def downgrade():
+    bind = op.get_bind()
+    _rewrite(bind, lambda password: open_password(password) if _is_sealed(password) else None)
+    if bind.dialect.name != "sqlite":
+        op.alter_column("provisioning_job", "password", type_=sa.String(255), existing_type=sa.Text)
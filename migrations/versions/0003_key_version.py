@@ -0,0 +1,27 @@
+"""Version keys for /api/check ETags.
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+
+Adds `key.version`, starting every existing key at 1. Databases created by
+`flask initdb` already have the column.
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if "version" not in {column["name"] for column in inspector.get_columns("key")}:
+        op.add_column("key", sa.Column("version", sa.Integer, nullable=False, server_default="1"))
+
+
+def downgrade():
+    with op.batch_alter_table("key") as batch:
+        batch.drop_column("version")
@@ -0,0 +1,28 @@
+"""Index activations by key, employee and machine.
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18
+
+Adds `ix_activation_key_employee_hwid`, which activation and check look
+their activation up by. Databases created by `flask initdb` already have it.
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0004"
+down_revision = "0003"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if "ix_activation_key_employee_hwid" not in {index["name"] for index in
+                                                 inspector.get_indexes("activation")}:
+        op.create_index("ix_activation_key_employee_hwid", "activation",
+                        ["key_id", "kunin_employee_id", "hwid"])
+
+
+def downgrade():
+    op.drop_index("ix_activation_key_employee_hwid", table_name="activation")
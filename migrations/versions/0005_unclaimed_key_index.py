@@ -0,0 +1,28 @@
+"""Index the keys still free to claim.
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+
+Adds `ix_key_unclaimed`, partial on `claimed_by IS NULL` where the database
+supports it. Databases created by `flask initdb` already have it.
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if "ix_key_unclaimed" not in {index["name"] for index in inspector.get_indexes("key")}:
+        op.create_index("ix_key_unclaimed", "key", ["app_id", "id"],
+                        postgresql_where=sa.text("claimed_by IS NULL"),
+                        sqlite_where=sa.text("claimed_by IS NULL"))
+
+
+def downgrade():
+    op.drop_index("ix_key_unclaimed", table_name="key")
@@ -0,0 +1,37 @@
+"""Let each application choose the shape of its tokens.
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+
+Adds `application.token_length` and `application.token_alphabet`, left
+unset so existing applications keep the default tokens, and
+`application.token_app_prefix`, off for existing applications. Databases
+created by `flask initdb` already have the columns.
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    columns = {column["name"] for column in inspector.get_columns("application")}
+    if "token_length" not in columns:
+        op.add_column("application", sa.Column("token_length", sa.Integer))
+    if "token_alphabet" not in columns:
+        op.add_column("application", sa.Column("token_alphabet", sa.String(256)))
+    if "token_app_prefix" not in columns:
+        op.add_column("application", sa.Column("token_app_prefix", sa.Boolean, nullable=False,
+                                               server_default=sa.false()))
+
+
+def downgrade():
+    with op.batch_alter_table("application") as batch:
+        batch.drop_column("token_app_prefix")
+        batch.drop_column("token_alphabet")
+        batch.drop_column("token_length")
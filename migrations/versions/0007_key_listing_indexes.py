@@ -0,0 +1,34 @@
+"""Index the orders the admin key listing pages through.
+
+Revision ID: 0007
+Revises: 0006
+Create Date: 2026-10-18
+
+Adds `ix_key_app_id_id` and `ix_key_valid_until_id`, which keep each page
+of the key listing an index range scan. Databases created by `flask initdb`
+already have them.
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0007"
+down_revision = "0006"
+branch_labels = None
+depends_on = None
+
+INDEXES = {
+    "ix_key_app_id_id": ["app_id", "id"],
+    "ix_key_valid_until_id": ["valid_until", "id"],
+}
+
+
+def upgrade():
+    existing = {index["name"] for index in sa.inspect(op.get_bind()).get_indexes("key")}
+    for name, columns in INDEXES.items():
+        if name not in existing:
+            op.create_index(name, "key", columns)
+
+
+def downgrade():
+    for name in INDEXES:
+        op.drop_index(name, table_name="key")
@@ -0,0 +1,44 @@
+"""Index the orders the audit log viewer and the claimed-key listing page through.
+
+Revision ID: 0008
+Revises: 0007
+Create Date: 2026-10-18
+
+Adds the (timestamp, id) indexes of `audit_log`, alone and behind each
+filter of /logs, and `ix_key_claimed_at_id`. Databases created by
+`flask initdb` already have them.
+"""
+import sqlalchemy as sa
+from alembic import op
+
+revision = "0008"
+down_revision = "0007"
+branch_labels = None
+depends_on = None
+
+INDEXES = {
+    "audit_log": {
+        "ix_audit_log_timestamp_id": ["timestamp", "id"],
+        "ix_audit_log_event_type_timestamp_id": ["event_type", "timestamp", "id"],
+        "ix_audit_log_app_id_timestamp_id": ["app_id", "timestamp", "id"],
+        "ix_audit_log_key_id_timestamp_id": ["key_id", "timestamp", "id"],
+    },
+    "key": {
+        "ix_key_claimed_at_id": ["claimed_at", "id"],
+    },
+}
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    for table, indexes in INDEXES.items():
+        existing = {index["name"] for index in inspector.get_indexes(table)}
+        for name, columns in indexes.items():
+            if name not in existing:
+                op.create_index(name, table, columns)
+
+
+def downgrade():
+    for table, indexes in INDEXES.items():
+        for name in indexes:
+            op.drop_index(name, table_name=table)
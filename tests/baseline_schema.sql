@@ -0,0 +1,92 @@
+CREATE TABLE application (
+	uuid CHAR(36),
+	id INTEGER NOT NULL,
+	name VARCHAR(128) NOT NULL,
+	support_message VARCHAR(255),
+	PRIMARY KEY (id),
+	UNIQUE (name)
+);
+CREATE INDEX ix_application_uuid ON application (uuid);
+CREATE TABLE users (
+	id INTEGER NOT NULL,
+	username VARCHAR(64) NOT NULL,
+	passwd BLOB NOT NULL,
+	level INTEGER,
+	PRIMARY KEY (id),
+	UNIQUE (username)
+);
+CREATE TABLE "key" (
+	uuid CHAR(36),
+	id INTEGER NOT NULL,
+	app_id INTEGER NOT NULL,
+	cutdate DATETIME,
+	enabled BOOLEAN,
+	memo VARCHAR(512),
+	kunin_client_id INTEGER,
+	remaining INTEGER,
+	token VARCHAR(512),
+	total_activations INTEGER,
+	total_checks INTEGER,
+	last_activation_ts DATETIME,
+	last_activation_ip VARCHAR(64),
+	last_check_ts DATETIME,
+	last_check_ip VARCHAR(64),
+	valid_until DATETIME,
+	ttl INTEGER,
+	claimed_by VARCHAR(255),
+	claimed_at DATETIME,
+	PRIMARY KEY (id),
+	FOREIGN KEY(app_id) REFERENCES application (id),
+	CHECK (enabled IN (0, 1)),
+	UNIQUE (token)
+);
+CREATE INDEX ix_key_uuid ON "key" (uuid);
+CREATE TABLE activation (
+	uuid CHAR(36),
+	id INTEGER NOT NULL,
+	key_id INTEGER NOT NULL,
+	hwid VARCHAR(128),
+	activation_ts DATETIME,
+	activation_ip VARCHAR(64),
+	kunin_employee_id INTEGER,
+	kunin_client_id INTEGER,
+	valid_until DATETIME,
+	PRIMARY KEY (id),
+	FOREIGN KEY(key_id) REFERENCES "key" (id)
+);
+CREATE INDEX ix_activation_uuid ON activation (uuid);
+CREATE TABLE audit_log (
+	uuid CHAR(36),
+	id INTEGER NOT NULL,
+	app_id INTEGER NOT NULL,
+	event_type INTEGER,
+	key_id INTEGER NOT NULL,
+	message VARCHAR(512),
+	timestamp DATETIME,
+	PRIMARY KEY (id),
+	FOREIGN KEY(app_id) REFERENCES application (id),
+	FOREIGN KEY(key_id) REFERENCES "key" (id)
+);
+CREATE INDEX ix_audit_log_uuid ON audit_log (uuid);
+CREATE TABLE early_bird_application (
+	uuid CHAR(36),
+	id INTEGER NOT NULL,
+	name VARCHAR(255) NOT NULL,
+	email VARCHAR(255) NOT NULL,
+	school VARCHAR(255),
+	subjects VARCHAR(512),
+	grade_levels VARCHAR(255),
+	class_size VARCHAR(64),
+	uses_handwritten_tests VARCHAR(32),
+	how_heard VARCHAR(512),
+	motivation TEXT,
+	status INTEGER,
+	applied_at DATETIME,
+	reviewed_at DATETIME,
+	reviewer_notes TEXT,
+	key_id INTEGER,
+	PRIMARY KEY (id),
+	UNIQUE (email),
+	FOREIGN KEY(key_id) REFERENCES "key" (id)
+);
+CREATE INDEX ix_early_bird_application_uuid ON early_bird_application (uuid);
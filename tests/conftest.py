@@ -2,11 +2,16 @@
 """Defines fixtures available to all tests."""
 
 import pytest
+from sqlalchemy import event
 from webtest import TestApp
 
 from keyserv import create_app
+from keyserv.kunin import kunin_client
 from keyserv.models import db as _db
 
+from tests.kunin_stub import KuninStub
+
+
 @pytest.yield_fixture(scope='function')
 def app():
     """An application for the tests."""
@@ -23,6 +28,21 @@ def app():
     ctx.pop()
 
 
+@pytest.fixture
+def file_app(tmp_path):
+    """An application on a SQLite file, so that threads share one database."""
+    app = create_app('TestConfig')
+    app.config["SQLALCHEMY_DATABASE_URI"] = f"sqlite:///{tmp_path / 'keyserv.db'}"
+    with app.app_context():
+        _db.create_all()
+
+    yield app
+
+    with app.app_context():
+        _db.session.remove()
+        _db.drop_all()
+
+
 @pytest.fixture(scope='function')
 def testapp(app):
     """A Webtest app."""
@@ -41,6 +61,48 @@ def db(app):
     # Explicitly close DB connection
     _db.session.close()
     _db.drop_all()
+
+
+class StatementCounter:
+    """Counts the SQL statements and commits sent to the database."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.statements = []
+        self.commits = 0
+
+    def on_execute(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+    def on_commit(self, conn):
+        self.commits += 1
+
+
+@pytest.fixture(scope='function')
+def statements(db):
+    """A StatementCounter listening on the test database engine."""
+    counter = StatementCounter()
+    event.listen(db.engine, "before_cursor_execute", counter.on_execute)
+    event.listen(db.engine, "commit", counter.on_commit)
+
+    yield counter
+
+    event.remove(db.engine, "before_cursor_execute", counter.on_execute)
+    event.remove(db.engine, "commit", counter.on_commit)
+
+
+@pytest.fixture(scope='function')
+def kunin(app):
+    """A local Kunin API stub the app is pointed at."""
+    stub = KuninStub().start()
+    app.config["KUNIN_API"] = stub.url
+    kunin_client.init_app(app)
+
+    yield stub
+
+    stub.stop()
 #
 #
 # @pytest.fixture
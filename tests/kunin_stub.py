@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""A local stand-in for the Kunin user API."""
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+
+class KuninStub:
+    """Serves the Kunin user endpoints from a thread on localhost.
+
+    Registrations get 201 and a new employee id, logins get 404, unless
+    `responses` maps the path to another `(status, body)`. Every request
+    waits `delay` seconds first. `calls` records `(path, payload)` and
+    `connections` the client addresses seen, to tell keep-alive reuse apart
+    from new connections.
+    """
+
+    def __init__(self):
+        self.responses = {}
+        self.delay = 0.0
+        self.calls = []
+        self.connections = set()
+        self._employee_ids = itertools.count(1000)
+        self._server = _Server(("127.0.0.1", 0), _Handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    def start(self) -> "KuninStub":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def respond(self, path: str) -> tuple:
+        if path in self.responses:
+            return self.responses[path]
+        if path == "/api/v1/users":
+            return 201, {"user": {"kunin_employee_id": next(self._employee_ids)}}
+        return 404, {"error": "not found"}
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    """http.server.ThreadingHTTPServer, which Python 3.6 lacks."""
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # answer keep-alive requests without waiting on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        stub = self.server.stub
+        stub.connections.add(self.client_address)
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        stub.calls.append((self.path, payload))
+        if stub.delay:
+            time.sleep(stub.delay)
+        status, body = stub.respond(self.path)
+        data = json.dumps(body).encode()
+        try:
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        except ConnectionError:  # the client timed out and hung up
+            self.close_connection = True
+
+    def log_message(self, *args):
+        pass
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""Audit sampling policy tests."""
+import time
+
+import pytest
+
+from keyserv.auditpolicy import AuditPolicy, audit_policy
+from keyserv.keymanager import Origin, key_valid_const, rand_token
+from keyserv.models import Application, AuditLog, Event, Key
+
+from tests import fake
+
+
+class TestAuditPolicy:
+    """At most one event per key, IP and window."""
+
+    def test_window(self):
+        policy = AuditPolicy({"KeyAccess": 0.05})
+        assert policy.admit(1, Event.KeyAccess, "10.0.0.1") == 0
+        assert policy.admit(1, Event.KeyAccess, "10.0.0.1") is None
+        assert policy.admit(1, Event.KeyAccess, "10.0.0.1") is None
+        assert policy.admit(1, Event.KeyAccess, "10.0.0.2") == 0
+        assert policy.admit(2, Event.KeyAccess, "10.0.0.1") == 0
+        time.sleep(0.06)
+        assert policy.admit(1, Event.KeyAccess, "10.0.0.1") == 2
+        assert policy.stats()["suppressed"] == {"KeyAccess": 2}
+        assert policy.stats()["written"] == 4
+
+    def test_unsampled(self):
+        policy = AuditPolicy({"KeyAccess": 60})
+        for _ in range(3):
+            assert policy.admit(1, Event.AppActivation, "10.0.0.1") == 0
+            assert policy.admit(1, Event.KeyAccess, None) == 0
+        assert policy.stats()["tracked"] == 0
+
+    def test_bounded(self):
+        policy = AuditPolicy({"KeyAccess": 60}, size=2)
+        for key_id in range(3):
+            policy.admit(key_id, Event.KeyAccess, "10.0.0.1")
+        assert policy.stats()["evictions"] == 1
+        # the oldest pair was forgotten, so it is written again
+        assert policy.admit(0, Event.KeyAccess, "10.0.0.1") == 0
+        assert policy.admit(2, Event.KeyAccess, "10.0.0.1") is None
+
+
+@pytest.mark.usefixtures('db')
+class TestSampledChecks:
+    """KeyAccess rows written by key checks."""
+
+    @pytest.fixture(autouse=True)
+    def policy(self, app):
+        app.config["AUDIT_SAMPLING"] = {"KeyAccess": 60}
+        audit_policy.init_app(app)
+
+    def _key(self):
+        application = Application(name=fake.word()).save()
+        return Key(token=rand_token(), remaining=5, app_id=application.id).save()
+
+    def test_checks(self):
+        key = self._key()
+        for ip in ("10.0.0.1", "10.0.0.1", "10.0.0.1", "10.0.0.2"):
+            assert key_valid_const(key.app_id, key.token, Origin(ip, "m", "u"))
+        logs = AuditLog.query.filter_by(event_type=int(Event.KeyAccess)).all()
+        assert sorted(log.message[:len("key check from IP: 10.0.0.1")] for log in logs) == \
+            ["key check from IP: 10.0.0.1", "key check from IP: 10.0.0.2"]
+        # the counters the suppressed checks bumped are still committed
+        assert Key.query.get(key.id).total_checks == 4
+
+    def test_suppressed_count_in_next_row(self, app):
+        key = self._key()
+        app.config["AUDIT_SAMPLING"] = {"KeyAccess": 0.05}
+        audit_policy.init_app(app)
+        for _ in range(3):
+            key_valid_const(key.app_id, key.token, Origin("10.0.0.1", "m", "u"))
+        time.sleep(0.06)
+        key_valid_const(key.app_id, key.token, Origin("10.0.0.1", "m", "u"))
+        messages = [log.message for log in AuditLog.query.order_by(AuditLog.id)]
+        assert len(messages) == 2
+        assert messages[1].endswith("(2 more suppressed)")
+
+    def test_activations_are_kept(self, testapp):
+        key = self._key()
+        for _ in range(2):
+            testapp.post("/api/activate", {"token": key.token, "app_id": key.app_id, "machine": "m",
+                                           "user": "u", "hwid": fake.mac_address()})
+        assert AuditLog.query.filter_by(event_type=int(Event.AppActivation)).count() == 2
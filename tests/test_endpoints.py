@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""API endpoint tests."""
+import pytest
+
+from keyserv.keymanager import rand_token, receipt_public_keys, verify_receipt
+from keyserv.models import Activation, Application, AuditLog, Event, Key
+from keyserv.tokens import check_character, generator_for
+from keyserv.verdictcache import verdict_cache
+
+from tests import fake
+
+
+def _activate(testapp, key, **kwargs):
+    params = {"token": key.token, "app_id": key.app_id, "machine": fake.word(),
+              "user": fake.user_name(), "hwid": fake.mac_address(), **kwargs}
+    return testapp.post("/api/activate", params, expect_errors=True)
+
+
+@pytest.fixture
+def key(db):
+    application = Application(name=fake.word(), support_message=fake.sentence()).save()
+    key = Key(token=rand_token(), remaining=2, app_id=application.id).save()
+    db.session.refresh(key)
+    db.session.expunge_all()
+    return key
+
+
+@pytest.mark.usefixtures('db')
+class TestActivateKey:
+    """/api/activate"""
+
+    def test_activate(self, testapp, key):
+        resp = _activate(testapp, key)
+        assert resp.status_code == 201
+        assert resp.json["remainingActivations"] == "1"
+
+        key = Key.query.get(key.id)
+        assert key.remaining == 1
+        assert key.total_activations == 1
+        assert len(key.activations) == 1
+        events = sorted(log.event_type for log in key.logs)
+        assert events == [Event.AppActivation, Event.KeyAccess]
+
+    def test_out_of_activations(self, testapp, key):
+        assert _activate(testapp, key).status_code == 201
+        assert _activate(testapp, key).status_code == 201
+        resp = _activate(testapp, key)
+        assert resp.status_code == 410
+        assert resp.json["error"] == "key is out of activations"
+        assert AuditLog.query.filter_by(event_type=int(Event.FailedActivation)).count() == 1
+
+    def test_invalid_token(self, testapp, key):
+        resp = _activate(testapp, key, token=rand_token())
+        assert resp.status_code == 404
+        assert resp.json["support_message"]
+        assert Activation.query.count() == 0
+
+    def test_single_commit(self, testapp, key, statements):
+        # the first activation reserves the id blocks of the activation and audit tables
+        assert _activate(testapp, key).status_code == 201
+        statements.reset()
+        resp = _activate(testapp, key)
+        assert resp.status_code == 201
+        assert statements.commits == 1
+        # key lookup, read back of the decremented counters and one insert per table;
+        # the conditional decrement and the counters update excluded
+        inserts_and_selects = [s for s in statements.statements if not s.startswith("UPDATE")]
+        assert len(inserts_and_selects) == 4
+        assert len(statements.statements) == 6
+
+
+@pytest.mark.usefixtures('db')
+class TestCheckKey:
+    """/api/check"""
+
+    def _check(self, testapp, key, **kwargs):
+        params = {"token": key.token, "app_id": key.app_id, "machine": fake.word(),
+                  "user": fake.user_name(), "hwid": "aa:bb", **kwargs}
+        return testapp.get("/api/check", params, expect_errors=True)
+
+    def test_check(self, testapp, key):
+        resp = self._check(testapp, key)
+        assert resp.status_code == 201
+        assert resp.json["remainingActivations"] == "2"
+        assert "receipt" not in resp.json
+        assert self._check(testapp, key, token=rand_token()).status_code == 404
+
+    def test_receipt(self, testapp, key):
+        Activation(key.id, kunin_employee_id=42, hwid="aa:bb").save()
+        resp = self._check(testapp, key, kunin_employee_id=42, receipt="true")
+        assert resp.status_code == 200
+        receipt = verify_receipt(resp.json["receipt"])
+        assert receipt.key_id == key.id
+        assert receipt.hwid == "aa:bb"
+        assert receipt.kunin_employee_id == 42
+        assert "ETag" not in resp.headers
+
+        # no activation to vouch for
+        resp = self._check(testapp, key, receipt="true")
+        assert resp.status_code == 201
+        assert "receipt" not in resp.json
+        assert testapp.get("/api/receipt-keys").json["keys"] == receipt_public_keys()
+
+    def test_not_modified(self, testapp, key, statements):
+        etag = self._check(testapp, key).headers["ETag"]
+        verdict_cache.configure(verdict_cache.size, verdict_cache.ttl)
+
+        statements.reset()
+        resp = testapp.get("/api/check", {"token": key.token, "app_id": key.app_id, "machine": "m",
+                                          "user": "u", "hwid": "aa:bb"},
+                           headers={"If-None-Match": etag}, status=304)
+        assert resp.headers["ETag"] == etag
+        # one indexed read of the key row, no activations
+        assert len(statements.statements) == 1
+        assert self._check(testapp, key, hwid="cc:dd").headers["ETag"] != etag
+
+    def test_etag_follows_key_version(self, testapp, key):
+        etag = self._check(testapp, key).headers["ETag"]
+        _activate(testapp, key)
+        assert Key.query.get(key.id).version == 2
+        resp = testapp.get("/api/check", {"token": key.token, "app_id": key.app_id, "machine": "m",
+                                          "user": "u", "hwid": "aa:bb"},
+                           headers={"If-None-Match": etag})
+        assert resp.status_code == 201
+        assert resp.json["remainingActivations"] == "1"
+        assert resp.headers["ETag"] != etag
+
+
+@pytest.mark.usefixtures('db')
+class TestCheckKeyBatch:
+    """/api/check/batch"""
+
+    def test_batch(self, testapp, key, statements):
+        _activate(testapp, key, hwid="aa:bb")
+        activation = Activation.query.first()
+        checks = [{"token": key.token, "hwid": "aa:bb", "machine": "m", "user": "u",
+                   "kunin_employee_id": activation.kunin_employee_id},
+                  {"token": key.token, "hwid": "cc:dd", "machine": "m", "user": "u"},
+                  {"token": rand_token(), "hwid": "aa:bb", "machine": "m", "user": "u"},
+                  {"token": key.token, "machine": "m", "user": "u"}]
+
+        statements.reset()
+        resp = testapp.post_json("/api/check/batch", {"app_id": key.app_id, "checks": checks})
+        assert resp.status_code == 200
+        assert [r["status"] for r in resp.json["results"]] == [201, 201, 404, 400]
+        assert statements.commits == 1
+        assert Key.query.get(key.id).total_checks == 3
+
+    def test_limit(self, app, testapp, key):
+        app.config["CHECK_BATCH_LIMIT"] = 1
+        check = {"token": key.token, "hwid": "aa:bb", "machine": "m", "user": "u"}
+        resp = testapp.post_json("/api/check/batch", {"app_id": key.app_id, "checks": [check] * 2},
+                                 expect_errors=True)
+        assert resp.status_code == 400
+
+
+@pytest.mark.usefixtures('db')
+class TestTokenFormat:
+    """Grouped, lowercased, legacy and malformed tokens."""
+
+    def _check(self, testapp, key, token):
+        return testapp.get("/api/check", {"token": token, "app_id": key.app_id, "machine": "m",
+                                          "user": "u", "hwid": "aa:bb"}, expect_errors=True)
+
+    def test_grouped_lowercase(self, testapp, key):
+        grouped = "-".join(key.token[i:i + 5] for i in range(0, len(key.token), 5)).lower()
+        assert self._check(testapp, key, grouped).status_code == 201
+        assert _activate(testapp, key, token=grouped).status_code == 201
+        assert testapp.get("/api/appid", {"token": grouped}).json["app_id"] == key.app_id
+
+    def test_legacy_token(self, testapp, key):
+        legacy = Key(token=rand_token(25), remaining=1, app_id=key.app_id).save()
+        assert self._check(testapp, legacy, legacy.token.lower()).status_code == 201
+
+    def test_rejected_before_query(self, testapp, key, statements):
+        mistyped = key.token[:-1] + check_character(key.token[:-1], 5)
+        statements.reset()
+        resp = self._check(testapp, key, mistyped)
+        assert resp.status_code == 404
+        assert resp.json["error"] == "invalid key"
+        assert testapp.get("/api/appid", {"token": mistyped}, expect_errors=True).status_code == 404
+        resp = testapp.post_json("/api/check/batch", {"app_id": key.app_id, "checks": [
+            {"token": mistyped, "hwid": "aa:bb", "machine": "m", "user": "u"}]})
+        assert resp.json["results"][0]["status"] == 404
+        assert statements.statements == []
+        assert _activate(testapp, key, token=mistyped).status_code == 404
+
+
+@pytest.mark.usefixtures('db')
+class TestAppPrefixedTokens:
+    """Tokens carrying their application id."""
+
+    @pytest.fixture
+    def prefixed(self, db):
+        application = Application(name=fake.word(), support_message=fake.sentence())
+        application.token_app_prefix = True
+        application.save()
+        key = Key(token=generator_for(application).token(), remaining=2,
+                  app_id=application.id).save()
+        db.session.refresh(key)
+        db.session.expunge_all()
+        return key
+
+    def _params(self, key, **kwargs):
+        return {"token": key.token, "machine": "m", "user": "u", "hwid": "aa:bb", **kwargs}
+
+    def test_without_app_id(self, testapp, prefixed):
+        assert testapp.post("/api/activate", self._params(prefixed)).status_code == 201
+        assert testapp.get("/api/check", self._params(prefixed)).json["remainingActivations"] == "1"
+        resp = testapp.post_json("/api/check/batch", {"checks": [self._params(prefixed)]})
+        assert resp.json["results"][0]["remainingActivations"] == "1"
+
+    def test_appid_without_query(self, testapp, prefixed, statements):
+        statements.reset()
+        resp = testapp.get("/api/appid", {"token": prefixed.token.lower()})
+        assert resp.json["app_id"] == prefixed.app_id
+        resp = testapp.get("/api/check", self._params(prefixed, app_id=prefixed.app_id + 1),
+                           expect_errors=True)
+        assert resp.status_code == 404
+        assert statements.statements == []
+
+    def test_unprefixed_needs_app_id(self, testapp, key):
+        resp = testapp.get("/api/check", self._params(key), expect_errors=True)
+        assert resp.status_code == 400
+        resp = testapp.post("/api/activate", self._params(key), expect_errors=True)
+        assert resp.status_code == 400
+        assert testapp.get("/api/appid", {"token": key.token}).json["app_id"] == key.app_id
+
+
+@pytest.mark.usefixtures('db')
+class TestClaimKey:
+    """/api/claim"""
+
+    def _claim(self, testapp, app_id, email):
+        return testapp.post("/api/claim", {"app_id": app_id, "email": email},
+                            headers={"X-Api-Key": "claim-secret"}, expect_errors=True)
+
+    def test_claim(self, app, testapp, key):
+        app.config["CLAIM_API_KEY"] = "claim-secret"
+        resp = self._claim(testapp, key.app_id, "a@example.com")
+        assert resp.status_code == 201
+        assert resp.json["token"].replace("-", "") == key.token
+        assert self._claim(testapp, key.app_id, "a@example.com").json["already_claimed"]
+        assert self._claim(testapp, key.app_id, "b@example.com").status_code == 410
+        assert Key.query.get(key.id).memo == "early-tester: a@example.com"
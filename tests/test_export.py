@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+"""Export tests."""
+import csv
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytest
+
+from keyserv.export import export_query, stream
+from keyserv.keymanager import rand_token
+from keyserv.models import Activation, Application, AuditLog, Event, Key
+
+from tests import fake
+
+
+@pytest.mark.usefixtures('db')
+class TestExport:
+    """CSV and NDJSON exports streamed in batches."""
+
+    @pytest.fixture(autouse=True)
+    def rows(self, db):
+        start = datetime(2026, 1, 1)
+        self.apps = [Application(name=fake.word() + str(n)).save() for n in range(2)]
+        self.app_ids = [application.id for application in self.apps]
+        self.names = [application.name for application in self.apps]
+        for n in range(10):
+            key = Key(token=rand_token(), remaining=1, app_id=self.app_ids[n % 2])
+            key.save(commit=False)
+            key.cutdate = start + timedelta(days=n)
+            db.session.flush()
+            activation = Activation(key.id, hwid=f"hw-{n}").save(commit=False)
+            activation.activation_ts = start + timedelta(days=n)
+            log = AuditLog(key.id, key.app_id, f"log {n}",
+                           Event.KeyAccess if n % 2 else Event.AppActivation)
+            log.timestamp = start + timedelta(days=n)
+            log.save(commit=False)
+        db.session.commit()
+
+    def _csv(self, query, **kwargs):
+        return list(csv.DictReader(io.StringIO("".join(stream(query, **kwargs)))))
+
+    def test_csv(self):
+        rows = self._csv(export_query("keys"))
+        assert len(rows) == 10
+        assert list(rows[0])[:4] == ["id", "token", "app_id", "app_name"]
+        assert rows[0]["cutdate"] == "2026-01-01T00:00:00"
+        assert [row["app_name"] for row in rows[:2]] == self.names
+
+    def test_ndjson(self):
+        text = "".join(stream(export_query("logs"), "ndjson"))
+        rows = [json.loads(line) for line in text.splitlines()]
+        assert [row["message"] for row in rows] == [f"log {n}" for n in range(10)]
+        assert rows[0]["event"] == "AppActivation"
+        assert rows[1]["event_type"] == int(Event.KeyAccess)
+
+    def test_formulas_are_escaped(self, db):
+        for memo in ("=HYPERLINK(\"http://x\")", "+1", "-1", "@SUM(A1)", "\tx", "plain"):
+            Key(token=rand_token(), remaining=-1, app_id=self.app_ids[0],
+                memo=memo).save(commit=False)
+        db.session.commit()
+        rows = self._csv(export_query("keys"))[10:]
+        assert [row["memo"] for row in rows] == ["'=HYPERLINK(\"http://x\")", "'+1", "'-1",
+                                                 "'@SUM(A1)", "'\tx", "plain"]
+        assert rows[0]["remaining"] == "-1"
+        text = "".join(stream(export_query("keys"), "ndjson"))
+        rows = [json.loads(line) for line in text.splitlines()]
+        assert rows[10]["memo"] == "=HYPERLINK(\"http://x\")"
+
+    def test_key_filters(self, db):
+        keys = Key.query.order_by(Key.id).all()
+        keys[1].enabled = False
+        keys[2].claimed_by = "someone"
+        keys[3].valid_until = datetime(2000, 1, 1)
+        db.session.commit()
+        ids = [key.id for key in keys]
+
+        def exported(**filters):
+            return [int(row["id"]) for row in self._csv(export_query("keys", **filters))]
+
+        assert exported(enabled=False) == [ids[1]]
+        assert exported(claimed=True) == [ids[2]]
+        assert exported(expired=True) == [ids[3]]
+        assert exported(enabled=True, claimed=False, expired=False) == ids[:1] + ids[4:]
+        with pytest.raises(ValueError):
+            export_query("logs", claimed=True)
+
+    def test_chunks(self):
+        chunks = list(stream(export_query("activations"), batch_size=3))
+        # the header rides with the first batch, the last chunk has the one row left over
+        assert len(chunks) == 4
+        assert chunks[-1].count("\n") == 1
+
+    def test_filters(self):
+        rows = self._csv(export_query("activations", app_id=self.app_ids[1],
+                                      since=datetime(2026, 1, 3), until=datetime(2026, 1, 8)))
+        # row n is dated day n + 1 of January
+        assert [row["hwid"] for row in rows] == ["hw-3", "hw-5"]
+        rows = self._csv(export_query("logs", event_type=Event.AppActivation,
+                                      until=datetime(2026, 1, 6)))
+        assert [row["message"] for row in rows] == ["log 0", "log 2", "log 4"]
+
+        with pytest.raises(ValueError):
+            export_query("keys", event_type=Event.KeyAccess)
+        with pytest.raises(ValueError):
+            export_query("users")
+
+    def test_endpoint(self, app, testapp):
+        app.config["LOGIN_DISABLED"] = True
+        resp = testapp.get("/export/logs.ndjson", {"app": self.app_ids[0],
+                                                   "event": int(Event.AppActivation),
+                                                   "since": "2026-01-04 00:00"})
+        assert resp.content_type == "application/x-ndjson"
+        assert "attachment" in resp.headers["Content-Disposition"]
+        messages = [json.loads(line)["message"] for line in resp.text.splitlines()]
+        assert messages == ["log 4", "log 6", "log 8"]
+
+        resp = testapp.get("/export/keys.csv", {"app": self.app_ids[0], "enabled": "yes",
+                                                "expiry": "valid"})
+        assert len(list(csv.DictReader(io.StringIO(resp.text)))) == 5
+        assert testapp.get("/export/keys.xml", expect_errors=True).status_code == 404
+        assert testapp.get("/export/keys.csv", {"event": 7}, expect_errors=True).status_code == 400
+        resp = testapp.get("/export/logs.csv", {"since": "soon"}, expect_errors=True)
+        assert resp.status_code == 400
+
+    def test_cli(self, app):
+        result = app.test_cli_runner().invoke(args=["export", "keys", "--app", self.names[0],
+                                                    "--since", "2026-01-05"])
+        assert result.exit_code == 0, result.output
+        rows = list(csv.DictReader(io.StringIO(result.output)))
+        assert [row["cutdate"][:10] for row in rows] == ["2026-01-05", "2026-01-07", "2026-01-09"]
+
+        result = app.test_cli_runner().invoke(args=["export", "activations",
+                                                    "--event", "KeyAccess"])
+        assert result.exit_code != 0
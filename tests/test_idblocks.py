@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Id block allocator tests."""
+import threading
+
+import pytest
+
+from keyserv.idblocks import id_blocks
+from keyserv.keymanager import rand_token
+from keyserv.models import Activation, Application, AuditLog, Event, IdBlock, Key, db
+from keyserv.uuidgenerator import UUIDGenerator
+
+from tests import fake
+
+
+def _key():
+    application = Application(name=fake.word(), support_message=fake.sentence()).save()
+    return Key(token=rand_token(), remaining=5, app_id=application.id).save()
+
+
+@pytest.mark.usefixtures('db')
+class TestIdBlocks:
+    """Ids and uuids assigned before the INSERT."""
+
+    def test_uuid_in_insert(self, statements):
+        key = _key()
+        assert UUIDGenerator.uuid_to_int(key.uuid) == key.id
+        assert not [s for s in statements.statements if s.startswith("UPDATE key") or
+                    s.startswith('UPDATE "key"')]
+
+    def test_bulk_insert_is_one_statement(self, statements):
+        key = _key()
+        key_id, app_id = key.id, key.app_id
+        for n in range(50):
+            AuditLog(key_id, app_id, f"log {n}", Event.KeyAccess).save(commit=False)
+            Activation(key_id, hwid=f"hw-{n}").save(commit=False)
+        statements.reset()
+        db.session.commit()
+
+        # besides reserving the id blocks, one executemany INSERT per table
+        written = [s.split("(")[0] for s in statements.statements
+                   if "id_block" not in s and not s.startswith("SELECT")]
+        assert sorted(written) == ["INSERT INTO activation ", "INSERT INTO audit_log "]
+        logs = AuditLog.query.all()
+        assert len({log.id for log in logs}) == 50
+        assert all(UUIDGenerator.uuid_to_int(log.uuid) == log.id for log in logs)
+
+    def test_seeded_from_existing_rows(self, app):
+        key = _key()
+        db.session.execute(AuditLog.__table__.insert().values(
+            id=500, key_id=key.id, app_id=key.app_id, message="imported"))
+        db.session.commit()
+        id_blocks.init_app(app)
+        db.session.query(IdBlock).delete()
+        db.session.commit()
+
+        AuditLog.from_key(key, "new", Event.KeyAccess)
+        assert AuditLog.query.filter_by(message="new").one().id == 501
+
+    def test_rollback_gives_block_back(self, app):
+        app.config["ID_BLOCK_SIZE"] = 10
+        id_blocks.init_app(app)
+        key = _key()
+        AuditLog(key.id, key.app_id, "rolled back", Event.KeyAccess).save(commit=False)
+        db.session.flush()
+        db.session.rollback()
+        assert IdBlock.query.get("audit_log") is None
+
+        AuditLog.from_key(key, "kept", Event.KeyAccess)
+        assert IdBlock.query.get("audit_log").next_id == 11
+        assert AuditLog.query.one().id == 1
+
+    def test_core_rows(self):
+        key = _key()
+        rows = [{"key_id": key.id, "app_id": key.app_id, "message": str(n)} for n in range(3)]
+        db.session.execute(AuditLog.__table__.insert(),
+                           id_blocks.assign(db.session.connection(), AuditLog.__table__, rows))
+        AuditLog.from_key(key, "orm", Event.KeyAccess)
+        ids = sorted(log.id for log in AuditLog.query)
+        assert len(set(ids)) == 4
+        assert all(UUIDGenerator.uuid_to_int(log.uuid) == log.id for log in AuditLog.query)
+
+
+def test_threads_share_no_ids(file_app):
+    file_app.config["ID_BLOCK_SIZE"] = 5
+    id_blocks.init_app(file_app)
+    with file_app.app_context():
+        key = _key()
+        key_id, app_id = key.id, key.app_id
+
+    errors = []
+
+    def writer():
+        with file_app.app_context():
+            try:
+                for n in range(20):
+                    AuditLog(key_id, app_id, str(n), Event.KeyAccess).save()
+            except Exception as error:
+                errors.append(error)
+            db.session.remove()
+
+    workers = [threading.Thread(target=writer) for _ in range(8)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert not errors
+    with file_app.app_context():
+        assert AuditLog.query.count() == 160
@@ -0,0 +1,373 @@
+# -*- coding: utf-8 -*-
+"""Key manager unit tests."""
+import datetime as dt
+import json
+import threading
+
+import pytest
+from cryptography.exceptions import InvalidSignature
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+
+from keyserv.keymanager import (ExhaustedActivations, InvalidReceipt, Origin, activate_key,
+                                backfill_token_digests, check_key, check_keys_bulk, claim_key,
+                                cut_keys, disable_key_unsafe, find_activation, find_key_const,
+                                generate_token_unsafe, key_exists_const, key_valid_const,
+                                new_receipt_key, rand_token, receipt_public_keys, sign_receipt,
+                                token_matches_hwid, verify_receipt, TokenSpaceExhausted,
+                                _b64decode)
+from keyserv.models import Activation, Application, AuditLog, Event, Key, db, token_digest
+from keyserv.tokens import TokenGenerator
+from keyserv.verdictcache import verdict_cache
+
+from tests import fake
+
+
+def _application():
+    return Application(name=fake.word() + rand_token()[:5], support_message=fake.sentence()).save()
+
+
+def _key(application, **kwargs):
+    return Key(token=rand_token(), remaining=5, app_id=application.id, **kwargs).save()
+
+
+def _origin():
+    return Origin(fake.ipv4(), fake.word(), fake.user_name(), fake.mac_address())
+
+
+@pytest.mark.usefixtures('db')
+class TestTokenLookup:
+    """Lookups by the indexed token digest."""
+
+    def test_digest_set_on_insert(self):
+        key = _key(_application())
+        assert key.token_digest == token_digest(key.token)
+
+    def test_find_key(self):
+        application = _application()
+        key = _key(application)
+        assert find_key_const(application.id, key.token) == key
+        assert find_key_const(application.id, rand_token()) is None
+
+    def test_find_key_checks_app_and_enabled(self):
+        application = _application()
+        key = _key(application)
+        assert find_key_const(_application().id, key.token) is None
+        key.enabled = False
+        db.session.commit()
+        assert find_key_const(application.id, key.token) is None
+
+    def test_checks_are_recorded(self):
+        application = _application()
+        key = _key(application)
+        origin = _origin()
+        assert key_exists_const(application.id, key.token, origin)
+        assert key_valid_const(application.id, key.token, origin) == key
+        assert key.total_checks == 2
+        assert key.last_check_ip == origin.ip
+        assert not key_valid_const(application.id, rand_token(), origin)
+
+    def test_backfill(self):
+        application = _application()
+        keys = [_key(application) for _ in range(5)]
+        db.session.execute(Key.__table__.update().values(token_digest=None))
+        db.session.commit()
+
+        assert backfill_token_digests(batch_size=2) == 5
+        assert backfill_token_digests(batch_size=2) == 0
+        for key in keys:
+            db.session.refresh(key)
+            assert key.token_digest == token_digest(key.token)
+        assert backfill_token_digests(recompute=True) == 5
+
+
+@pytest.mark.usefixtures('db')
+class TestCheckKey:
+    """Cached check verdicts."""
+
+    def test_verdict_is_cached(self):
+        application = _application()
+        key = _key(application)
+        origin = _origin()
+        verdict = check_key(application.id, key.token, origin)
+        assert verdict.key_id == key.id
+        assert verdict.remaining == 5
+        assert check_key(application.id, key.token, origin) == verdict
+        assert key.total_checks == 1
+        assert check_key(application.id, rand_token(), origin) is None
+
+    def test_disable_invalidates(self):
+        application = _application()
+        key = _key(application)
+        origin = _origin()
+        assert check_key(application.id, key.token, origin)
+        disable_key_unsafe(key.token)
+        assert check_key(application.id, key.token, origin) is None
+        assert verdict_cache.stats()["size"] == 0
+
+    def test_version_tracks_check_fields(self):
+        key = _key(_application())
+        assert key.version == 1
+        key_valid_const(key.app_id, key.token, _origin())
+        assert key.version == 1
+        key.memo = "not part of a check"
+        db.session.commit()
+        assert key.version == 1
+        key.remaining = 4
+        db.session.commit()
+        assert key.version == 2
+
+    def test_bulk_matches_single(self):
+        application = _application()
+        keys = [_key(application) for _ in range(3)]
+        origin = _origin()
+        checks = [(application.id, key.token, origin, None) for key in keys]
+        checks.append((application.id, rand_token(), origin, None))
+
+        verdicts = check_keys_bulk(checks)
+        assert [v and v.key_id for v in verdicts] == [key.id for key in keys] + [None]
+        verdict_cache.configure(verdict_cache.size, verdict_cache.ttl)
+        assert [check_key(*check) for check in checks] == verdicts
+
+    def test_live_activation_wins(self):
+        key = _key(_application())
+        origin = _origin()
+        Activation(key.id, kunin_employee_id=9, expiry_date="-1", hwid=origin.hwid).save()
+        live = Activation(key.id, kunin_employee_id=9, expiry_date="30", hwid=origin.hwid).save()
+        Activation(key.id, kunin_employee_id=9, expiry_date="60", hwid="other").save()
+
+        assert find_activation(key.id, 9, origin.hwid) == live
+        assert find_activation(key.id, 10, origin.hwid) is None
+        verdict = check_key(key.app_id, key.token, origin, 9)
+        assert verdict.activation_valid_until == live.valid_until
+        verdict_cache.configure(verdict_cache.size, verdict_cache.ttl)
+        assert check_keys_bulk([(key.app_id, key.token, origin, 9)]) == [verdict]
+
+    def test_token_matches_hwid(self):
+        key = _key(_application())
+        Activation(key.id, hwid="aa:bb").save()
+        assert token_matches_hwid(key.token, "aa:bb")
+        assert not token_matches_hwid(key.token, "cc:dd")
+        assert not token_matches_hwid(rand_token(), "aa:bb")
+
+
+class TestConcurrentActivation:
+    """Activations racing for the same key."""
+    threads = 8
+    attempts = 10
+
+    def _race(self, app, remaining: int) -> tuple:
+        with app.app_context():
+            key = _key(_application())
+            key.remaining = remaining
+            db.session.commit()
+            app_id, token, key_id = key.app_id, key.token, key.id
+
+        outcomes, errors = [], []
+
+        def activate(thread: int):
+            with app.app_context():
+                for attempt in range(self.attempts):
+                    origin = Origin(fake.ipv4(), "machine", "user", f"hw-{thread}-{attempt}")
+                    try:
+                        activate_key(app_id, token, origin)
+                        outcomes.append(True)
+                    except ExhaustedActivations:
+                        outcomes.append(False)
+                    except Exception as error:
+                        errors.append(error)
+                db.session.remove()
+
+        workers = [threading.Thread(target=activate, args=(n,)) for n in range(self.threads)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        assert not errors
+
+        with app.app_context():
+            activations = Activation.query.filter_by(key_id=key_id).count()
+            return outcomes.count(True), Key.query.get(key_id), activations
+
+    def test_no_overdraft(self, file_app):
+        activated, key, activations = self._race(file_app, 25)
+        assert activated == 25
+        assert activations == 25
+        assert key.remaining == 0
+        assert key.total_activations == 25
+
+    def test_unlimited_loses_nothing(self, file_app):
+        activated, key, activations = self._race(file_app, -1)
+        assert activated == activations == self.threads * self.attempts
+        assert key.remaining == -1
+        assert key.total_activations == self.threads * self.attempts
+
+
+@pytest.mark.usefixtures('db')
+class TestClaimKey:
+    """Claims from the unclaimed key pool."""
+
+    def test_claims_in_order(self):
+        application = _application()
+        _key(application, enabled=False)
+        exhausted = _key(application)
+        exhausted.remaining = 0
+        first, second = _key(application), _key(application)
+
+        key = claim_key(application.id, "a@example.com", "memo")
+        assert key == first
+        assert key.claimed_by == "a@example.com"
+        assert key.claimed_at is not None
+        assert claim_key(application.id, "b@example.com", "memo") == second
+        assert claim_key(application.id, "c@example.com", "memo") is None
+        assert claim_key(_application().id, "c@example.com", "memo") is None
+
+    def test_concurrent_claims_are_distinct(self, file_app):
+        with file_app.app_context():
+            application = _application()
+            app_id = application.id
+            for _ in range(30):
+                _key(application)
+
+        claims, errors = [], []
+
+        def claim(thread: int):
+            with file_app.app_context():
+                for attempt in range(5):
+                    try:
+                        key = claim_key(app_id, f"{thread}-{attempt}@example.com", "memo")
+                        claims.append(key.id if key else None)
+                    except Exception as error:
+                        errors.append(error)
+                db.session.remove()
+
+        workers = [threading.Thread(target=claim, args=(n,)) for n in range(10)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        assert not errors
+        claimed = [key_id for key_id in claims if key_id]
+        assert len(claimed) == len(set(claimed)) == 30
+        with file_app.app_context():
+            assert Key.query.filter(Key.claimed_by.is_(None)).count() == 0
+
+
+@pytest.mark.usefixtures('db')
+class TestCutKeys:
+    """Bulk key cutting."""
+
+    def test_cut_keys(self, statements):
+        application = _application()
+        cut = list(cut_keys(application.id, 120, 3, ttl=10, memo="partner", chunk_size=50))
+        assert len(cut) == len({token for _, token, _ in cut}) == 120
+
+        keys = Key.query.filter_by(app_id=application.id).all()
+        assert len(keys) == 120
+        key = keys[0]
+        assert (key.remaining, key.memo, key.ttl, key.version) == (3, "partner", 10, 1)
+        assert key.token_digest == token_digest(key.token)
+        assert key.valid_until - key.cutdate == dt.timedelta(days=10)
+        assert AuditLog.query.filter_by(event_type=int(Event.KeyCreated)).count() == 120
+        inserts = [s for s in statements.statements if s.startswith('INSERT INTO "key"')]
+        assert len(inserts) == 3
+
+    def test_duplicates_are_replaced(self, monkeypatch):
+        application = _application()
+        existing = _key(application)
+        tokens = iter([existing.token, "A" * 25, "A" * 25, "B" * 25] +
+                      [rand_token() for _ in range(10)])
+        monkeypatch.setattr("keyserv.tokens.TokenGenerator.tokens",
+                            lambda self, count: [next(tokens) for _ in range(count)])
+
+        cut = [token for _, token, _ in cut_keys(application.id, 4, 1, chunk_size=2)]
+        assert cut[:2] == ["A" * 25, "B" * 25]
+        assert existing.token not in cut
+        assert Key.query.filter_by(app_id=application.id).count() == 5
+
+    def test_cli(self, app):
+        application = _application()
+        result = app.test_cli_runner().invoke(args=["cut-keys", "--app", application.name,
+                                                    "--count", "3", "--activations", "-1",
+                                                    "--format", "ndjson"])
+        assert result.exit_code == 0, result.output
+        rows = [json.loads(line) for line in result.output.splitlines() if line.startswith("{")]
+        assert [Key.query.get(row["id"]).token for row in rows] == [row["token"] for row in rows]
+        assert Key.query.get(rows[0]["id"]).remaining == -1
+
+        result = app.test_cli_runner().invoke(args=["cut-keys", "--app", "missing", "--count", "1"])
+        assert result.exit_code == 2
+
+    def test_application_token_format(self):
+        application = _application()
+        application.token_length = 64
+        application.token_alphabet = "ABC"
+        db.session.commit()
+        tokens = [token for _, token, _ in cut_keys(application.id, 20, 1)]
+        assert all(len(token) == 64 and set(token) <= set("ABC") for token in tokens)
+
+    def test_token_space_exhausted(self, monkeypatch):
+        application = _application()
+        token = generate_token_unsafe(application)
+        Key(token=token, remaining=1, app_id=application.id).save()
+        monkeypatch.setattr(TokenGenerator, "tokens", lambda self, count: [token] * count)
+        with pytest.raises(TokenSpaceExhausted):
+            generate_token_unsafe(application)
+        with pytest.raises(TokenSpaceExhausted):
+            list(cut_keys(application.id, 2, 1))
+
+
+class TestReceipts:
+    """Signed offline receipts."""
+
+    def _receipt(self, **kwargs):
+        valid_until = dt.datetime.utcnow().replace(microsecond=0) + dt.timedelta(hours=1)
+        return sign_receipt(kwargs.get("key_id", 7), "aa:bb", 42,
+                            kwargs.get("valid_until", valid_until))
+
+    def test_round_trip(self, app):
+        receipt = verify_receipt(self._receipt())
+        assert receipt.key_id == 7
+        assert receipt.hwid == "aa:bb"
+        assert receipt.kunin_employee_id == 42
+        assert receipt.valid_until > dt.datetime.utcnow()
+
+    def test_tampered(self, app):
+        key_name, payload, signature = self._receipt().split(".")
+        forged = self._receipt(key_id=8).split(".")[1]
+        with pytest.raises(InvalidReceipt):
+            verify_receipt(f"{key_name}.{forged}.{signature}")
+        with pytest.raises(InvalidReceipt):
+            verify_receipt(f"{key_name}.{payload}")
+        with pytest.raises(InvalidReceipt):
+            verify_receipt(f"{key_name}.{payload}.{signature[:-4]}")
+
+    def test_expired(self, app):
+        with pytest.raises(InvalidReceipt):
+            expired = dt.datetime.utcnow() - dt.timedelta(seconds=5)
+            verify_receipt(self._receipt(valid_until=expired))
+
+    def test_public_key(self, app):
+        # what a client holding only the public key does
+        key_name, payload, signature = self._receipt().split(".")
+        public_key = Ed25519PublicKey.from_public_bytes(_b64decode(receipt_public_keys()[key_name]))
+        public_key.verify(_b64decode(signature), f"{key_name}.{payload}".encode())
+        with pytest.raises(InvalidSignature):
+            public_key.verify(_b64decode(signature), f"{key_name}.{payload}x".encode())
+
+    def test_rotation(self, app):
+        receipt = self._receipt()
+        retired = receipt_public_keys()["test"]
+        private_key, public_key = new_receipt_key()
+        app.config["RECEIPT_KEYS"] = {**app.config["RECEIPT_KEYS"], "next": private_key}
+        app.config["RECEIPT_KEY_ID"] = "next"
+        assert self._receipt().startswith("next.")
+        assert receipt_public_keys()["next"] == public_key
+        assert verify_receipt(receipt).key_id == 7
+
+        app.config["RECEIPT_KEYS"] = {"next": private_key}
+        app.config["RECEIPT_PUBLIC_KEYS"] = {"test": retired}
+        assert verify_receipt(receipt).key_id == 7
+        app.config["RECEIPT_PUBLIC_KEYS"] = {}
+        with pytest.raises(InvalidReceipt):
+            verify_receipt(receipt)
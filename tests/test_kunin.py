@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+"""Kunin API client tests."""
+import datetime as dt
+import time
+
+import pytest
+
+from keyserv.keymanager import rand_token
+from keyserv.kunin import KuninUnavailable, kunin_client
+from keyserv.models import (Activation, Application, AuditLog, Event, Key, KuninEmployee,
+                            ProvisioningJob, ProvisioningStatus, db, open_password)
+from keyserv.provisioning import provisioning
+
+from tests import fake
+
+
+def _configure(app, **config):
+    app.config.update(**config)
+    kunin_client.init_app(app)
+
+
+class TestKuninClient:
+    """Pooled client with timeouts and a circuit breaker."""
+
+    def test_register_reuses_connection(self, kunin):
+        for _ in range(5):
+            resp = kunin_client.register(fake.email(), "secret", 7)
+            assert resp.status_code == 201
+            assert resp.json()["user"]["kunin_employee_id"]
+        email = kunin.calls[0][1]["user"]["email"]
+        assert kunin.calls[0] == ("/api/v1/users", {"user": {"email": email, "password": "secret",
+                                                             "client_id": 7}})
+        assert len(kunin.connections) == 1
+        assert kunin_client.stats()["requests"] == 5
+
+    def test_read_timeout_is_not_retried(self, app, kunin):
+        _configure(app, KUNIN_READ_TIMEOUT=0.1)
+        kunin.delay = 0.5
+        with pytest.raises(KuninUnavailable):
+            kunin_client.login(fake.email(), "secret")
+        assert len(kunin.calls) == 1
+        assert kunin_client.stats()["failures"] == 1
+
+    def test_deadline(self, kunin):
+        with pytest.raises(KuninUnavailable):
+            kunin_client.register(fake.email(), "secret", 7, deadline=time.monotonic() - 1)
+        assert not kunin.calls
+
+    def test_breaker(self, app, kunin):
+        _configure(app, KUNIN_BREAKER_THRESHOLD=2, KUNIN_BREAKER_RESET=0.2)
+        kunin.responses["/api/v1/users"] = (502, {})
+        for _ in range(3):
+            with pytest.raises(KuninUnavailable):
+                kunin_client.register(fake.email(), "secret", 7)
+        assert len(kunin.calls) == 2
+        assert kunin_client.stats()["breaker_open"]
+        assert kunin_client.stats()["short_circuited"] == 1
+
+        time.sleep(0.25)
+        del kunin.responses["/api/v1/users"]
+        assert kunin_client.register(fake.email(), "secret", 7).status_code == 201
+        assert not kunin_client.stats()["breaker_open"]
+
+
+@pytest.mark.usefixtures('db')
+class TestKuninActivation:
+    """/api/activate of keys cut for a Kunin client."""
+
+    def _activate(self, testapp, key, email=None, password="secret"):
+        return testapp.post("/api/activate", {"token": key.token, "app_id": key.app_id,
+                                              "machine": "m", "user": "u",
+                                              "hwid": fake.mac_address(),
+                                              "email": email or fake.email(), "password": password},
+                            expect_errors=True)
+
+    def _key(self):
+        application = Application(name=fake.word(), support_message=fake.sentence()).save()
+        return Key(token=rand_token(), remaining=3, app_id=application.id, kunin_client_id=7).save()
+
+    def test_registered(self, testapp, kunin):
+        key = self._key()
+        resp = self._activate(testapp, key)
+        assert resp.status_code == 201
+        assert resp.json["kunin_employee_id"] == 1000
+        assert Activation.query.one().kunin_employee_id == 1000
+
+    def test_existing_user_logs_in(self, testapp, kunin):
+        kunin.responses["/api/v1/users"] = (409, {})
+        kunin.responses["/api/v1/users/login"] = (200, {"user": {"kunin_employee_id": 55}})
+        resp = self._activate(testapp, self._key())
+        assert resp.status_code == 201
+        assert resp.json["kunin_employee_id"] == 55
+        assert "client_id" not in kunin.calls[1][1]["user"]
+
+    def test_known_user_skips_kunin(self, testapp, kunin):
+        key = self._key()
+        assert self._activate(testapp, key, "A@example.com").json["kunin_employee_id"] == 1000
+        assert len(kunin.calls) == 1
+        entry = KuninEmployee.query.one()
+        assert "example" not in entry.email_digest + entry.password_hash
+
+        resp = self._activate(testapp, key, "a@example.com")
+        assert resp.json["kunin_employee_id"] == 1000
+        assert len(kunin.calls) == 1
+
+        self._activate(testapp, key, "a@example.com", password="guess")
+        assert len(kunin.calls) == 2
+
+    def test_known_user_expires(self, testapp, kunin):
+        key = self._key()
+        self._activate(testapp, key, "a@example.com")
+        KuninEmployee.query.one().expires_at = dt.datetime.utcnow()
+        db.session.commit()
+        self._activate(testapp, key, "a@example.com")
+        assert len(kunin.calls) == 2
+        assert KuninEmployee.query.count() == 1
+
+    def test_server_error(self, testapp, kunin):
+        kunin.responses["/api/v1/users"] = (500, "<html>oops</html>")
+        key = self._key()
+        resp = self._activate(testapp, key)
+        assert resp.status_code == 503
+        assert [path for path, _ in kunin.calls] == ["/api/v1/users"]
+        assert Activation.query.count() == 0
+        assert Key.query.get(key.id).remaining == 3
+
+    def test_unavailable(self, app, testapp, kunin):
+        _configure(app, KUNIN_READ_TIMEOUT=0.1)
+        kunin.delay = 0.5
+        key = self._key()
+        resp = self._activate(testapp, key)
+        assert resp.status_code == 503
+        assert Activation.query.count() == 0
+        assert Key.query.get(key.id).remaining == 3
+        assert AuditLog.query.filter_by(event_type=int(Event.FailedActivation)).count() == 1
+
+
+@pytest.mark.usefixtures('db')
+class TestAsyncProvisioning:
+    """Kunin registration through the provisioning outbox."""
+
+    @pytest.fixture(autouse=True)
+    def outbox(self, app, kunin):
+        _configure(app, KUNIN_ASYNC_PROVISIONING=True, PROVISIONING_CONCURRENCY=1,
+                   PROVISIONING_INTERVAL=0.01, PROVISIONING_MAX_ATTEMPTS=2, KUNIN_READ_TIMEOUT=0.1)
+        provisioning.init_app(app)
+
+    def _key(self):
+        application = Application(name=fake.word(), support_message=fake.sentence()).save()
+        return Key(token=rand_token(), remaining=2, app_id=application.id, kunin_client_id=7).save()
+
+    def _activate(self, testapp, key, hwid="aa:bb"):
+        return testapp.post("/api/activate", {"token": key.token, "app_id": key.app_id,
+                                              "machine": "m", "user": "u", "hwid": hwid,
+                                              "email": "a@example.com", "password": "secret"})
+
+    def _check(self, testapp, key, hwid="aa:bb"):
+        return testapp.get("/api/check", {"token": key.token, "app_id": key.app_id, "machine": "m",
+                                          "user": "u", "hwid": hwid})
+
+    def test_pending_then_resolved(self, testapp, kunin):
+        key = self._key()
+        resp = self._activate(testapp, key)
+        assert resp.status_code == 201
+        assert resp.json["provisioning"] == "pending"
+        assert resp.json["kunin_employee_id"] is None
+        assert not kunin.calls
+        etag = self._check(testapp, key).headers["ETag"]
+        assert self._check(testapp, key).json["provisioning"] == "pending"
+
+        assert provisioning.drain() == 1
+        db.session.expire_all()
+        job = ProvisioningJob.query.one()
+        assert job.status == ProvisioningStatus.Done
+        assert job.password is None
+        assert Activation.query.one().kunin_employee_id == 1000
+
+        resp = testapp.get("/api/check", {"token": key.token, "app_id": key.app_id, "machine": "m",
+                                          "user": "u", "hwid": "aa:bb"},
+                           headers={"If-None-Match": etag})
+        assert resp.status_code == 201
+        assert resp.json["kunin_employee_id"] == 1000
+        assert resp.json["provisioning"] == "done"
+
+    def test_refused_gives_slot_back(self, testapp, kunin):
+        kunin.responses["/api/v1/users"] = (409, {})
+        key = self._key()
+        self._activate(testapp, key)
+        assert Key.query.get(key.id).remaining == 1
+
+        provisioning.drain()
+        db.session.expire_all()
+        assert ProvisioningJob.query.one().status == ProvisioningStatus.Failed
+        assert Key.query.get(key.id).remaining == 2
+        assert Activation.query.one().valid_until <= dt.datetime.utcnow()
+        assert AuditLog.query.filter_by(event_type=int(Event.FailedActivation)).count() == 1
+
+    def test_unavailable_is_retried(self, testapp, kunin):
+        kunin.delay = 0.5
+        key = self._key()
+        self._activate(testapp, key)
+
+        provisioning.drain()
+        db.session.expire_all()
+        job = ProvisioningJob.query.one()
+        assert job.status == ProvisioningStatus.Pending
+        assert job.attempts == 1
+        assert "secret" not in job.password
+        assert open_password(job.password) == "secret"
+
+        kunin.delay = 0
+        job.next_attempt_at = dt.datetime.utcnow()
+        db.session.commit()
+        assert provisioning.drain() == 1
+        db.session.expire_all()
+        assert ProvisioningJob.query.one().status == ProvisioningStatus.Done
+
+    def test_error_is_retried_then_failed(self, testapp, kunin):
+        kunin.responses["/api/v1/users"] = (201, {})
+        key = self._key()
+        self._activate(testapp, key)
+
+        provisioning.drain()
+        db.session.expire_all()
+        job = ProvisioningJob.query.one()
+        assert job.status == ProvisioningStatus.Pending
+        assert job.last_error.startswith("KeyError")
+        assert job.password
+
+        job.next_attempt_at = dt.datetime.utcnow()
+        db.session.commit()
+        provisioning.drain()
+        db.session.expire_all()
+        job = ProvisioningJob.query.one()
+        assert job.status == ProvisioningStatus.Failed
+        assert job.attempts == 2
+        assert job.password is None
+        assert Key.query.get(key.id).remaining == 2
+        assert Activation.query.one().valid_until <= dt.datetime.utcnow()
+
+    def test_server_error_is_retried(self, testapp, kunin):
+        kunin.responses["/api/v1/users"] = (500, {})
+        key = self._key()
+        self._activate(testapp, key)
+
+        provisioning.drain()
+        db.session.expire_all()
+        job = ProvisioningJob.query.one()
+        assert job.status == ProvisioningStatus.Pending
+        assert "500" in job.last_error
+        assert Activation.query.one().valid_until > dt.datetime.utcnow()
+        assert Key.query.get(key.id).remaining == 1
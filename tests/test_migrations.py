@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Migration tests."""
+import sqlite3
+from pathlib import Path
+
+import pytest
+from flask_migrate import upgrade
+from webtest import TestApp
+
+from keyserv.models import db, open_password, seal_password, token_digest
+
+BASELINE_SCHEMA = Path(__file__).with_name("baseline_schema.sql")
+
+
+@pytest.fixture
+def baseline_app(file_app):
+    """`file_app` on a database from before the migrations, with one key."""
+    path = file_app.config["SQLALCHEMY_DATABASE_URI"][len("sqlite:///"):]
+    with file_app.app_context():
+        db.drop_all()
+    with sqlite3.connect(path) as conn:
+        conn.executescript(BASELINE_SCHEMA.read_text())
+        conn.execute("INSERT INTO application (id, name) VALUES (1, 'app')")
+        conn.execute('INSERT INTO "key" (id, app_id, token, enabled, remaining, total_activations, '
+                     "total_checks) VALUES (1, 1, 'BASELINE', 1, -1, 0, 0)")
+    conn.close()
+    return file_app
+
+
+def test_token_digest(file_app):
+    with file_app.app_context():
+        # a key table from before token digests
+        db.session.execute("DROP INDEX ix_key_token_digest")
+        db.session.execute('ALTER TABLE "key" DROP COLUMN token_digest')
+        db.session.execute("INSERT INTO application (id, name, token_app_prefix) "
+                           "VALUES (1, 'app', 0)")
+        for key_id in range(1, 4):
+            db.session.execute('INSERT INTO "key" (id, app_id, token, version) '
+                               "VALUES (:id, 1, :token, 1)",
+                               {"id": key_id, "token": f"TOKEN{key_id}"})
+        db.session.commit()
+        db.session.remove()
+
+        upgrade()
+        rows = db.session.execute('SELECT token, token_digest FROM "key" ORDER BY id').fetchall()
+        assert [digest for _, digest in rows] == [token_digest(token) for token, _ in rows]
+        indexes = db.session.execute("SELECT name FROM sqlite_master "
+                                     "WHERE type = 'index'").fetchall()
+        assert ("ix_key_token_digest",) in indexes
+
+
+def test_provisioning_passwords(file_app):
+    with file_app.app_context():
+        db.session.execute("INSERT INTO application (id, name, token_app_prefix) "
+                           "VALUES (1, 'app', 0)")
+        db.session.execute('INSERT INTO "key" (id, app_id, token, version) '
+                           "VALUES (1, 1, :token, 1)", {"token": "TOKEN"})
+        db.session.execute("INSERT INTO activation (id, key_id) VALUES (1, 1)")
+        for job_id, password in enumerate(("plain", seal_password("sealed"), None), 1):
+            db.session.execute("INSERT INTO provisioning_job (id, key_id, activation_id, "
+                               "kunin_client_id, status, attempts, password) "
+                               "VALUES (:id, 1, 1, 7, 0, 0, :password)",
+                               {"id": job_id, "password": password})
+        db.session.commit()
+        db.session.remove()
+
+        upgrade()
+        rows = db.session.execute("SELECT password FROM provisioning_job ORDER BY id").fetchall()
+        assert "plain" not in rows[0].password
+        assert [open_password(row.password) for row in rows] == ["plain", "sealed", None]
+
+
+def test_fresh_database(file_app):
+    with file_app.app_context():
+        upgrade()
+        assert db.session.execute("SELECT version_num FROM alembic_version").scalar()
+
+
+def test_baseline_database(baseline_app):
+    # `flask initdb` then `flask db upgrade`
+    with baseline_app.app_context():
+        db.create_all()
+        upgrade()
+        db.session.remove()
+
+    params = {"token": "BASELINE", "app_id": 1, "machine": "m", "user": "u", "hwid": "h"}
+    resp = TestApp(baseline_app).get("/api/check", params, expect_errors=True)
+    assert resp.status_code < 500
+    assert resp.json["result"] == "ok"
+    with baseline_app.app_context():
+        assert db.session.execute('SELECT version FROM "key"').scalar() == 1
+        application = db.session.execute("SELECT token_length, token_alphabet, token_app_prefix "
+                                         "FROM application").first()
+        assert tuple(application) == (None, None, False)
+        rows = db.session.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+        indexes = {name for name, in rows}
+        assert {"ix_activation_key_employee_hwid", "ix_key_unclaimed", "ix_key_app_id_id",
+                "ix_key_valid_until_id", "ix_key_claimed_at_id", "ix_audit_log_timestamp_id",
+                "ix_audit_log_event_type_timestamp_id", "ix_audit_log_app_id_timestamp_id",
+                "ix_audit_log_key_id_timestamp_id"} <= indexes
+        assert "WHERE claimed_by IS NULL" in db.session.execute(
+            "SELECT sql FROM sqlite_master WHERE name = 'ix_key_unclaimed'").scalar()
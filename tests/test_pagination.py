@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""Keyset pagination tests."""
+from datetime import datetime, timedelta
+
+import pytest
+
+from keyserv.keymanager import rand_token
+from keyserv.models import Application, Key, db
+from keyserv.pagination import keyset_page, parse_datetime
+
+
+def _keys(count, **columns):
+    application = Application(name=rand_token()[:8]).save()
+    keys = []
+    for n in range(count):
+        key = Key(token=rand_token(), remaining=1, app_id=application.id)
+        for name, values in columns.items():
+            setattr(key, name, values[n])
+        keys.append(key.save(commit=False))
+    db.session.commit()
+    return keys
+
+
+def _walk(column, descending=False, per_page=2):
+    ids, after = [], None
+    while True:
+        page = keyset_page(Key.query, column, Key.id, after, descending, per_page)
+        ids.extend(key.id for key in page.items)
+        if not page.cursor:
+            return ids
+        after = page.cursor
+
+
+@pytest.mark.usefixtures('db')
+class TestKeysetPage:
+    """Pages of (column, id) with NULLs last."""
+
+    def test_by_id(self):
+        keys = _keys(5)
+        assert _walk(Key.id) == [key.id for key in keys]
+        assert _walk(Key.id, descending=True) == [key.id for key in reversed(keys)]
+
+    def test_nullable_column(self):
+        now = datetime(2026, 1, 1)
+        expiries = [now + timedelta(days=2), None, now, now + timedelta(days=2), None,
+                    now + timedelta(days=1)]
+        keys = _keys(6, valid_until=expiries)
+        ids = [key.id for key in keys]
+
+        assert _walk(Key.valid_until) == [ids[2], ids[5], ids[0], ids[3], ids[1], ids[4]]
+        assert _walk(Key.valid_until, descending=True) == [ids[3], ids[0], ids[5], ids[2], ids[4],
+                                                           ids[1]]
+
+    def test_last_page_has_no_cursor(self):
+        _keys(2)
+        assert keyset_page(Key.query, Key.id, Key.id, per_page=2).cursor is None
+        assert keyset_page(Key.query, Key.id, Key.id, per_page=1).cursor
+
+    def test_bad_cursor(self):
+        with pytest.raises(ValueError):
+            keyset_page(Key.query, Key.valid_until, Key.id, after="1,yesterday")
+        with pytest.raises(ValueError):
+            keyset_page(Key.query, Key.id, Key.id, after="first")
+
+
+def test_parse_datetime():
+    moment = datetime(2026, 1, 2, 3, 4, 5, 678000)
+    assert parse_datetime(moment.isoformat()) == moment
+    assert parse_datetime("2026-01-02 03:04") == datetime(2026, 1, 2, 3, 4)
+    assert parse_datetime("2026-01-02") == datetime(2026, 1, 2)
+    with pytest.raises(ValueError):
+        parse_datetime("2026-01-02T03:04:05+00:00")
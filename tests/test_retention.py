@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+"""Audit log retention tests."""
+import csv
+import io
+import time
+from datetime import date, datetime, timedelta
+
+import pytest
+from sqlalchemy import event
+
+from keyserv.export import export_query
+from keyserv.keymanager import rand_token
+from keyserv.models import Application, AuditLog, AuditRollup, Event, Key, db
+from keyserv.retention import audit_retention
+
+from tests import fake
+
+NOW = datetime(2026, 6, 1, 12)
+
+
+def _log(key, event_type, age, message="log", now=NOW):
+    log = AuditLog(key.id, key.app_id, message, event_type)
+    log.timestamp = now - age
+    return log.save(commit=False)
+
+
+@pytest.mark.usefixtures('db')
+class TestAuditRetention:
+    """Rollups of old rows and chunked purges."""
+
+    @pytest.fixture(autouse=True)
+    def keys(self, app, db):
+        app.config.update(AUDIT_RETENTION={"KeyAccess": 30, "FailedActivation": 60},
+                          AUDIT_RETENTION_CHUNK=4, AUDIT_RETENTION_PAUSE=0)
+        audit_retention.init_app(app)
+        application = Application(name=fake.word()).save()
+        self.keys = [Key(token=rand_token(), remaining=1, app_id=application.id).save()
+                     for _ in range(2)]
+
+    def _rollups(self):
+        return {(rollup.day, rollup.key_id, Event(rollup.event_type)): rollup.count
+                for rollup in AuditRollup.query}
+
+    def test_purge(self, db):
+        first, second = self.keys
+        for hours in (0, 1, 2):
+            _log(first, Event.KeyAccess, timedelta(days=40, hours=hours))
+        _log(second, Event.KeyAccess, timedelta(days=40))
+        _log(second, Event.KeyAccess, timedelta(days=31))
+        _log(first, Event.KeyAccess, timedelta(days=29), "kept")
+        _log(first, Event.FailedActivation, timedelta(days=40), "kept")
+        _log(first, Event.KeyModified, timedelta(days=400), "kept")
+        db.session.commit()
+
+        assert audit_retention.purge(now=NOW) == 5
+        assert {log.message for log in AuditLog.query} == {"kept"}
+        assert AuditLog.query.count() == 3
+        day = (NOW - timedelta(days=40)).date()
+        assert self._rollups() == {(day, first.id, Event.KeyAccess): 3,
+                                   (day, second.id, Event.KeyAccess): 1,
+                                   (day + timedelta(days=9), second.id, Event.KeyAccess): 1}
+        assert audit_retention.stats()["purged"] == 5
+
+    def test_rollups_accumulate(self, db):
+        key = self.keys[0]
+        _log(key, Event.KeyAccess, timedelta(days=40))
+        db.session.commit()
+        audit_retention.purge(now=NOW)
+        _log(key, Event.KeyAccess, timedelta(days=40, hours=1))
+        _log(key, Event.KeyAccess, timedelta(days=41))
+        db.session.commit()
+        audit_retention.purge(now=NOW)
+
+        day = (NOW - timedelta(days=40)).date()
+        assert self._rollups() == {(day, key.id, Event.KeyAccess): 2,
+                                   (day - timedelta(days=1), key.id, Event.KeyAccess): 1}
+
+    def test_key_moved_between_apps(self, db):
+        key = self.keys[0]
+        _log(key, Event.KeyAccess, timedelta(days=40, hours=2))
+        key.app_id = Application(name=fake.word() + "2").save().id
+        _log(key, Event.KeyAccess, timedelta(days=40, hours=1))
+        db.session.commit()
+
+        assert audit_retention.purge(now=NOW) == 2
+        rollup = AuditRollup.query.one()
+        assert (rollup.key_id, rollup.app_id, rollup.count) == (key.id, key.app_id, 2)
+        assert audit_retention.stats()["conflicts"] == 0
+
+    def test_chunks(self, db, statements):
+        for n in range(10):
+            _log(self.keys[n % 2], Event.KeyAccess, timedelta(days=40, minutes=n))
+        db.session.commit()
+        statements.reset()
+
+        assert audit_retention.purge(now=NOW) == 10
+        deletes = [s for s in statements.statements if s.startswith("DELETE FROM audit_log")]
+        assert len(deletes) == 3
+        # a transaction per chunk, and none left over for an event with nothing to purge
+        assert statements.commits == 3
+
+    def test_cli(self, app, db):
+        # the command purges up to the current time
+        _log(self.keys[0], Event.Info, timedelta(days=3), now=datetime.now())
+        _log(self.keys[0], Event.Info, timedelta(hours=1), "kept", now=datetime.now())
+        db.session.commit()
+
+        result = app.test_cli_runner().invoke(args=["purge-audit-logs", "--event", "Info"])
+        assert result.exit_code != 0
+        assert "pass --days" in result.output
+
+        result = app.test_cli_runner().invoke(args=["purge-audit-logs", "--event", "Info",
+                                                    "--days", "2"])
+        assert result.exit_code == 0, result.output
+        assert "purged 1 " in result.output
+        assert [log.message for log in AuditLog.query] == ["kept"]
+
+    def test_export(self, app, db):
+        key_id = self.keys[0].id
+        _log(self.keys[0], Event.KeyAccess, timedelta(days=40))
+        _log(self.keys[1], Event.FailedActivation, timedelta(days=90))
+        db.session.commit()
+        audit_retention.purge(now=NOW)
+
+        since = str((NOW - timedelta(days=40)).date())
+        result = app.test_cli_runner().invoke(args=["export", "rollups", "--event", "KeyAccess",
+                                                    "--since", since])
+        assert result.exit_code == 0, result.output
+        rows = list(csv.DictReader(io.StringIO(result.output)))
+        assert [(row["day"], row["key_id"], row["event"], row["count"]) for row in rows] == \
+            [(str((NOW - timedelta(days=40)).date()), str(key_id), "KeyAccess", "1")]
+
+    def test_export_range(self, db):
+        _log(self.keys[0], Event.KeyAccess, timedelta(days=40))
+        _log(self.keys[0], Event.KeyAccess, timedelta(days=41))
+        db.session.commit()
+        audit_retention.purge(now=NOW)
+        day = (NOW - timedelta(days=40)).date()
+
+        def days(since, until):
+            return [row.day for row in export_query("rollups", since=since, until=until)]
+
+        # `until` stays exclusive at midnight but takes the whole day it ends in otherwise
+        assert days(None, datetime.combine(day, datetime.min.time())) == [day - timedelta(days=1)]
+        assert days(None, NOW - timedelta(days=40, hours=6)) == [day - timedelta(days=1), day]
+        assert days(NOW - timedelta(days=40, hours=6), None) == [day]
+
+
+def test_worker(file_app):
+    file_app.config.update(AUDIT_RETENTION={"KeyAccess": 1}, AUDIT_RETENTION_INTERVAL=0.05)
+    audit_retention.init_app(file_app)
+    with file_app.app_context():
+        application = Application(name=fake.word()).save()
+        key = Key(token=rand_token(), remaining=1, app_id=application.id).save()
+        log = AuditLog(key.id, key.app_id, "old", Event.KeyAccess)
+        log.timestamp = datetime.now() - timedelta(days=2)
+        log.save()
+
+    audit_retention.start()
+    deadline = time.monotonic() + 5
+    while audit_retention.stats()["purged"] < 1 and time.monotonic() < deadline:
+        time.sleep(0.01)
+    audit_retention.stop()
+
+    assert audit_retention.stats()["purged"] == 1
+    with file_app.app_context():
+        assert AuditRollup.query.one().day == date.today() - timedelta(days=2)
+
+
+def test_chunk_taken_by_another_purge(file_app):
+    file_app.config.update(AUDIT_RETENTION={"KeyAccess": 30})
+    audit_retention.init_app(file_app)
+    with file_app.app_context():
+        application = Application(name=fake.word()).save()
+        key = Key(token=rand_token(), remaining=1, app_id=application.id).save()
+        for n in range(3):
+            _log(key, Event.KeyAccess, timedelta(days=40, minutes=n))
+        db.session.commit()
+        taken = []
+
+        def other_purge(conn, cursor, statement, parameters, context, executemany):
+            # another process purges one of the rows just read and commits first
+            if statement.startswith("DELETE FROM audit_log") and not taken:
+                taken.append(parameters[0])
+                with db.engine.connect() as other:
+                    other.execute(AuditLog.__table__.delete().where(AuditLog.id == parameters[0]))
+
+        event.listen(db.engine, "before_cursor_execute", other_purge)
+        try:
+            assert audit_retention.purge(now=NOW) == 2
+        finally:
+            event.remove(db.engine, "before_cursor_execute", other_purge)
+        assert AuditLog.query.count() == 0
+        assert AuditRollup.query.one().count == 2
+        assert audit_retention.stats()["conflicts"] == 1
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""Token generator tests."""
+from collections import Counter
+
+import pytest
+
+from keyserv.tokens import (DEFAULT_ALPHABET, MAX_PREFIX_APP_ID, TokenGenerator, app_id_of,
+                            app_prefix, check_character, checksum_valid, generator_for,
+                            normalize_token, token_filter, token_generator)
+
+
+class TestTokenGenerator:
+    """Batched tokens without modulo bias."""
+
+    def test_defaults(self):
+        tokens = TokenGenerator().tokens(100)
+        assert len(tokens) == len(set(tokens)) == 100
+        assert all(len(token) == 30 and set(token) <= set(DEFAULT_ALPHABET) for token in tokens)
+        assert all(checksum_valid(token) for token in tokens)
+        assert not TokenGenerator(25).checked
+
+    def test_length_and_alphabet(self):
+        token = TokenGenerator(100, "01").token()
+        assert len(token) == 100
+        assert set(token) <= {"0", "1"}
+
+    def test_biased_bytes_are_rejected(self, monkeypatch):
+        # 256 % 3 == 1, so byte 255 would make "A" more likely than "B" and "C"
+        monkeypatch.setattr("keyserv.tokens.secrets.token_bytes",
+                            lambda n: bytes([255, 0, 1, 2, 255, 4] * n))
+        assert TokenGenerator(64, "ABC").token() == "ABCB" * 16
+
+    def test_uniform(self):
+        counts = Counter("".join(TokenGenerator(100, "ABCDEFG").tokens(700)))
+        # 10000 draws per character; 5% is far outside the expected deviation
+        assert all(abs(count - 10000) < 500 for count in counts.values())
+
+    @pytest.mark.parametrize("alphabet", ["A", "AAB", "ÄB", "ab", "A-B", "A B"])
+    def test_bad_alphabet(self, alphabet):
+        with pytest.raises(ValueError):
+            TokenGenerator(alphabet=alphabet)
+
+    @pytest.mark.parametrize("length, alphabet", [(99, "01"), (35, "ABCDEFG"), (30, "XY")])
+    def test_too_little_entropy(self, length, alphabet):
+        with pytest.raises(ValueError, match="random bits"):
+            TokenGenerator(length, alphabet)
+        assert TokenGenerator(100, "01").entropy == 100
+
+    def test_generator_for(self):
+        class Application:
+            id = 7
+            token_length = None
+            token_alphabet = "XYZ0123456789"
+            token_app_prefix = False
+
+        assert generator_for(None) is token_generator()
+        generator = generator_for(Application())
+        assert (generator.length, generator.alphabet) == (30, "XYZ0123456789")
+        assert generator.checked
+
+
+class TestTokenFilter:
+    """Rejection of malformed tokens before any query."""
+
+    def test_check_character(self):
+        # from the right F..A doubled alternately: 10 + 4 + 6 + 2 + 2 + 0 = 24,
+        # and 36 - 24 = 12 is "M"
+        assert check_character("ABCDEF") == "M"
+        body = TokenGenerator(29).token()
+        token = body + check_character(body)
+        assert checksum_valid(token)
+        # any other character in any place changes the check character
+        assert all(check_character(body[:3] + char + body[4:]) != token[-1]
+                   for char in DEFAULT_ALPHABET if char != body[3])
+
+    def test_normalize(self):
+        assert normalize_token(" abcde-fghij\n") == "ABCDEFGHIJ"
+
+    @pytest.mark.parametrize("token,valid", [
+        ("", False), ("-- -", False), ("A" * 513, False), ("ABC\x00", False), ("ABCDÉ", False),
+        ("A" * 25, True), ("A" * 30, True), ("A" * 29 + "C", False), ("A" * 29 + "B", False),
+        ("ABCDEFGHIJ", True)])
+    def test_parse(self, token, valid):
+        assert bool(token_filter.parse(token)) == valid
+
+    def test_grouped_token(self):
+        # a fixed token: a typo in a random one can pass the check of the prefixed layout
+        token = "FDY894Z7EWK5LCFGQ1W4HFLSO5AQ9P"
+        grouped = "-".join(token[i:i + 5] for i in range(0, 30, 5)).lower()
+        before = token_filter.stats()
+        assert token_filter.parse(grouped) == token
+        assert token_filter.parse(grouped[:-1] + "A") is None
+        stats = token_filter.stats()
+        assert stats["accepted"] - before["accepted"] == 1
+        assert stats["rejected"] - before["rejected"] == 1
+
+
+class TestAppPrefix:
+    """Tokens starting with their application id."""
+
+    @pytest.mark.parametrize("app_id", [1, 36, 1234, MAX_PREFIX_APP_ID])
+    def test_round_trip(self, app_id):
+        tokens = TokenGenerator(prefix=app_prefix(app_id)).tokens(20)
+        assert all(len(token) == 30 and checksum_valid(token) for token in tokens)
+        assert {app_id_of(token) for token in tokens} == {app_id}
+        grouped = "-".join(tokens[0][i:i + 5] for i in range(0, 30, 5))
+        assert token_filter.parse(grouped) == tokens[0]
+
+    def test_unprefixed(self):
+        assert app_id_of(TokenGenerator().token()) is None
+        assert app_id_of("A" * 25) is None
+
+    def test_prefix_is_checked(self):
+        token = TokenGenerator(prefix=app_prefix(1234)).token()
+        assert app_id_of(token[:2] + ("B" if token[2] != "B" else "C") + token[3:]) is None
+
+    def test_limits(self):
+        with pytest.raises(ValueError):
+            app_prefix(MAX_PREFIX_APP_ID + 1)
+        with pytest.raises(ValueError):
+            TokenGenerator(25, prefix="AAB")
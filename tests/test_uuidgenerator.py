@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 """Test configs."""
-from uuid import uuid4
+from uuid import UUID, uuid4
 
-from kunin.utils.uuidgenerator import UUIDGenerator
+import pytest
+
+from keyserv.uuidgenerator import UUIDGenerator
 
 
 def test_generate_uuid():
@@ -62,3 +64,36 @@ def test_format_hex_throws_exception():
         str_uuid_no_dashes = uuid4().hex[:-2]
         new_uuid = UUIDGenerator.format_uuid_hex(str_uuid_no_dashes)
     assert 'provided is NOT a proper uuid' in str(excinfo.value)
+
+
+# written by the baseconv implementation
+STORED = {1: "7fffffff9bbf43f39e249e92ff405b30", 1000: "7ffffc1819a44eaa830966d3d46837b7",
+          123456789: "78a432eb717f4eb6ae923410bab9b7f4", 0: "80000000746c4b5da45e1c33de3d8d01"}
+
+
+@pytest.mark.parametrize("int_id,stored", STORED.items())
+def test_stored_values(int_id, stored, monkeypatch):
+    """Check that ids map to and from uuids as the baseconv implementation did"""
+    assert UUIDGenerator.uuid_to_int(stored) == int_id
+    assert not UUIDGenerator.new_version(stored)
+    # the random part of a stored uuid, before the flag was set
+    random = UUID(int=UUID(stored).int & ~(0x80 << 24))
+    monkeypatch.setattr("keyserv.uuidgenerator.uuid4", lambda: random)
+    assert UUIDGenerator.int_to_uuid(int_id).hex == stored
+
+
+def test_int_to_uuids():
+    """Check that the batch conversion matches int_to_uuid but for the random bits"""
+    ids = [1, 1000, 123456789, 0]
+    uuids = UUIDGenerator.int_to_uuids(ids)
+    assert [UUIDGenerator.uuid_to_int(u.hex) for u in uuids] == ids
+    assert all(u.version == 4 and not UUIDGenerator.new_version(u) for u in uuids)
+    assert len({u.int & ((1 << 96) - 1) for u in uuids}) == len(ids)
+
+
+def test_int_to_uuid_out_of_range():
+    """Check that ids without an eight digit uuid prefix are refused"""
+    with pytest.raises(ValueError):
+        UUIDGenerator.int_to_uuid((1 << 31) - (1 << 28) + 1)
+    with pytest.raises(ValueError):
+        UUIDGenerator.int_to_uuids([-(1 << 31)])
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""Verdict cache unit tests."""
+import datetime as dt
+
+from keyserv.verdictcache import Verdict, VerdictCache
+
+from tests import freeze_time
+
+
+def _verdict(key_id=1, **kwargs):
+    return Verdict(key_id, 5, 0, None, **kwargs)
+
+
+class TestVerdictCache:
+    """LRU, TTL and invalidation behaviour."""
+
+    def test_hit_and_miss(self):
+        cache = VerdictCache(size=10)
+        assert cache.get(("a",)) is None
+        cache.put(("a",), _verdict())
+        assert cache.get(("a",)) == _verdict()
+        assert cache.stats()["hits"] == 1
+        assert cache.stats()["misses"] == 1
+
+    def test_lru_eviction(self):
+        cache = VerdictCache(size=2)
+        cache.put(("a",), _verdict(1))
+        cache.put(("b",), _verdict(2))
+        cache.get(("a",))
+        cache.put(("c",), _verdict(3))
+        assert cache.get(("b",)) is None
+        assert cache.get(("a",)) is not None
+        assert cache.stats()["evictions"] == 1
+
+    def test_ttl(self):
+        cache = VerdictCache(size=10, ttl=-1)
+        cache.put(("a",), _verdict())
+        assert cache.get(("a",)) is None
+        assert cache.stats()["size"] == 0
+
+    def test_invalidate(self):
+        cache = VerdictCache(size=10)
+        cache.put(("a",), _verdict(1))
+        cache.put(("b",), _verdict(1))
+        cache.put(("c",), _verdict(2))
+        cache.invalidate(1)
+        assert cache.get(("a",)) is None
+        assert cache.get(("b",)) is None
+        assert cache.get(("c",)) is not None
+
+    def test_disabled(self):
+        cache = VerdictCache(size=0)
+        cache.put(("a",), _verdict())
+        assert cache.get(("a",)) is None
+
+    @freeze_time('2020-01-01')
+    def test_still_valid(self):
+        assert _verdict().still_valid()
+        tomorrow, last_year = dt.datetime(2020, 1, 2), dt.datetime(2019, 1, 2)
+        assert _verdict(activation=True, activation_valid_until=tomorrow).still_valid()
+        assert not _verdict(activation=True, activation_valid_until=last_year).still_valid()
+        assert not _verdict(activation=True).still_valid()
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""Admin view tests."""
+import re
+from datetime import datetime, timedelta
+
+import pytest
+
+from keyserv.keymanager import rand_token
+from keyserv.models import Application, AuditLog, Event, Key, db
+
+from tests import fake
+
+
+@pytest.fixture
+def admin(app, testapp):
+    app.config.update(LOGIN_DISABLED=True, ADMIN_PAGE_SIZE=10)
+    return testapp
+
+
+def _key_ids(resp):
+    return [int(key_id) for key_id in re.findall(r'/detail/key/(\d+)"', resp.text)]
+
+
+@pytest.mark.usefixtures('db')
+class TestKeyListing:
+    """Keyset-paginated /keys and /keys/app/<id>."""
+
+    @pytest.fixture(autouse=True)
+    def keys(self, db):
+        self.apps = [Application(name=fake.word() + str(n)).save().id for n in range(3)]
+        for n in range(30):
+            key = Key(token=rand_token(), remaining=1, app_id=self.apps[n % 3], enabled=n % 2 == 0)
+            key.cutdate = datetime.utcnow()
+            key.valid_until = key.cutdate + timedelta(days=n - 10)
+            if n % 5 == 0:
+                key.claimed_by = "someone@example.com"
+            key.save(commit=False)
+        db.session.commit()
+        self.ids = [key.id for key in Key.query.order_by(Key.id)]
+        db.session.expunge_all()
+
+    def _walk(self, admin, url, params):
+        ids, pages = [], 0
+        resp = admin.get(url, params)
+        while True:
+            pages += 1
+            ids.extend(_key_ids(resp))
+            more = re.search(r'href="([^"]+)" class="btn btn-default">Next page', resp.text)
+            if not more:
+                return ids, pages
+            resp = admin.get(more.group(1).replace("&amp;", "&"))
+
+    def test_pages(self, admin):
+        ids, pages = self._walk(admin, "/keys", {})
+        assert ids == self.ids
+        assert pages == 3
+
+    def test_queries_per_page(self, admin, statements):
+        admin.get("/keys")
+        # the application list for the filter and the page of keys with their applications
+        assert len([s for s in statements.statements if s.startswith("SELECT")]) == 2
+        db.session.expunge_all()
+        statements.reset()
+        admin.get(f"/keys/app/{self.apps[0]}")
+        assert len([s for s in statements.statements if s.startswith("SELECT")]) == 2
+
+    def test_filters(self, admin):
+        ids, _ = self._walk(admin, "/keys", {"enabled": "no", "claimed": "yes"})
+        assert ids == [self.ids[n] for n in (5, 15, 25)]
+        ids, _ = self._walk(admin, "/keys", {"expiry": "expired", "app": self.apps[1]})
+        assert ids == [self.ids[n] for n in (1, 4, 7, 10)]
+
+        export = admin.get("/keys", {"expiry": "expired", "claimed": "no", "sort": "expiry"}).html \
+            .find("a", string="Export CSV")["href"]
+        assert export.startswith("/export/keys.csv?")
+        assert "expiry=expired" in export and "claimed=no" in export and "sort" not in export
+
+    def test_sort(self, admin):
+        ids, _ = self._walk(admin, "/keys", {"sort": "expiry", "order": "desc"})
+        assert ids == list(reversed(self.ids))
+        ids, _ = self._walk(admin, "/keys", {"sort": "claimed"})
+        assert sorted(ids) == self.ids
+
+    def test_keys_for_app(self, admin):
+        ids, pages = self._walk(admin, f"/keys/app/{self.apps[2]}", {"sort": "expiry"})
+        assert ids == self.ids[2::3]
+        assert pages == 1
+
+    def test_bad_cursor(self, admin):
+        resp = admin.get("/keys", {"sort": "expiry", "after": "1,soon"}, expect_errors=True)
+        assert resp.status_code == 400
+
+    def test_app_key_counts(self, admin):
+        assert "<td>10</td>" in admin.get("/applications").text
+        assert ">10</a></li>" in admin.get(f"/detail/app/{self.apps[0]}").text
+
+
+@pytest.mark.usefixtures('db')
+class TestAuditLogViewer:
+    """Keyset-paginated /logs, newest first."""
+
+    @pytest.fixture(autouse=True)
+    def logs(self, db):
+        start = datetime(2026, 1, 1)
+        self.apps = [Application(name=fake.word() + str(n)).save().id for n in range(2)]
+        self.keys = [Key(token=rand_token(), remaining=1, app_id=self.apps[n % 2]).save().id
+                     for n in range(3)]
+        for n in range(25):
+            log = AuditLog(self.keys[n % 3], self.apps[n % 3 % 2], f"log {n}",
+                           Event.KeyAccess if n % 4 else Event.AppActivation)
+            # pairs of rows share a timestamp, so the id breaks the tie
+            log.timestamp = start + timedelta(minutes=n // 2)
+            log.save(commit=False)
+        db.session.commit()
+        self.ids = [log.id for log in AuditLog.query.order_by(AuditLog.id)]
+        db.session.expunge_all()
+
+    def _walk(self, admin, params):
+        ids, pages = [], 0
+        resp = admin.get("/logs", params)
+        while True:
+            pages += 1
+            ids.extend(self.ids[int(n)] for n in re.findall(r"<td>log (\d+)</td>", resp.text))
+            more = re.search(r'href="([^"]+)" class="btn btn-default">Next page', resp.text)
+            if not more:
+                return ids, pages
+            resp = admin.get(more.group(1).replace("&amp;", "&"))
+
+    def test_pages(self, admin):
+        ids, pages = self._walk(admin, {})
+        assert ids == list(reversed(self.ids))
+        assert pages == 3
+        ids, _ = self._walk(admin, {"order": "asc"})
+        assert ids == self.ids
+
+    def test_one_query_per_page(self, admin, statements):
+        resp = admin.get("/logs")
+        # the page with its key tokens and app names, and the application list for the filter
+        selects = [s for s in statements.statements if s.startswith("SELECT")]
+        assert len(selects) == 2
+        assert "JOIN application" in selects[0] and 'JOIN "key"' in selects[0]
+        assert Key.query.get(self.keys[0]).token in resp.text
+
+    def test_filters(self, admin):
+        ids, _ = self._walk(admin, {"event": int(Event.AppActivation)})
+        assert ids == [self.ids[n] for n in (24, 20, 16, 12, 8, 4, 0)]
+        ids, _ = self._walk(admin, {"key": self.keys[1], "app": self.apps[1]})
+        assert ids == [self.ids[n] for n in (22, 19, 16, 13, 10, 7, 4, 1)]
+        ids, _ = self._walk(admin, {"since": "2026-01-01T00:03", "until": "2026-01-01 00:05",
+                                    "order": "asc"})
+        assert ids == self.ids[6:10]
+
+    def test_bad_parameters(self, admin):
+        assert admin.get("/logs", {"since": "yesterday"}, expect_errors=True).status_code == 400
+        assert admin.get("/logs", {"after": "3,noon"}, expect_errors=True).status_code == 400
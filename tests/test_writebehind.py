@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Write-behind buffer tests."""
+import time
+
+import pytest
+
+from keyserv.auditpolicy import audit_policy
+from keyserv.keymanager import Origin, key_valid_const, rand_token
+from keyserv.models import Application, AuditLog, Event, Key, db
+from keyserv.uuidgenerator import UUIDGenerator
+from keyserv.writebehind import AuditSink, CheckCounters, audit_sink, check_counters
+
+from tests import fake
+
+
+def _key():
+    application = Application(name=fake.word(), support_message=fake.sentence()).save()
+    return Key(token=rand_token(), remaining=5, app_id=application.id).save()
+
+
+def _sink(app, **config):
+    app.config.update(AUDIT_ASYNC=True, **config)
+    sink = AuditSink()
+    sink.init_app(app)
+    return sink
+
+
+@pytest.mark.usefixtures('db')
+class TestAuditSink:
+    """Batched audit log writes."""
+
+    def test_flush_on_stop(self, app):
+        sink = _sink(app, AUDIT_BATCH_SIZE=10, AUDIT_FLUSH_INTERVAL=60)
+        key = _key()
+        for _ in range(25):
+            sink.emit(key.id, key.app_id, fake.sentence(), Event.KeyAccess)
+        sink.stop()
+
+        logs = AuditLog.query.all()
+        assert len(logs) == 25
+        assert all(UUIDGenerator.uuid_to_int(log.uuid) == log.id for log in logs)
+        assert sink.stats()["written"] == 25
+        assert sink.stats()["batches"] >= 3
+
+    def test_flush_on_interval(self, app):
+        sink = _sink(app, AUDIT_BATCH_SIZE=100, AUDIT_FLUSH_INTERVAL=0.01)
+        key = _key()
+        for _ in range(3):
+            sink.emit(key.id, key.app_id, fake.sentence(), Event.KeyAccess)
+        deadline = time.monotonic() + 5
+        while sink.stats()["written"] < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert sink.stats()["written"] == 3
+        sink.stop()
+
+    def test_bounded_buffer(self, app):
+        sink = _sink(app, AUDIT_BATCH_SIZE=100, AUDIT_FLUSH_INTERVAL=60,
+                     AUDIT_BUFFER_SIZE=5, AUDIT_BUFFER_TIMEOUT=0)
+        key = _key()
+        for _ in range(8):
+            sink.emit(key.id, key.app_id, fake.sentence(), Event.KeyAccess)
+        assert sink.stats()["buffered"] == 5
+        assert sink.stats()["dropped"] == 3
+        sink.stop()
+        assert AuditLog.query.count() == 5
+
+
+@pytest.mark.usefixtures('db')
+class TestAuditSinkCommits:
+    """Audit rows through the sink next to the caller's own transaction."""
+
+    @pytest.fixture(autouse=True)
+    def sink(self, app):
+        app.config.update(AUDIT_ASYNC=True, AUDIT_FLUSH_INTERVAL=60, CHECK_COUNTERS_ASYNC=False)
+        audit_sink.init_app(app)
+        check_counters.init_app(app)
+        yield
+        app.config.update(AUDIT_ASYNC=False)
+        audit_sink.init_app(app)
+
+    def test_caller_changes_are_committed(self):
+        key = _key()
+        key_id = key.id
+        for ip in ("10.0.0.1", "10.0.0.2", "10.0.0.3"):
+            assert key_valid_const(key.app_id, key.token, Origin(ip, "m", "u", "aa:bb"))
+        db.session.remove()
+
+        key = Key.query.get(key_id)
+        assert key.total_checks == 3
+        assert key.last_check_ip == "10.0.0.3"
+        audit_sink.flush()
+        assert AuditLog.query.filter_by(key_id=key_id, event_type=int(Event.KeyAccess)).count() == 3
+
+    def test_sampled_out_checks_are_committed(self, app):
+        app.config["AUDIT_SAMPLING"] = {"KeyAccess": 60}
+        audit_policy.init_app(app)
+        key = _key()
+        key_id = key.id
+        for _ in range(3):
+            assert key_valid_const(key.app_id, key.token, Origin("10.0.0.1", "m", "u", "aa:bb"))
+        db.session.remove()
+
+        assert Key.query.get(key_id).total_checks == 3
+        audit_sink.flush()
+        assert AuditLog.query.filter_by(key_id=key_id, event_type=int(Event.KeyAccess)).count() == 1
+
+    def test_rolled_back_work_logs_nothing(self):
+        key = _key()
+        AuditLog.from_key(key, "never happened", Event.KeyModified, commit=False)
+        db.session.rollback()
+        AuditLog.from_key(key, "kept", Event.KeyModified, commit=False)
+        db.session.commit()
+        audit_sink.flush()
+        logs = AuditLog.query.filter_by(event_type=int(Event.KeyModified))
+        assert [log.message for log in logs] == ["kept"]
+
+
+@pytest.mark.usefixtures('db')
+class TestCheckCounters:
+    """Aggregated check counters."""
+
+    def test_aggregated_update(self, app, statements):
+        app.config.update(CHECK_COUNTERS_ASYNC=True, CHECK_COUNTERS_INTERVAL=60)
+        counters = CheckCounters()
+        counters.init_app(app)
+        first, second = _key(), _key()
+        for _ in range(3):
+            counters.record(first.id, "10.0.0.1")
+        counters.record(second.id, "10.0.0.2")
+        counters.record(first.id, "10.0.0.3")
+
+        statements.reset()
+        counters.stop()
+        assert len([s for s in statements.statements if s.startswith("UPDATE")]) == 1
+
+        db.session.refresh(first)
+        db.session.refresh(second)
+        assert first.total_checks == 4
+        assert first.last_check_ip == "10.0.0.3"
+        assert second.total_checks == 1
+        assert counters.stats()["written"] == 5